@@ -0,0 +1,12 @@
+"""Benchmarks of the API, not shipped with the package.
+
+- `benchmarks.e2e`: load test of POST /email through the whole stack,
+  against local stub provider servers (`benchmarks.stub_servers`)
+- `benchmarks.micro`: hot paths of a send (validation, routing,
+  serialization) at 1 to 10k recipients, failing on regressions
+
+Run them from the root of the repo, e.g.::
+
+    python -m benchmarks.e2e --help
+
+"""
@@ -0,0 +1,219 @@
+"""Throughput and tail latency of POST /email, through the whole stack.
+
+Starts a stub server per provider (see `benchmarks.stub_servers`), then
+for each WSGI server backend runs the API with `email_api.api.start_app`
+in a subprocess, configured to send to the stubs, and loads it with
+`benchmarks.load.run_load`. Backends that are not installed are
+skipped, backends that fail are reported as such::
+
+    python -m benchmarks.e2e --servers wsgiref,gunicorn --requests 2000 \\
+        --concurrency 16 --latency 0.02 --error-rate 0.01
+
+Prints req/s and p50/p95/p99 latencies per backend, and the answers of
+the stubs. `--json` prints the results as JSON instead.
+
+"""
+import argparse
+import importlib.util
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+import yaml
+
+from benchmarks.load import run_load
+from benchmarks.stub_servers import StubServer
+
+
+# Module needed by the bottle server adapters, when it's not their name
+SERVER_MODULES = {
+    'wsgiref': 'wsgiref',
+    'paste': 'paste',
+    'cheroot': 'cheroot',
+}
+
+PAYLOADS = [
+    {'to': 'Bench <bench{}@example.com>'.format(i),
+     'subject': 'Benchmark {}'.format(i),
+     'text': 'Hello there',
+     'html': '<p>Hello there</p>'}
+    for i in range(100)
+]
+
+
+def available(server):
+    module = SERVER_MODULES.get(server, server)
+    return importlib.util.find_spec(module) is not None
+
+
+def free_port(host='127.0.0.1'):
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def build_config(stubs, server, port, workers):
+    """Returns the API config sending to the stub servers.
+
+    Args:
+      stubs (list[StubServer]): In the order of the default route
+      server (str): bottle server backend
+      port (int):
+      workers (int): gunicorn workers
+    """
+    config = {
+        'host': '127.0.0.1',
+        'port': port,
+        'server': server,
+        'providers': {
+            stub.provider: {
+                'user': 'bench',
+                'key': 'bench',
+                'domain': 'example.com',
+                'from_name': 'noreply',
+                'human_name': 'Benchmark',
+                'base_url': stub.url,
+            }
+            for stub in stubs
+        },
+        'routes': {'default': [stub.provider for stub in stubs]},
+    }
+    if server == 'gunicorn':
+        config['server_extra'] = {'workers': workers,
+                                  'worker_class': 'gthread',
+                                  'threads': 8}
+    return config
+
+
+def wait_until_up(url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("The API exited with {}".format(
+                process.returncode
+            ))
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError("The API did not start in {}s".format(timeout))
+
+
+def bench_server(server, stubs, args):
+    """Runs the API with a server backend and loads it.
+
+    Returns:
+      dict: `LoadResult.to_dict`
+    """
+    port = free_port()
+    config = build_config(stubs, server, port, args.workers)
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml') as conf:
+        yaml.safe_dump(config, conf)
+        conf.flush()
+        env = dict(os.environ, EMAIL_API_CONFIG=conf.name)
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'email_api.api'], env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=None if args.verbose else subprocess.DEVNULL
+        )
+        try:
+            base = 'http://127.0.0.1:{}'.format(port)
+            wait_until_up(base + '/metrics', process)
+            url = base + '/email'
+            run_load(url, PAYLOADS, args.warmup, args.concurrency)
+            return run_load(url, PAYLOADS, args.requests,
+                            args.concurrency).to_dict()
+        finally:
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--servers', default='wsgiref,gunicorn',
+                        help='Comma separated bottle server backends')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--warmup', type=int, default=100,
+                        help='Requests sent before measuring')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=4,
+                        help='gunicorn workers')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Stub answer delay, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Share of 500 answers of the stubs')
+    parser.add_argument('--throttle-rate', type=float, default=0,
+                        help='Share of 429 answers of the stubs')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as JSON')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Show the API logs')
+    return parser.parse_args(argv)
+
+
+def print_report(results, stubs):
+    print('{:<12}{:>10}{:>10}{:>10}{:>10}  statuses'.format(
+        'server', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'
+    ))
+    for server, res in results.items():
+        if res is None:
+            print('{:<12}not installed, skipped'.format(server))
+            continue
+        if 'error' in res:
+            print('{:<12}failed: {}'.format(server, res['error']))
+            continue
+        print('{:<12}{:>10}{:>10}{:>10}{:>10}  {}'.format(
+            server, res['req_per_sec'], res['p50_ms'], res['p95_ms'],
+            res['p99_ms'], res['statuses']
+        ))
+    for stub in stubs:
+        print('stub {}: {}'.format(stub.provider, dict(stub.statuses)))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    stubs = [
+        StubServer(provider, latency=args.latency,
+                   error_rate=args.error_rate,
+                   throttle_rate=args.throttle_rate, seed=args.seed)
+        for provider in ('mailgun', 'elasticemail')
+    ]
+    for stub in stubs:
+        stub.start()
+    results = {}
+    try:
+        for server in args.servers.split(','):
+            server = server.strip()
+            if not available(server):
+                results[server] = None
+                continue
+            try:
+                results[server] = bench_server(server, stubs, args)
+            except Exception as e:  # pylint: disable=W0703
+                # Still report the other backends
+                results[server] = {'error': str(e)}
+    finally:
+        for stub in stubs:
+            stub.stop()
+
+    if args.json:
+        print(json.dumps({
+            'results': results,
+            'stubs': {s.provider: dict(s.statuses) for s in stubs},
+        }, indent=2))
+    else:
+        print_report(results, stubs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""A closed loop load generator: `concurrency` threads sending requests
+one after the other, as fast as the server answers.
+"""
+import itertools
+import threading
+import time
+from collections import Counter
+
+import requests
+
+
+def percentile(sorted_values, pct):
+    """Nearest rank percentile.
+
+    Args:
+      sorted_values (list[float]): Sorted, not empty
+      pct (float): Between 0 and 100
+
+    Returns:
+      float
+    """
+    rank = max(int(round(pct / 100 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class LoadResult:
+    """Latencies and statuses of a load run.
+    """
+
+    def __init__(self, latencies, statuses, duration):
+        """
+        Args:
+          latencies (list[float]): Seconds, of each request
+          statuses (Counter): Count by HTTP status, 'error' for requests
+            that got no answer
+          duration (float): Seconds, of the whole run
+        """
+        self.latencies = sorted(latencies)
+        self.statuses = statuses
+        self.duration = duration
+
+    @property
+    def throughput(self):
+        """Requests per second.
+        """
+        return len(self.latencies) / self.duration if self.duration else 0
+
+    def percentiles(self, pcts=(50, 95, 99)):
+        """Returns the latency percentiles, in seconds, by percentile.
+        """
+        if not self.latencies:
+            return {pct: None for pct in pcts}
+        return {pct: percentile(self.latencies, pct) for pct in pcts}
+
+    def to_dict(self):
+        pcts = self.percentiles()
+        return {
+            'requests': len(self.latencies),
+            'duration': round(self.duration, 3),
+            'req_per_sec': round(self.throughput, 1),
+            'p50_ms': _ms(pcts[50]),
+            'p95_ms': _ms(pcts[95]),
+            'p99_ms': _ms(pcts[99]),
+            'statuses': {str(k): v for k, v in sorted(
+                self.statuses.items(), key=lambda item: str(item[0])
+            )},
+        }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def run_load(url, payloads, requests_count, concurrency=8, timeout=30):
+    """Sends `requests_count` POST requests to `url`.
+
+    Args:
+      url (str):
+      payloads (list[dict]): JSON bodies, used in turn
+      requests_count (int):
+      concurrency (int): Requests in flight
+      timeout (float): Seconds, per request
+
+    Returns:
+      LoadResult
+    """
+    counter = itertools.count()
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+
+    def worker():
+        with requests.Session() as session:
+            while True:
+                index = next(counter)
+                if index >= requests_count:
+                    return
+                payload = payloads[index % len(payloads)]
+                start = time.perf_counter()
+                try:
+                    status = session.post(url, json=payload,
+                                          timeout=timeout).status_code
+                except requests.RequestException:
+                    status = 'error'
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed)
+                    statuses[status] += 1
+
+    threads = [threading.Thread(target=worker, daemon=True)
+               for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return LoadResult(latencies, statuses, time.perf_counter() - start)
@@ -0,0 +1,276 @@
+"""Microbenchmarks of the hot paths of a send, with regression checks.
+
+Each benchmark runs at several recipient counts (1, 1k and 10k by
+default). Timings are the best per call time over a few repeats, which
+is the most stable figure on a busy machine.
+
+Results are compared to a JSON baseline: the run fails (exit code 1) if
+a benchmark got slower than the baseline by more than `--threshold`
+percent. The baseline is written on the first run, and replaced with
+`--update`::
+
+    python -m benchmarks.micro                  # Compare to the baseline
+    python -m benchmarks.micro --update         # Accept the new timings
+    python -m benchmarks.micro --only build_email --sizes 10000
+
+Baselines depend on the machine, keep one per machine (or CI runner)
+with `--baseline`.
+
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import timeit
+
+from email_api import message
+from email_api.api import get_route
+from email_api.elasticemail_provider import ElasticEmailProvider
+from email_api.mailgun_provider import MailgunProvider
+from email_api.message import Email, build_email, build_recipients
+from email_api.provider_registry import create_provider
+from email_api.providers_manager import ProvidersManager
+from email_api.routing import Router
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baselines',
+                                'micro.json')
+DEFAULT_SIZES = (1, 1000, 10000)
+DEFAULT_THRESHOLD = 20  # Percent
+
+PROVIDERS_CONFIG = {
+    nickname: {'user': 'bench', 'key': 'bench', 'domain': 'example.com',
+               'from_name': 'noreply', 'human_name': 'Benchmark'}
+    for nickname in ('mailgun', 'elasticemail')
+}
+
+ROUTES = {
+    'default': ['mailgun', 'elasticemail'],
+    'recipients': [
+        {'domains': ['gmail.com', '.corp.fr'], 'providers': ['elasticemail']},
+        {'regex': '.*@((hotmail)|(outlook)|(live))\\..*',
+         'providers': ['mailgun']},
+    ],
+}
+
+_DOMAINS = ('example.com', 'gmail.com', 'mail.corp.fr', 'hotmail.fr')
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Registers a benchmark: a function taking the recipient count and
+    returning the callable to time, with its inputs prebuilt. Or a
+    (setup, func) tuple to time `func(setup())`, for functions whose
+    results are cached on their input.
+    """
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def addresses(size):
+    return ['Recipient {0} <r{0}@{1}>'.format(i, _DOMAINS[i % len(_DOMAINS)])
+            for i in range(size)]
+
+
+def new_emails(size, from_=None):
+    """Returns a function building a new validated email, with `size`
+    recipients and none of their serialization cached yet.
+    """
+    recipients = build_recipients({'to': addresses(size)})
+    email = Email(subject='Benchmark', text='Hello', html='<p>Hello</p>',
+                  from_=from_)
+    return lambda: email.with_recipients(recipients)
+
+
+@benchmark('build_recipients')
+def bench_build_recipients(size):
+    recipients = {'to': addresses(size)}
+    return lambda: build_recipients(recipients)
+
+
+@benchmark('build_recipients_uncached')
+def bench_build_recipients_uncached(size):
+    recipients = {'to': addresses(size)}
+    return message.validation_cache.clear, \
+        lambda _: build_recipients(recipients)
+
+
+@benchmark('build_email')
+def bench_build_email(size):
+    recipients = build_recipients({'to': addresses(size)})
+    return lambda: build_email(recipients, 'Benchmark', 'Hello',
+                               '<p>Hello</p>', 'Bench <bench@example.com>')
+
+
+@benchmark('get_route')
+def bench_get_route(size):
+    config = {'routes': ROUTES}
+    config['email_api.router'] = Router(ROUTES, {
+        p.nickname: p for p in (MailgunProvider, ElasticEmailProvider)
+    })
+    return new_emails(size), \
+        lambda email: get_route(config, email, 'recipients')
+
+
+@benchmark('prep_request')
+def bench_prep_request(size):
+    manager = ProvidersManager([MailgunProvider], PROVIDERS_CONFIG)
+    provider = create_provider(MailgunProvider, PROVIDERS_CONFIG)
+    return new_emails(size, provider.default_from_address), \
+        lambda email: manager._prep_request(  # pylint: disable=W0212
+            email, provider, lambda *args, **kwargs: None
+        )
+
+
+def _bench_email_to_data(provider_class):
+    def bench(size):
+        provider = create_provider(provider_class, PROVIDERS_CONFIG)
+        return new_emails(size, provider.default_from_address), \
+            provider.email_to_data
+    return bench
+
+
+for _class in (MailgunProvider, ElasticEmailProvider):
+    benchmark('email_to_data.{}'.format(_class.nickname))(
+        _bench_email_to_data(_class)
+    )
+
+
+def _time_with_setup(setup, func, number):
+    # Like timeit, keep the garbage collector out of the measure
+    gc.collect()
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        total = 0
+        for _ in range(number):
+            arg = setup()
+            start = timeit.default_timer()
+            func(arg)
+            total += timeit.default_timer() - start
+        return total
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def measure(bench, repeat=5, min_time=0.2, max_wall_time=2):
+    """Returns the best time of a call, in seconds.
+
+    Args:
+      bench: A benchmark result, see `benchmark`
+      repeat (int): Number of measures, the best is kept
+      min_time (float): Seconds to spend per measure
+      max_wall_time (float): Max seconds per measure, with the setups
+    """
+    if callable(bench):
+        timer = timeit.Timer(bench)
+        number, _ = timer.autorange()
+        # autorange aims for 0.2s per repeat, stretch it if asked
+        number = max(number, int(number * min_time / 0.2))
+        return min(timer.repeat(repeat=repeat, number=number)) / number
+
+    setup, func = bench
+    # Calibrate like autorange, minding the (untimed) setup duration
+    number = 1
+    while True:
+        start = timeit.default_timer()
+        timed = _time_with_setup(setup, func, number)
+        wall = timeit.default_timer() - start
+        if timed >= min_time or wall * 2 >= max_wall_time:
+            break
+        number *= 2
+    return min(_time_with_setup(setup, func, number)
+               for _ in range(repeat)) / number
+
+
+def run(names, sizes, repeat=5):
+    """
+    Returns:
+      dict: Seconds per call by "<benchmark>[<size>]"
+    """
+    results = {}
+    for name in names:
+        for size in sizes:
+            results['{}[{}]'.format(name, size)] = measure(
+                BENCHMARKS[name](size), repeat
+            )
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Returns the benchmarks slower than the baseline by more than
+    `threshold` percent, as (key, baseline, result) tuples.
+    """
+    regressions = []
+    for key, value in results.items():
+        previous = baseline.get(key)
+        if previous and (value - previous) / previous * 100 > threshold:
+            regressions.append((key, previous, value))
+    return regressions
+
+
+def load_baseline(path):
+    try:
+        with open(path) as baseline:
+            return json.load(baseline)
+    except FileNotFoundError:
+        return None
+
+
+def save_baseline(path, results):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as baseline:
+        json.dump(results, baseline, indent=2, sort_keys=True)
+        baseline.write('\n')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Max slowdown, in percent')
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='Comma separated recipient counts')
+    parser.add_argument('--only', action='append', choices=sorted(BENCHMARKS),
+                        help='Benchmark to run, can be repeated')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--update', action='store_true',
+                        help='Save the results as the new baseline')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = run(args.only or sorted(BENCHMARKS), sizes, args.repeat)
+    baseline = load_baseline(args.baseline)
+
+    for key, value in results.items():
+        line = '{:<40}{:>12.1f} us'.format(key, value * 1e6)
+        if baseline and baseline.get(key):
+            line += '{:>+10.1f}%'.format(
+                (value - baseline[key]) / baseline[key] * 100
+            )
+        print(line)
+
+    if baseline is None or args.update:
+        # Keep the timings of benchmarks that were not run
+        save_baseline(args.baseline, dict(baseline or {}, **results))
+        print('Baseline saved to {}'.format(args.baseline))
+        return 0
+
+    regressions = compare(results, baseline, args.threshold)
+    for key, previous, value in regressions:
+        print('REGRESSION {}: {:.1f} us -> {:.1f} us'.format(
+            key, previous * 1e6, value * 1e6
+        ))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+"""Local HTTP servers answering like the provider APIs, to benchmark the
+API without sending emails.
+
+Each `StubServer` mimics the send endpoint of one provider, with a
+configurable latency, error rate and rate of 429 (throttled) answers.
+Point a provider to it with `base_url` in its config::
+
+    with StubServer('mailgun', latency=0.05, error_rate=0.01) as stub:
+        config['providers']['mailgun']['base_url'] = stub.url
+
+"""
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _mailgun_success():
+    return {'id': '<{}@stub>'.format(uuid.uuid4().hex),
+            'message': 'Queued. Thank you.'}
+
+
+def _elasticemail_success():
+    return {'success': True,
+            'data': {'transactionid': uuid.uuid4().hex,
+                     'messageid': uuid.uuid4().hex}}
+
+
+# Path prefix of the send endpoint and success body, by provider nickname
+ENDPOINTS = {
+    'mailgun': ('/v3/', _mailgun_success),
+    'elasticemail': ('/v2/email/send', _elasticemail_success),
+}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real APIs
+
+    def do_POST(self):  # pylint: disable=C0103
+        stub = self.server.stub
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+
+        prefix, success = ENDPOINTS[stub.provider]
+        if not self.path.startswith(prefix):
+            status, body = 404, {'message': 'Not found'}
+        else:
+            status, body = stub.answer(success)
+        if stub.latency:
+            time.sleep(stub.latency)
+
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if status == 429:
+            self.send_header('Retry-After', str(stub.retry_after))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *_):  # pylint: disable=W0221
+        pass
+
+
+class StubServer:
+    """A threaded HTTP server answering like a provider, on a free port.
+    """
+
+    def __init__(self, provider, latency=0, error_rate=0, throttle_rate=0,
+                 retry_after=1, host='127.0.0.1', port=0, seed=None):
+        """
+        Args:
+          provider (str): Nickname of the provider to mimic, see
+            `ENDPOINTS`
+          latency (float): Seconds to wait before answering
+          error_rate (float): Share of requests answered with a 500
+          throttle_rate (float): Share of requests answered with a 429
+          retry_after (int): Retry-After header of the 429s, in seconds
+          host (str):
+          port (int): 0 for any free port
+          seed (Optional[int]): Makes the errors reproducible
+        """
+        if provider not in ENDPOINTS:
+            raise ValueError("No stub for provider: {}".format(provider))
+        self.provider = provider
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.statuses = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def answer(self, success):
+        """Draws the status of a request.
+
+        Returns:
+          tuple: (status code, JSON body)
+        """
+        with self._lock:
+            draw = self._random.random()
+            if draw < self.throttle_rate:
+                status, body = 429, {'message': 'Too many requests'}
+            elif draw < self.throttle_rate + self.error_rate:
+                status, body = 500, {'message': 'Internal error'}
+            else:
+                status, body = 200, success()
+            self.statuses[status] += 1
+        return status, body
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True,
+            name='stub-{}'.format(self.provider)
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
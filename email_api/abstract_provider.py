@@ -26,6 +26,13 @@ class InvalidProviderError(Exception):
     pass
 
 
+class InvalidCallbackError(Exception):
+    """Raise if a webhook call of a provider is malformed, or can't be
+    authenticated.
+    """
+    pass
+
+
 class DataFormat(Enum):
     """ Enum values map to `requests.request()` arguments for sending data.
 
@@ -60,6 +67,36 @@ class AProvider(ABC):
 
     Subclasses should have their own
     """
+
+    max_batch_size = None
+    """Max emails sent in one API call by `emails_to_batch_data`. None if
+    the provider has no batch API.
+    """
+
+    attachment_field = None
+    """Multipart form field of the attachments. None if the provider
+    can't send attachments, it is then skipped for emails with files.
+    `email_to_data` must use `DataFormat.form` for the manager to stream
+    the files along the form.
+    """
+
+    supports_templates = False
+    """If `email_to_data` handles mail merge emails (`Email.templated`)
+    with server side substitution. If not, the manager renders them and
+    sends one email per recipient.
+    """
+
+    api_url = None
+    """Root URL of the provider API, `send_url` should be built from
+    `base_url` which can be overridden in the config.
+    """
+
+    max_recipients = None
+    """Max recipients (to, cc and bcc) of an email in one API call, None
+    if there is no limit. Can be overridden in the config, see
+    `recipient_limit`.
+    """
+
     def __init__(self, config=None):
         """
         Args:
@@ -113,8 +150,11 @@ class AProvider(ABC):
         The provider sub class must also be aware of the email recipient
         data structure: `email_api.message.Recipient` and adapt it to its need.
 
-        Files are currently not implemented in `email_api.message` but
-        they should also be wrapped in a class such as `Attachment`
+        Files (`email_api.attachments.Attachment`) must be left out, the
+        manager streams them, see `attachment_field`.
+
+        The email is usually frozen and must not be modified, the
+        result is memoized per provider and must not be modified either.
 
         Args:
             email (email_api.message.Email): The email to be serialized
@@ -133,6 +173,74 @@ class AProvider(ABC):
     def is_success(self, response: requests.Response) -> bool:
         pass
 
+    def batch_key(self, email):
+        """Returns what emails must have in common to be sent in the same
+        batch, e.g. their content.
+
+        Only called if `max_batch_size` is set, providers with a batch
+        API must implement it along with `emails_to_batch_data`.
+
+        Args:
+            email (email_api.message.Email): A frozen email
+
+        Returns:
+            A hashable key, None if this email can't be batched
+        """
+        return None
+
+    def emails_to_batch_data(self, emails):
+        """Format many emails to the provider batch API format.
+
+        Same as `email_to_data` for a list of emails sharing the same
+        `batch_key`, at most `max_batch_size` of them.
+
+        Returns:
+            tuple::
+
+                (email_api.provider.DataFormat, dict)
+
+        """
+        raise NotImplementedError(
+            "{} has no batch API".format(self.nickname)
+        )
+
+    def message_id(self, response):
+        """Returns the ID the provider gave to an email it accepted, read
+        from its answer to the `send_url` request. Its webhook events
+        refer to the email by this ID.
+
+        Args:
+            response: The answer of the provider, a `requests.Response`
+              look-alike
+
+        Returns:
+            Optional[str]: None if unknown
+        """
+        return None
+
+    def parse_callback(self, data):
+        """Turns a webhook call of the provider into standard events.
+
+        Like `email_to_data` it must not do any I/O: the events are
+        queued by the caller and saved later.
+
+        Args:
+            data (dict): The JSON body, or the form and query parameters
+              of the call
+
+        Raises:
+            InvalidCallbackError: If the call is malformed, or not from
+              the provider
+            NotImplementedError: If the provider has no webhooks
+
+        Returns:
+            list[email_api.webhooks.DeliveryEvent]: Events we don't
+              track are left out
+        """
+        raise NotImplementedError(
+            "{} has no webhooks".format(self.nickname)
+        )
+
     def validate(self):
         """Validates subclass implementation.
 
@@ -171,10 +279,43 @@ class AProvider(ABC):
             )
 
     def fill_in_blanks(self, email):
+        """Returns the email with the defaults of this provider.
+
+        The email is shared by all the providers tried, it is not
+        modified: a copy is returned if something had to be filled in.
+
+        Returns:
+            email_api.message.Email
+        """
         if not email.from_:
-            email.from_ = self.build_from_address()
+            return email.replace(from_=self.default_from_address)
         return email
 
+    @property
+    def recipient_limit(self):
+        """`max_recipients`, unless the provider config has its own
+        `max_recipients`.
+        """
+        conf = getattr(self, '_config', None) or {}
+        return conf.get('max_recipients', self.max_recipients)
+
+    @property
+    def base_url(self):
+        """`api_url`, unless the provider config has a `base_url` (e.g. a
+        proxy, or a stub server to benchmark the API).
+        """
+        conf = getattr(self, '_config', None) or {}
+        return conf.get('base_url', self.api_url).rstrip('/')
+
+    @property
+    def default_from_address(self):
+        """The `build_from_address` result, built once per instance.
+        """
+        address = getattr(self, '_default_from', None)
+        if address is None:
+            address = self._default_from = self.build_from_address()
+        return address
+
     def build_from_address(self):
         str_addr = '{} <{}@{}>'.format(
             self._config['human_name'],
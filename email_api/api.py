@@ -5,16 +5,7 @@ The glue is here.
 
 TODO:
 
-- Save the email to persistent storage (SQLAlchemy + sqlite), adding
-an ID and status
-
-- Provide GET endpoint to fetch by ID, or ALL with pagination
-
-- Provide a POST /hook/<providername> endpoint (for status update)
-that uses the ProvidersManager to handle API specific data and
-standardize it, then update Email records status
-
-- Add rate limiting or auth, or both
+- Provide GET endpoint to fetch ALL with pagination
 
 - Add HATEOAS links in endpoints' return data
 
@@ -22,8 +13,10 @@ standardize it, then update Email records status
 import logging
 import json
 import sys
-import re
 import os
+import time
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
 
 import bottle
 bottle.BaseRequest.MEMFILE_MAX = 1024 * 1024
@@ -36,19 +29,59 @@ from bottle import (
     abort,
     default_app,
     app,
-    error
+    error,
+    HTTPError
 )
 
 from email_api.message import (
     InvalidRecipientError,
     InvalidEmailError,
+    VALIDATION_CACHE_KEY,
     build_email,
-    build_recipients
+    build_recipients,
+    configure_validation_cache
+)
+from email_api.providers_manager import ProvidersManager, ChunkedResponse
+from email_api.provider_registry import ProviderRegistry
+from email_api.abstract_provider import (
+    InvalidCallbackError,
+    InvalidProviderError
 )
-from email_api.providers_manager import ProvidersManager
 from email_api.mailgun_provider import MailgunProvider
 from email_api.elasticemail_provider import ElasticEmailProvider
 from email_api.config import load_config, valid_config_or_exit, PROVIDERS_KEY
+from email_api.sessions import SessionPool
+from email_api.routing import Router, UnconfiguredRouteError
+from email_api.circuit_breaker import CircuitBreakers
+from email_api.provider_stats import ProviderStats, STATS_KEY
+from email_api.deadline import Timeouts, DeadlineExceededError
+from email_api.rate_limit import RateLimiter
+from email_api.concurrency import AdaptiveLimits
+from email_api.auth import (
+    ApiKeys,
+    AUTH_KEY,
+    InvalidApiKeyConfigError,
+    retry_after_header
+)
+from email_api.idempotency import (
+    Idempotency,
+    IDEMPOTENCY_KEY,
+    InFlightError,
+    KeyReusedError,
+    MAX_KEY_LENGTH,
+    fingerprint
+)
+from email_api.webhooks import EventQueue, QueueFullError, WEBHOOKS_KEY
+from email_api.batch import LimitedReader, iter_json_items, send_batch
+from email_api.attachments import Attachment
+from email_api import metrics
+from email_api.outbox import (
+    Outbox,
+    OutboxWorkers,
+    OUTBOX_KEY,
+    QUEUED,
+    DEFAULTS as OUTBOX_DEFAULTS
+)
 
 _LOG = logging.getLogger()
 
@@ -62,8 +95,55 @@ PROVIDER_BY_NICK = {
     p.nickname: p for p in REGISTERED_PROVIDERS
 }
 
+# Keys of the runtime objects shared by all requests, stored in the app
+# config next to the YAML config
+SESSIONS_KEY = 'email_api.sessions'
+ROUTER_KEY = 'email_api.router'
+OUTBOX_OBJ_KEY = 'email_api.outbox'
+OUTBOX_WORKERS_KEY = 'email_api.outbox_workers'
+BREAKERS_KEY = 'email_api.breakers'
+STATS_OBJ_KEY = 'email_api.stats'
+TIMEOUTS_KEY = 'email_api.timeouts'
+REGISTRY_KEY = 'email_api.registry'
+RATE_LIMITS_KEY = 'email_api.rate_limits'
+CONCURRENCY_OBJ_KEY = 'email_api.concurrency'
+API_KEYS_KEY = 'email_api.api_keys'
+METRICS_EXPORTER_KEY = 'email_api.metrics_exporter'
+IDEMPOTENCY_OBJ_KEY = 'email_api.idempotency'
+WEBHOOK_EVENTS_KEY = 'email_api.webhook_events'
+
+# The `ApiClient` of an authenticated request, in its WSGI environ
+CLIENT_ENV_KEY = 'email_api.client'
+
+# Send the recipients matching different route rules separately
+SPLIT_ROUTING_KEY = 'split_routing'
+SPLIT_ROUTING_DEFAULTS = {
+    'enabled': False,
+    'concurrency': 4,
+}
+
+# Emails with more recipients than a provider accepts are split
+CHUNKING_KEY = 'chunking'
+CHUNKING_DEFAULTS = {
+    'concurrency': 4,
+}
+
+BATCH_KEY = 'batch'
+BATCH_DEFAULTS = {
+    'concurrency': 8,
+    'max_items': 100000,
+    'max_item_size': 1024 * 1024,
+}
+
 
 @error(400)
+@error(401)
+@error(404)
+@error(409)
+@error(422)
+@error(429)
+@error(503)
+@error(504)
 def error400(err):
     response.content_type = 'application/json'
 
@@ -72,40 +152,96 @@ def error400(err):
     })
 
 
-def _order(nicks):
-    return [PROVIDER_BY_NICK[n] for n in nicks]
+def authenticated(callback):
+    """Route decorator checking the API key and rate limit of the client,
+    if `auth` is configured. Runs before the body is read, so rejected
+    requests cost a hash and a dict lookup.
+    """
+    @wraps(callback)
+    def wrapper(*args, **kwargs):
+        keys = app().config.get(API_KEYS_KEY)
+        if keys is not None:
+            client = keys.authenticate(keys.key_from(request.headers))
+            if client is None:
+                abort(401, "Missing or invalid API key")
+            wait = client.hit()
+            if wait:
+                _LOG.info("%s is over its rate limit", client.name)
+                raise HTTPError(
+                    429, "Rate limit exceeded",
+                    headers={'Retry-After': retry_after_header(wait)}
+                )
+            request.environ[CLIENT_ENV_KEY] = client
+        return callback(*args, **kwargs)
+    return wrapper
+
 
+def get_route(config, email, routing_type=None):
+    """Returns the provider classes to use for an email, by priority.
 
-class UnconfiguredRouteError(Exception):
-    pass
+    The routes are compiled once by `start_app`, if they were not (e.g.
+    app not started through `start_app`) they are compiled on first use.
 
+    With adaptive routing enabled, the providers allowed by the config
+    are re-ranked by their observed latency and success rate.
 
-def get_route(config, email, routing_type=None):
-    routes = config['routes']
+    Raises:
+        UnconfiguredRouteError
+    """
     if not routing_type:
-        return REGISTERED_PROVIDERS
+        providers = REGISTERED_PROVIDERS
+    else:
+        providers = _router(config).route(email, routing_type)
+    return _rank(config, providers)
 
-    joined = ';'.join([rec.email for rec in email.get_recipients('to')])
 
-    for rule in routes[routing_type]:
-        r = re.compile(rule['regex'])
-        res = r.match(joined)
-        if res and res.group(0):
-            print(res, res.group(0))
-            return _order(rule['providers'])
+def split_route(config, email, routing_type=None):
+    """Same as `get_route` for each group of recipients matching the
+    same rule, see `email_api.routing.Router.split`.
 
-    return _order(routes['default'])
+    Raises:
+        UnconfiguredRouteError
 
+    Returns:
+        list[tuple]: (email, provider classes) of each group
+    """
+    if not routing_type:
+        return [(email, get_route(config, email))]
+    return [
+        (part, _rank(config, providers))
+        for part, providers in _router(config).split(email, routing_type)
+    ]
 
-@route('/email', method='post')
-def send_email():
-    """ Validates and send an email.
 
-    Accepts JSON or url encoded parameters.
+def _router(config):
+    router = config.get(ROUTER_KEY)
+    if router is None:
+        router = Router(config.get('routes'), PROVIDER_BY_NICK)
+        config[ROUTER_KEY] = router
+    return router
 
-    """
-    params = request.json or request.params
 
+def _rank(config, providers):
+    stats = config.get(STATS_OBJ_KEY)
+    if stats is not None and stats.enabled:
+        return stats.rank(providers)
+    return providers
+
+
+def email_from_params(params, files=None):
+    """Builds and validates an email from the request parameters.
+
+    Args:
+        params (dict): JSON or url encoded parameters
+        files (Optional[list[Attachment]]): Attachments
+
+    Raises:
+        InvalidRecipientError
+        InvalidEmailError
+
+    Returns:
+        tuple: (Email, route type)
+    """
     recps = {
         'to': params.get('to'),
         'cc': params.get('cc'),
@@ -116,31 +252,483 @@ def send_email():
     html = params.get('html')
     from_ = params.get('from')
     reply_to = params.get('reply_to')
-    route = params.get('route')
+    variables = params.get('variables')
 
+    # Init and validate data structures
+    start = time.monotonic()
     try:
-        # Init and validate data structures
         recipients = build_recipients(recps)
-        email = build_email(recipients, subject, text, html, from_, reply_to)
+        email = build_email(recipients, subject, text, html, from_,
+                            reply_to, variables, files)
+    finally:
+        metrics.VALIDATION.observe(time.monotonic() - start)
+    return email, params.get('route')
+
+
+def _providers(email, route):
+    start = time.monotonic()
+    try:
+        return get_route(app().config, email, route)
+    except UnconfiguredRouteError:
+        _LOG.exception("Routing error")
+        raise InvalidEmailError("Unknown route: {}".format(route))
+    finally:
+        metrics.ROUTING.observe(time.monotonic() - start)
+
+
+def send(email, route):
+    """Routes and sends an email.
+
+    With split routing, recipients matching different rules are sent
+    separately, in parallel, each group through its own providers.
+
+    Raises:
+        InvalidEmailError: If the route is not configured
+        DeadlineExceededError: If the providers took too long
+
+    Returns:
+        tuple: (response, provider nickname), (None, None) on failure.
+          (ChunkedResponse, nicknames) if the email was split
+    """
+    parts = _split(email, route)
+    if len(parts) == 1:
         # Init Manager with registed providers
+        return new_manager(parts[0][1]).send(parts[0][0])
+
+    def send_part(part):
+        part_email, providers = part
         try:
-            providers = get_route(app().config, email, route)
-            print(providers)
-        except Exception as e: # TODO change this
-            _LOG.exception("Routing error")
-            raise InvalidEmailError
-        #
-        manager = ProvidersManager(
-            providers,
-            app().config[PROVIDERS_KEY]
+            return new_manager(providers).send(part_email)
+        except DeadlineExceededError as e:
+            _LOG.warning("Part of an email not sent: %s", e)
+            return None, None
+
+    conf = _split_routing_conf()
+    with ThreadPoolExecutor(min(len(parts), conf['concurrency'])) as pool:
+        return ChunkedResponse.merge(list(pool.map(send_part, parts)),
+                                     [part_email for part_email, _ in parts])
+
+
+def _split_routing_conf():
+    return dict(
+        SPLIT_ROUTING_DEFAULTS,
+        **(app().config.get(SPLIT_ROUTING_KEY) or {})
+    )
+
+
+def _split(email, route):
+    """Returns the (email, providers) to send, several if split routing
+    is enabled and the recipients match different rules.
+
+    Raises:
+        InvalidEmailError: If the route is not configured
+    """
+    if not _split_routing_conf()['enabled']:
+        return [(email, _providers(email, route))]
+    start = time.monotonic()
+    try:
+        return split_route(app().config, email, route)
+    except UnconfiguredRouteError:
+        _LOG.exception("Routing error")
+        raise InvalidEmailError("Unknown route: {}".format(route))
+    finally:
+        metrics.ROUTING.observe(time.monotonic() - start)
+
+
+def send_many(emails, route):
+    """Routes and sends many emails, emails with the same providers are
+    sent together so they can use the provider batch APIs.
+
+    Raises:
+        InvalidEmailError: If the route is not configured
+
+    Returns:
+        list[tuple]: (response, provider nickname) of each email, in
+          order, (None, None) on failure
+    """
+    groups = {}
+    results = [(None, None)] * len(emails)
+    for i, email in enumerate(emails):
+        parts = _split(email, route)
+        if len(parts) > 1:  # Split routing, parts are sent in parallel
+            results[i] = send(email, route)
+            continue
+        groups.setdefault(tuple(parts[0][1]), []).append(i)
+
+    for providers, indexes in groups.items():
+        sent = new_manager(list(providers)).send_many(
+            [emails[i] for i in indexes]
         )
-        res, provider = manager.send(email)
+        for i, res in zip(indexes, sent):
+            results[i] = res
+    return results
+
+
+def new_manager(providers):
+    """Returns a `ProvidersManager` wired to the state shared by all
+    requests.
+    """
+    config = app().config
+    chunking = dict(CHUNKING_DEFAULTS, **(config.get(CHUNKING_KEY) or {}))
+    return ProvidersManager(
+        providers,
+        config[PROVIDERS_KEY],
+        sessions=config.get(SESSIONS_KEY),
+        breakers=config.get(BREAKERS_KEY),
+        stats=config.get(STATS_OBJ_KEY),
+        timeouts=config.get(TIMEOUTS_KEY),
+        registry=config.get(REGISTRY_KEY),
+        max_parallel_chunks=chunking['concurrency'],
+        rate_limits=config.get(RATE_LIMITS_KEY),
+        concurrency=config.get(CONCURRENCY_OBJ_KEY)
+    )
 
+
+def submit(email, route):
+    """Sends the email, or queues it if the outbox is enabled and it has
+    no attachments.
+
+    Raises:
+        InvalidEmailError: If the route is not configured
+
+    Returns:
+        dict: The result to return to the client
+    """
+    outbox = app().config.get(OUTBOX_OBJ_KEY)
+    # Attachments only live for the request, they are not queued
+    if outbox is None or email.files:
+        res, provider = send(email, route)
+        result = {"sent": bool(res), "provider": provider}
+        if isinstance(res, ChunkedResponse):
+            result["chunks"] = {"sent": res.sent, "total": len(res)}
+        return result
+
+    _providers(email, route)  # Fail now on bad routes
+    id_ = outbox.put(email, route)
+    workers = app().config.get(OUTBOX_WORKERS_KEY)
+    if workers is not None:
+        workers.wakeup()
+    return {"id": id_, "status": QUEUED}
+
+
+def _send_email(params, files):
+    """Handles POST /email.
+
+    Returns:
+        tuple: The status code, body and headers of the response
+    """
+    try:
+        email, route = email_from_params(params, files)
+        res = submit(email, route)
     except (InvalidRecipientError, InvalidEmailError) as e:
+        _LOG.warning("%s", e)
+        return 400, {"error": str(e)}, {}
+    except DeadlineExceededError as e:
+        _LOG.warning("%s", e)
+        return 504, {
+            "error": "Providers did not answer in time: {}".format(e)
+        }, {}
+    if 'id' in res:
+        return 202, res, {'Location': '/email/{}'.format(res['id'])}
+    return 200, res, {}
+
+
+def _settled(result):
+    """False for the responses of emails that were not sent at all, a
+    retry should try again rather than get them replayed.
+
+    Emails sent in part (chunks or split routes) are kept: a retry would
+    send their sent chunks again.
+    """
+    status, res, _ = result
+    if status >= 500:
+        return False
+    chunks = res.get('chunks') or {}
+    return res.get('sent') is not False or chunks.get('sent', 0) > 0
+
+
+def _request_fingerprint(params, files):
+    if isinstance(params, bottle.MultiDict):
+        params = sorted(params.allitems())
+    return fingerprint(
+        params,
+        [(f.filename, f.content_type, f.size, f.digest()) for f in files]
+    )
+
+
+def _idempotent(func, params, files):
+    """Calls `func` at most once per `Idempotency-Key` of the client.
+    Without a key in the request, always calls it.
+    """
+    idempotency = app().config.get(IDEMPOTENCY_OBJ_KEY)
+    key = request.headers.get(idempotency.header) \
+        if idempotency is not None else None
+    if not key:
+        return func()
+    if len(key) > MAX_KEY_LENGTH:
+        abort(400, "Idempotency key longer than {} characters".format(
+            MAX_KEY_LENGTH
+        ))
+    # Clients can't see each other's results
+    client = request.environ.get(CLIENT_ENV_KEY)
+    if client is not None:
+        key = '{}:{}'.format(client.name, key)
+
+    try:
+        (status, res, headers), replayed = idempotency.run(
+            key, _request_fingerprint(params, files), func, keep=_settled
+        )
+    except KeyReusedError as e:
+        abort(422, e)
+    except InFlightError as e:
+        abort(409, e)
+    if replayed:
+        _LOG.info("Replaying the response of idempotency key %s", key)
+        headers = dict(headers, **{'Idempotent-Replayed': 'true'})
+    return status, res, headers
+
+
+@route('/email', method='post')
+@authenticated
+def send_email():
+    """ Validates and send an email.
+
+    Accepts JSON or url encoded parameters, or multipart form data with
+    file attachments.
+
+    If the outbox is enabled the email is only saved, we answer 202 with
+    its ID and it is sent in the background.
+
+    A retry with the same `Idempotency-Key` header gets the response of
+    the first request, the email is not sent twice.
+
+    """
+    params = request.json or request.params
+    files = _attachments()
+
+    try:
+        status, res, headers = _idempotent(
+            lambda: _send_email(params, files), params, files
+        )
+    finally:
+        for attachment in files:
+            attachment.close()
+    response.status = status
+    for name, value in headers.items():
+        response.set_header(name, value)
+    return res
+
+
+@route('/email/<id_>', method='get')
+@authenticated
+def get_email(id_):
+    """ Returns the status of an email saved in the outbox.
+    """
+    outbox = app().config.get(OUTBOX_OBJ_KEY)
+    status = outbox.get(id_) if outbox is not None else None
+    if status is None:
+        abort(404, "Email not found")
+    return status
+
+
+def message_id(response, provider):
+    """Returns the ID a provider gave to an email, to match its delivery
+    events. See `ProvidersManager.message_id`.
+    """
+    klass = PROVIDER_BY_NICK.get(provider)
+    if klass is None:
+        return None
+    return new_manager([klass]).message_id(response, provider)
+
+
+@route('/webhook/<provider>', method='post')
+def receive_webhook(provider):
+    """ Receives the delivery events of a provider and queues them, they
+    are saved to the outbox database in batches.
+
+    Not behind the API keys, providers sign their calls instead (see
+    their `parse_callback`). Answers as soon as the events are queued,
+    a 503 tells the provider to call again later.
+
+    """
+    events_queue = app().config.get(WEBHOOK_EVENTS_KEY)
+    if events_queue is None:
+        abort(404, "Webhooks need the outbox")
+
+    try:
+        events = new_manager(REGISTERED_PROVIDERS).handle_callback(
+            provider, request.json or request.params
+        )
+    except InvalidProviderError as e:
+        abort(404, e)
+    except InvalidCallbackError as e:
         _LOG.warning("%s", e)
         abort(400, e)
-    print(res.text)
-    return {"sent": bool(res), "provider": provider}
+
+    try:
+        events_queue.put(events)
+    except QueueFullError as e:
+        _LOG.warning("Webhook events dropped: %s", e)
+        abort(503, "Too many events, try again later")
+    return {"queued": len(events)}
+
+
+@route('/providers/breakers', method='get')
+def get_breakers():
+    """ Returns the circuit breaker state of each provider, for the
+    worker process answering.
+    """
+    breakers = app().config.get(BREAKERS_KEY)
+    return breakers.snapshot() if breakers is not None else {}
+
+
+@route('/providers/concurrency', method='get')
+def get_concurrency():
+    """ Returns the adaptive concurrency limit of each provider, for the
+    worker process answering.
+    """
+    limits = app().config.get(CONCURRENCY_OBJ_KEY)
+    return limits.snapshot() if limits is not None else {}
+
+
+@route('/providers/stats', method='get')
+def get_provider_stats():
+    """ Returns the latency and success rate moving averages of each
+    provider, for the worker process answering.
+    """
+    stats = app().config.get(STATS_OBJ_KEY)
+    return stats.snapshot() if stats is not None else {}
+
+
+@route('/metrics', method='get')
+def get_metrics():
+    """ Prometheus metrics, added up across the worker processes if the
+    metrics `dir` is configured.
+    """
+    exporter = app().config.get(METRICS_EXPORTER_KEY)
+    snapshots = exporter.collect() if exporter is not None \
+        else [metrics.snapshot()]
+    response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return metrics.render(snapshots)
+
+
+def _attachments():
+    """Returns the files uploaded with the request as `Attachment`.
+
+    Bottle already spooled big uploads to disk, the attachments read
+    its files rather than copies.
+    """
+    if not request.content_type.startswith('multipart/'):
+        return []
+    return [
+        Attachment.from_file(upload.raw_filename, upload.file,
+                             upload.content_type)
+        for _, upload in request.files.allitems() if upload.raw_filename
+    ]
+
+
+def _send_batch_item(params):
+    """Same as `send_email` for one item of a batch, errors are
+    returned instead of raised.
+    """
+    if not isinstance(params, dict):
+        return {"error": "Each item must be a JSON object"}
+    try:
+        email, route = email_from_params(params)
+        return submit(email, route)
+    except (InvalidRecipientError, InvalidEmailError) as e:
+        return {"error": str(e)}
+    except DeadlineExceededError as e:
+        return {"sent": False, "error": str(e)}
+
+
+def _request_body_stream():
+    """Returns the raw request body as a stream, bypassing bottle's
+    body buffering (and its `MEMFILE_MAX`).
+    """
+    if 'chunked' in request.environ.get('HTTP_TRANSFER_ENCODING', ''):
+        # Let bottle decode it, it spools big bodies to a temp file
+        return request.body
+    return LimitedReader(
+        request.environ['wsgi.input'], max(request.content_length, 0)
+    )
+
+
+def _batch_rate_limit(client):
+    """Returns the `send_batch` `admit` function charging each email to
+    the rate limit of the client, the request counted for the first one.
+    """
+    def admit(index):
+        wait = client.hit() if index else 0
+        if not wait:
+            return None
+        _LOG.info("%s is over its rate limit", client.name)
+        return "Rate limit exceeded, retry from index {} in {}s".format(
+            index, retry_after_header(wait)
+        )
+    return admit
+
+
+@route('/emails/batch', method='post')
+@authenticated
+def send_emails_batch():
+    """ Validates and send many emails.
+
+    Accepts a JSON array of emails, or NDJSON (one email per line), each
+    email having the same parameters as POST /email. The body is parsed
+    as it is read, there is no size limit.
+
+    Streams back NDJSON: one line per email, in order of completion, as
+    the `send_email` result plus the `index` of the email in the batch,
+    or an `error`.
+
+    Each email counts as a request for the rate limit of the client, the
+    batch stops with an error line at the first one over it.
+
+    """
+    conf = dict(BATCH_DEFAULTS, **(app().config.get(BATCH_KEY) or {}))
+    client = request.environ.get(CLIENT_ENV_KEY)
+    items = iter_json_items(
+        _request_body_stream(), max_item_size=conf['max_item_size']
+    )
+    results = send_batch(
+        items,
+        _send_batch_item,
+        max_in_flight=conf['concurrency'],
+        max_items=conf['max_items'],
+        admit=_batch_rate_limit(client) if client is not None else None
+    )
+
+    response.content_type = 'application/x-ndjson'
+    return (json.dumps(res) + '\n' for res in results)
+
+
+def server_options(config, on_worker_start):
+    """Returns the extra arguments of the WSGI server.
+
+    The `on_worker_start` callbacks are called right away, or in each
+    worker after the fork with gunicorn (threads don't survive a fork).
+
+    Args:
+      config (dict): The application config
+      on_worker_start (list[callable]): Called without arguments
+
+    Returns:
+      dict
+    """
+    extra = dict(config.get('server_extra') or {})
+    if config.get('server', 'wsgiref') != 'gunicorn':
+        for func in on_worker_start:
+            func()
+        return extra
+
+    # gunicorn checks the hook takes exactly (server, worker)
+    def post_fork(server, worker):  # pylint: disable=W0613
+        for func in on_worker_start:
+            func()
+
+    extra['post_fork'] = post_fork
+    return extra
 
 
 def start_app(argv):
@@ -149,17 +737,94 @@ def start_app(argv):
     config = load_config(file_path)
     valid_config_or_exit(config, REGISTERED_PROVIDERS)
 
+    try:
+        router = Router(config.get('routes'), PROVIDER_BY_NICK)
+    except UnconfiguredRouteError as e:
+        _LOG.critical("Invalid routes: %s. Exiting", e)
+        exit(1)
+
+    try:
+        registry = ProviderRegistry(
+            REGISTERED_PROVIDERS, config[PROVIDERS_KEY]
+        )
+    except (InvalidProviderError, KeyError) as e:
+        _LOG.critical("Invalid provider: %s. Exiting", e)
+        exit(1)
+
+    try:
+        api_keys = ApiKeys.from_config(config.get(AUTH_KEY))
+    except InvalidApiKeyConfigError as e:
+        _LOG.critical("Invalid auth config: %s. Exiting", e)
+        exit(1)
+
+    try:
+        rate_limits = RateLimiter.from_config(config)
+    except ValueError as e:
+        _LOG.critical("Invalid rate limit: %s. Exiting", e)
+        exit(1)
+
+    configure_validation_cache(config.get(VALIDATION_CACHE_KEY))
+    idempotency = Idempotency.from_config(config.get(IDEMPOTENCY_KEY))
+
     _app = default_app()
     _app.config.update(config)
+    _app.config[ROUTER_KEY] = router
+    _app.config[REGISTRY_KEY] = registry
+    _app.config[RATE_LIMITS_KEY] = rate_limits
+    _app.config[API_KEYS_KEY] = api_keys
+    _app.config[IDEMPOTENCY_OBJ_KEY] = idempotency
+    sessions = SessionPool(config)
+    _app.config[SESSIONS_KEY] = sessions
+    _app.config[BREAKERS_KEY] = CircuitBreakers(config)
+    _app.config[CONCURRENCY_OBJ_KEY] = AdaptiveLimits.from_config(config)
+    _app.config[STATS_OBJ_KEY] = ProviderStats.from_config(
+        config.get(STATS_KEY)
+    )
+    _app.config[TIMEOUTS_KEY] = Timeouts(config)
+    # Threads don't survive a fork, they must be started in each worker
+    on_worker_start = []
+    on_exit = [sessions.close]
 
-    extra = config.get('server_extra') or {}
-    # TODO: Configure logger, WSGI server conf
-    run(app=_app,
-        host=config.get('host', 'localhost'),
-        port=config.get('port', 8080),
-        server=config.get('server', 'wsgiref'),
-        **extra
+    exporter = metrics.MetricsExporter.from_config(
+        config.get(metrics.METRICS_KEY)
     )
+    if exporter is not None:
+        exporter.reset()  # Before the workers start
+        _app.config[METRICS_EXPORTER_KEY] = exporter
+        on_worker_start.append(exporter.start)
+        on_exit.append(exporter.stop)
+
+    if config.get(OUTBOX_KEY) is not None:
+        conf = dict(OUTBOX_DEFAULTS, **config[OUTBOX_KEY])
+        outbox = Outbox.from_config(conf)
+        workers = OutboxWorkers(
+            outbox, send, conf['workers'], conf['batch_size'],
+            conf['poll_interval'], send_many=send_many,
+            message_id=message_id
+        )
+        events = EventQueue.from_config(outbox.add_events,
+                                        config.get(WEBHOOKS_KEY))
+        _app.config[OUTBOX_OBJ_KEY] = outbox
+        _app.config[OUTBOX_WORKERS_KEY] = workers
+        _app.config[WEBHOOK_EVENTS_KEY] = events
+        on_worker_start.extend([workers.start, events.start])
+        on_exit[:0] = [workers.stop, events.stop]
+
+    server = config.get('server', 'wsgiref')
+    extra = server_options(config, on_worker_start)
+
+    # TODO: Configure logger, WSGI server conf
+    try:
+        run(app=_app,
+            host=config.get('host', 'localhost'),
+            port=config.get('port', 8080),
+            server=server,
+            **extra
+        )
+    finally:
+        # Also reached in gunicorn workers as they exit with SystemExit
+        for func in on_exit:
+            func()
 
 
 if __name__ == '__main__':
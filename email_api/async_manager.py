@@ -0,0 +1,173 @@
+"""Asyncio flavour of the `email_api.providers_manager.ProvidersManager`.
+
+Same provider contract, same failover rules, but the requests go
+through an `email_api.transports.AsyncTransport` so a single process
+can keep thousands of provider calls in flight instead of blocking a
+worker thread for the whole failover chain.
+
+E.g::
+
+    manager = AsyncProvidersManager(providers, config, AiohttpTransport())
+    results = await manager.send_all(emails, max_in_flight=500)
+
+"""
+import asyncio
+import logging
+import time
+
+from email_api import metrics
+from email_api.deadline import DeadlineExceededError
+from email_api.providers_manager import (
+    ProvidersManager,
+    ChunkedResponse,
+    FAILOVER_ERRORS
+)
+
+
+_LOG = logging.getLogger()
+
+
+class AsyncProvidersManager(ProvidersManager):
+    """`ProvidersManager` with coroutine `send` methods.
+    """
+
+    def __init__(self, provider_classes, config, transport, **kwargs):
+        """
+        Args:
+          provider_classes (list[AProvider]): Same as `ProvidersManager`
+          config (dict): Configuration that will be passed to providers
+          transport (email_api.transports.AsyncTransport): Does the I/O
+          kwargs: Shared state, see `ProvidersManager` (but `sessions`)
+        """
+        super().__init__(provider_classes, config, **kwargs)
+        self.transport = transport
+
+    async def send(self, email):  # pylint: disable=W0236
+        """Send an email, see `ProvidersManager.send`.
+
+        The transport `request` coroutine function is injected in
+        `_prep_request` in place of `requests.Session.request`.
+
+        Raises:
+          DeadlineExceededError
+
+        Returns:
+          tuple: (response, provider nickname), (None, None) on failure
+        """
+        email = email.freeze()
+        runs = self._template_runs(email)
+        if runs is not None:
+            return await self._send_runs_async(email, runs)
+        chunks = self._chunks(email)
+        if len(chunks) == 1:
+            return await self._send_async(chunks[0])
+        return ChunkedResponse.merge(
+            await self._send_chunks_async(chunks), chunks
+        )
+
+    async def _send_chunks_async(self, chunks, providers=None):
+        """Same as `ProvidersManager._send_chunks`.
+        """
+        semaphore = asyncio.Semaphore(self.max_parallel_chunks)
+
+        async def send_chunk(chunk):
+            async with semaphore:
+                try:
+                    return await self._send_async(chunk, providers)
+                except DeadlineExceededError as e:
+                    _LOG.warning("Chunk not sent: %s", e)
+                    return None, None
+
+        return await asyncio.gather(*(send_chunk(c) for c in chunks))
+
+    async def _send_runs_async(self, email, runs):
+        """Same as `ProvidersManager._send_runs`.
+        """
+        results, parts = [], []
+        for providers in runs:
+            chunks = self._chunks(email, providers)
+            unsent = self._sent_parts(
+                await self._send_chunks_async(chunks, providers), chunks,
+                results, parts
+            )
+            if not unsent:
+                break
+            email = email.with_recipients(unsent)
+        else:
+            results.append((None, None))
+            parts.append(email)
+        if len(results) == 1:
+            return results[0]
+        return ChunkedResponse.merge(results, parts)
+
+    async def _send_async(self, email, providers=None):
+        """The failover loop of `send`, see `ProvidersManager._send`.
+        """
+        deadline = self.timeouts.deadline() if self.timeouts else None
+        tried = 0
+        for klass in self._ordered() if providers is None else providers:
+            start = time.monotonic()
+            entered = None
+            try:
+                provider = self._provider(klass)
+                if not self._can_send(provider, email) or \
+                   not self._enter(provider):
+                    continue
+                entered = provider
+                if not await self._acquire_async(provider, deadline):
+                    continue
+                tried += 1
+                req = self._prep_request(
+                    email, provider, self.transport.request
+                )
+                kwargs = self._request_kwargs(provider, deadline)
+                if not self._allow(provider):
+                    continue
+                response = await req(**kwargs)
+            except FAILOVER_ERRORS as e:
+                self._on_error(klass, e, time.monotonic() - start)
+                continue
+            finally:
+                self._leave(entered)
+
+            if self._on_response(provider, response,
+                                 time.monotonic() - start):
+                metrics.FAILOVER_DEPTH.observe(tried)
+                return response, provider.nickname
+
+        metrics.FAILOVER_DEPTH.observe(tried)
+        return None, None
+
+    async def _acquire_async(self, provider, deadline):
+        """Same as `ProvidersManager._acquire`, waiting without blocking
+        the event loop.
+        """
+        if self.rate_limits is None:
+            return True
+        if await self.rate_limits.acquire_async(provider.nickname,
+                                                self._max_wait(deadline)):
+            return True
+        self._on_throttled(provider)
+        return False
+
+    async def send_all(self, emails, max_in_flight=None):
+        """Send many emails concurrently.
+
+        Args:
+          emails (Iterable[Email]):
+          max_in_flight (Optional[int]): Max emails being sent at the same
+            time, unbounded if None
+
+        Returns:
+          list[tuple]: The result of `send` for each email, in order
+        """
+        if not max_in_flight:
+            return await asyncio.gather(*(self.send(e) for e in emails))
+
+        semaphore = asyncio.Semaphore(max_in_flight)
+
+        async def bounded(email):
+            async with semaphore:
+                return await self.send(email)
+
+        return await asyncio.gather(*(bounded(e) for e in emails))
@@ -0,0 +1,286 @@
+"""Email attachments, streamed instead of loaded in memory.
+
+An `Attachment` is backed by bytes (small files), by a file on disk, or
+by an open file: uploads already spooled by the web framework are used
+as they are (`Attachment.from_file`), other streams bigger than the
+spool size are copied in chunks to a temporary file, which is deleted
+with `Attachment.close`.
+
+Each `Attachment.open` returns a new reader, so an attachment can be
+sent again by the next provider on failover, or by parallel chunks.
+
+`MultipartBody` streams a multipart/form-data request body: the form
+fields then the attachments, read from disk as the request is sent.
+`requests` sends file-like bodies as they are read, knowing their
+length from `len`::
+
+    body = MultipartBody(form, [('attachment', attachment)])
+    session.post(url, data=body,
+                 headers={'Content-Type': body.content_type})
+
+"""
+import hashlib
+import io
+import mimetypes
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+
+SPOOL_SIZE = 1024 * 1024
+"""Uploads bigger than that (bytes) are spooled to a temporary file.
+"""
+_CHUNK_SIZE = 64 * 1024
+
+
+class Attachment:
+    """A file attached to an email.
+    """
+    __slots__ = ('filename', 'content_type', 'size', '_data', '_path',
+                 '_owned', '_file', '_lock')
+
+    def __init__(self, filename, data=None, path=None, content_type=None,
+                 file=None):
+        """
+        Args:
+          filename (str): Name of the file, as seen by the recipients
+          data (Optional[bytes]): The content, for small files
+          path (Optional[str]): Where the content is, if no `data`
+          content_type (Optional[str]): Guessed from the filename if None
+          file (Optional[file]): Seekable binary file holding the content,
+            if no `data` nor `path`. Not closed by `close`
+
+        Raises:
+          ValueError: If not exactly one of `data`, `path` and `file` is
+            given
+        """
+        if [data, path, file].count(None) != 2:
+            raise ValueError("Attachment needs either data, a path or a "
+                             "file")
+        self.filename = filename
+        self.content_type = content_type or \
+            mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        self._data = data
+        self._path = path
+        self._file = file
+        self._lock = threading.Lock() if file is not None else None
+        self._owned = False
+        if data is not None:
+            self.size = len(data)
+        elif path is not None:
+            self.size = os.path.getsize(path)
+        else:
+            self.size = file.seek(0, io.SEEK_END)
+
+    @classmethod
+    def from_file(cls, filename, file, content_type=None):
+        """Wraps an open file without copying it, e.g. an upload the web
+        framework already spooled. It must stay open while the attachment
+        is used.
+
+        Args:
+          filename (str):
+          file: Seekable binary file-like object
+          content_type (Optional[str]):
+
+        Returns:
+          Attachment
+        """
+        return cls(filename, content_type=content_type, file=file)
+
+    @classmethod
+    def from_stream(cls, filename, stream, content_type=None,
+                    spool_size=SPOOL_SIZE):
+        """Copies a stream (e.g. an upload) in chunks, to memory if it is
+        small, to a temporary file otherwise.
+
+        Args:
+          filename (str):
+          stream: File-like object to read from
+          content_type (Optional[str]):
+          spool_size (int): Max bytes kept in memory
+
+        Returns:
+          Attachment
+        """
+        head = stream.read(spool_size + 1)
+        if len(head) <= spool_size:
+            return cls(filename, data=head, content_type=content_type)
+
+        with tempfile.NamedTemporaryFile(prefix='email_api-', delete=False) \
+                as spool:
+            spool.write(head)
+            shutil.copyfileobj(stream, spool, _CHUNK_SIZE)
+        attachment = cls(filename, path=spool.name,
+                         content_type=content_type)
+        attachment._owned = True  # pylint: disable=W0212
+        return attachment
+
+    @property
+    def in_memory(self):
+        return self._data is not None
+
+    def open(self):
+        """Returns a new binary reader of the content, to be closed by
+        the caller.
+        """
+        if self._data is not None:
+            return io.BytesIO(self._data)
+        if self._file is not None:
+            return _SharedFileReader(self._file, self._lock)
+        return open(self._path, 'rb')
+
+    def digest(self):
+        """Returns the hex sha256 of the content, read in chunks.
+        """
+        sha = hashlib.sha256()
+        with self.open() as reader:
+            for chunk in iter(lambda: reader.read(_CHUNK_SIZE), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def close(self):
+        """Deletes the temporary file, if this attachment owns one.
+        """
+        if self._owned:
+            self._owned = False
+            try:
+                os.remove(self._path)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __repr__(self):
+        return '<Attachment {} ({} bytes)>'.format(self.filename, self.size)
+
+
+class _SharedFileReader(io.RawIOBase):
+    """Reads a file shared with other readers, each one at its own
+    position.
+    """
+
+    def __init__(self, file, lock):
+        super().__init__()
+        self._file = file
+        self._lock = lock
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        with self._lock:
+            self._file.seek(self._position)
+            data = self._file.read(len(buffer))
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+
+def _quote(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\r', ' ').replace('\n', ' ')
+
+
+class MultipartBody(io.RawIOBase):
+    """A multipart/form-data body, read lazily.
+    """
+
+    def __init__(self, fields, files, boundary=None):
+        """
+        Args:
+          fields (dict): Form fields, list values are repeated and None
+            values dropped like `requests` does
+          files (list[tuple]): (field name, Attachment)
+          boundary (Optional[str]): Random if None
+        """
+        super().__init__()
+        self.boundary = boundary or uuid.uuid4().hex
+        self._segments = []  # bytes, or an Attachment to stream
+        for name, values in fields.items():
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            for value in values:
+                if value is None:
+                    continue
+                self._segments.append(
+                    self._part_header(name) + str(value).encode('utf-8')
+                    + b'\r\n'
+                )
+        for name, attachment in files:
+            self._segments.append(self._part_header(name, attachment))
+            self._segments.append(attachment)
+            self._segments.append(b'\r\n')
+        self._segments.append(
+            '--{}--\r\n'.format(self.boundary).encode('ascii')
+        )
+        self._length = sum(
+            seg.size if isinstance(seg, Attachment) else len(seg)
+            for seg in self._segments
+        )
+        self._index = 0
+        self._offset = 0
+        self._position = 0
+        self._reader = None
+
+    def _part_header(self, name, attachment=None):
+        header = '--{}\r\nContent-Disposition: form-data; name="{}"'.format(
+            self.boundary, _quote(name)
+        )
+        if attachment is not None:
+            header += '; filename="{}"\r\nContent-Type: {}'.format(
+                _quote(attachment.filename), attachment.content_type
+            )
+        return (header + '\r\n\r\n').encode('utf-8')
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary={}'.format(self.boundary)
+
+    def __len__(self):
+        return self._length
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        # `requests` subtracts it from `len` to get the Content-Length
+        return self._position
+
+    def readinto(self, buffer):
+        size = len(buffer)
+        written = 0
+        while written < size and self._index < len(self._segments):
+            segment = self._segments[self._index]
+            if isinstance(segment, Attachment):
+                if self._reader is None:
+                    self._reader = segment.open()
+                chunk = self._reader.read(size - written)
+                if not chunk:
+                    self._reader.close()
+                    self._reader = None
+                    self._index += 1
+                    continue
+            else:
+                chunk = segment[self._offset:self._offset + size - written]
+                self._offset += len(chunk)
+                if self._offset >= len(segment):
+                    self._index += 1
+                    self._offset = 0
+            buffer[written:written + len(chunk)] = chunk
+            written += len(chunk)
+        self._position += written
+        return written
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        super().close()
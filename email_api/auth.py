@@ -0,0 +1,243 @@
+"""API key authentication and per key rate limits.
+
+Keys come from the config, or from a YAML file with the same entries.
+Only their sha256 is kept in memory: a request is authenticated by
+hashing the key it presents (in the `X-API-Key` header, or as an
+`Authorization: Bearer` token) and looking the hash up in a dict. Store
+hashes rather than keys in the config with `sha256`::
+
+    auth:
+      header: X-API-Key
+      limit: 60        # Requests per window and key, None for no limit
+      window: 60       # Seconds
+      keys_file: api_keys.yaml
+      keys:
+        - name: billing
+          key: s3cr3t
+        - name: newsletter
+          sha256: 4e07408562bedb8b60ce05c1decfe3ad16b72230967de01f640b7e4729b49fce
+          limit: 1000  # Overrides the default limit
+
+Each email of a POST /emails/batch counts as a request. Limits use a
+sliding window counter: the count of the current window plus the count
+of the previous one weighted by how much of it the sliding window still
+covers. It is O(1) in time and memory per key.
+
+Note:
+    The counters live in memory, each gunicorn worker limits its own
+    requests: divide the limits by the number of workers.
+
+"""
+import hashlib
+import math
+import threading
+import time
+
+import yaml
+
+
+AUTH_KEY = 'auth'
+DEFAULTS = {
+    'header': 'X-API-Key',
+    'limit': None,
+    'window': 60,
+    'keys': [],
+    'keys_file': None,
+}
+
+
+class InvalidApiKeyConfigError(Exception):
+    """Raise if an API key entry of the config is invalid.
+    """
+    pass
+
+
+def hash_key(key):
+    """Returns the hex sha256 of an API key.
+    """
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class SlidingWindow:
+    """Rate limit of one client, a sliding window counter.
+    """
+    __slots__ = ('limit', 'window', '_clock', '_lock', '_start',
+                 '_current', '_previous')
+
+    def __init__(self, limit, window=60, clock=time.monotonic):
+        """
+        Args:
+          limit (int): Max requests per window
+          window (float): Seconds
+          clock (callable): Returns the current time in seconds
+        """
+        self.limit = limit
+        self.window = window
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._start = clock()
+        self._current = 0
+        self._previous = 0
+
+    def _roll(self, now):
+        elapsed = now - self._start
+        if elapsed >= self.window:
+            windows = int(elapsed // self.window)
+            self._previous = self._current if windows == 1 else 0
+            self._current = 0
+            self._start += windows * self.window
+
+    def hit(self):
+        """Counts a request, if it is allowed.
+
+        Returns:
+          float: 0 if the request is allowed, the seconds until it would
+            be otherwise
+        """
+        with self._lock:
+            now = self._clock()
+            self._roll(now)
+            weight = 1 - (now - self._start) / self.window
+            if self._previous * weight + self._current < self.limit:
+                self._current += 1
+                return 0
+            return self._wait(now)
+
+    def _wait(self, now):
+        # Solves previous * (1 - elapsed / window) + current < limit
+        elapsed = now - self._start
+        if self._current < self.limit:
+            until = self.window * (
+                1 - (self.limit - self._current) / self._previous
+            )
+            # Exactly at the limit: allowed right after
+            return max(until - elapsed, 1e-3)
+        # Only in the next window, where the current count is the
+        # previous one
+        return self.window - elapsed + \
+            self.window * (1 - self.limit / self._current)
+
+
+class ApiClient:
+    """A client authenticated by its API key.
+    """
+    __slots__ = ('name', 'rate_limit')
+
+    def __init__(self, name, rate_limit=None):
+        """
+        Args:
+          name (str): Shows up in the logs
+          rate_limit (Optional[SlidingWindow]): None for no limit
+        """
+        self.name = name
+        self.rate_limit = rate_limit
+
+    def hit(self):
+        """See `SlidingWindow.hit`.
+        """
+        if self.rate_limit is None:
+            return 0
+        return self.rate_limit.hit()
+
+    def __repr__(self):
+        return '<ApiClient {}>'.format(self.name)
+
+
+class ApiKeys:
+    """The clients by hash of their API key.
+    """
+
+    def __init__(self, clients, header='X-API-Key'):
+        """
+        Args:
+          clients (dict): `ApiClient` by hex sha256 of its key
+          header (str): The request header holding the key
+        """
+        self.clients = clients
+        self.header = header
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Args:
+          config (Optional[dict]): The `auth` section of the config
+
+        Raises:
+          InvalidApiKeyConfigError
+
+        Returns:
+          ApiKeys: None if there is no `auth` section, auth is disabled
+        """
+        if config is None:
+            return None
+        conf = dict(DEFAULTS, **config)
+        entries = list(conf['keys'] or [])
+        if conf['keys_file']:
+            try:
+                with open(conf['keys_file']) as keys_file:
+                    entries.extend(yaml.safe_load(keys_file) or [])
+            except (OSError, yaml.YAMLError) as e:
+                raise InvalidApiKeyConfigError(
+                    "Can't load {}: {}".format(conf['keys_file'], e)
+                )
+
+        clients = {}
+        for entry in entries:
+            digest, client = cls._client(entry, conf)
+            if digest in clients:
+                raise InvalidApiKeyConfigError(
+                    "Duplicated API key: {}".format(client.name)
+                )
+            clients[digest] = client
+        return cls(clients, conf['header'])
+
+    @staticmethod
+    def _client(entry, conf):
+        if not isinstance(entry, dict) or not entry.get('name'):
+            raise InvalidApiKeyConfigError(
+                "API keys need a name: {!r}".format(entry)
+            )
+        if entry.get('key'):
+            digest = hash_key(str(entry['key']))
+        elif entry.get('sha256'):
+            digest = str(entry['sha256']).lower()
+        else:
+            raise InvalidApiKeyConfigError(
+                "API key {} needs a key or a sha256".format(entry['name'])
+            )
+        limit = entry.get('limit', conf['limit'])
+        window = entry.get('window', conf['window'])
+        return digest, ApiClient(
+            entry['name'], SlidingWindow(limit, window) if limit else None
+        )
+
+    def key_from(self, headers):
+        """Returns the API key of a request, None if there is none.
+
+        Args:
+          headers: The request headers, a case insensitive mapping
+        """
+        key = headers.get(self.header)
+        if key:
+            return key
+        authorization = headers.get('Authorization') or ''
+        if authorization[:7].lower() == 'bearer ':
+            return authorization[7:].strip() or None
+        return None
+
+    def authenticate(self, key):
+        """Returns the client of an API key, None if it is unknown.
+        """
+        if not key:
+            return None
+        return self.clients.get(hash_key(key))
+
+    def __len__(self):
+        return len(self.clients)
+
+
+def retry_after_header(wait):
+    """Formats seconds to wait as a `Retry-After` value: whole seconds,
+    at least 1.
+    """
+    return str(max(int(math.ceil(wait)), 1))
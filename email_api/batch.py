@@ -0,0 +1,187 @@
+"""Helpers for the batch endpoint: parse a stream of emails and send them
+concurrently, yielding results as they come.
+
+Nothing here knows about the web framework, the body is read from any
+binary file-like object.
+
+"""
+import codecs
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+_LOG = logging.getLogger()
+_WHITESPACE = ' \t\n\r'
+
+
+class InvalidBatchError(ValueError):
+    """Raise if the batch body is not a JSON array nor NDJSON.
+    """
+    pass
+
+
+class LimitedReader:
+    """Wraps a WSGI input stream so we never read past Content-Length
+    (reading more would block with some servers).
+    """
+
+    def __init__(self, stream, length):
+        self._stream = stream
+        self._left = length
+
+    def read(self, size=-1):
+        if self._left <= 0:
+            return b''
+        if size < 0 or size > self._left:
+            size = self._left
+        data = self._stream.read(size)
+        self._left -= len(data)
+        return data
+
+
+def iter_json_items(stream, chunk_size=64 * 1024, max_item_size=1024 * 1024):
+    """Lazily parses a JSON array or NDJSON, one item at a time.
+
+    Only one chunk and the item being parsed are held in memory, whatever
+    the size of the body.
+
+    Args:
+      stream: Binary file-like object, utf-8 encoded
+      chunk_size (int): Bytes read at a time
+      max_item_size (int): Max size of a single item, in characters
+
+    Raises:
+      InvalidBatchError
+
+    Yields:
+      The decoded items
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    eof = False
+    state = None  # 'array', 'ndjson' or 'done', unknown until first char
+    expect_comma = False
+
+    def fill():
+        nonlocal buf, pos, eof
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        try:
+            buf = buf[pos:] + utf8.decode(chunk or b'', final=eof)
+        except UnicodeDecodeError as e:
+            raise InvalidBatchError("Invalid UTF-8: {}".format(e)) from e
+        pos = 0
+
+    while True:
+        # Skip blanks
+        while True:
+            while pos < len(buf) and buf[pos] in _WHITESPACE:
+                pos += 1
+            if pos < len(buf) or eof:
+                break
+            fill()
+
+        if pos == len(buf):  # eof
+            if state == 'array':
+                raise InvalidBatchError("Unterminated JSON array")
+            return
+
+        char = buf[pos]
+        if state is None:
+            state = 'array' if char == '[' else 'ndjson'
+            if state == 'array':
+                pos += 1
+                continue
+        elif state == 'done':
+            raise InvalidBatchError("Unexpected data after the JSON array")
+        elif state == 'array':
+            if char == ']':
+                pos += 1
+                state = 'done'
+                continue
+            if expect_comma:
+                if char != ',':
+                    raise InvalidBatchError("Expected ',' between items")
+                pos += 1
+                expect_comma = False
+                continue
+
+        # Decode one item, reading more until it is complete
+        while True:
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError as e:
+                if eof:
+                    raise InvalidBatchError(str(e)) from e
+                if len(buf) - pos > max_item_size:
+                    raise InvalidBatchError("Item too large") from e
+                fill()
+                continue
+            if end == len(buf) and not eof:
+                # A number could go on in the next chunk
+                fill()
+                continue
+            break
+
+        pos = end
+        expect_comma = state == 'array'
+        yield item
+
+
+def send_batch(items, process, max_in_flight=8, max_items=None,
+               admit=None):
+    """Processes items concurrently, yields results as they complete.
+
+    Items are pulled from the iterator lazily, no more than
+    `max_in_flight` are being processed at a time.
+
+    Args:
+      items (Iterable): E.g from `iter_json_items`
+      process (callable): Takes an item, returns a (dict) result. Must
+        not raise, errors should be part of the result
+      max_in_flight (int): Concurrency
+      max_items (Optional[int]): Stop with an error line past that
+      admit (Optional[callable]): Called with the index of each item
+        before processing it, returns an error to stop with (e.g. a rate
+        limit), None to go on
+
+    Yields:
+      dict: The result of `process` with the item `index` added
+    """
+    def run(index, item):
+        try:
+            res = process(item)
+        except Exception as e:  # pylint: disable=W0703
+            _LOG.exception("Unexpected error in batch item %s", index)
+            res = {'error': 'Internal error: {}'.format(type(e).__name__)}
+        res['index'] = index
+        return res
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        pending = set()
+        try:
+            for index, item in enumerate(items):
+                if max_items is not None and index >= max_items:
+                    yield {'error': 'Too many items, max is {}'.format(
+                        max_items)}
+                    break
+                error = admit(index) if admit is not None else None
+                if error:
+                    yield {'error': error}
+                    break
+                pending.add(pool.submit(run, index, item))
+                if len(pending) >= max_in_flight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        yield fut.result()
+        except InvalidBatchError as e:
+            # Already started streaming, we can only report it in band
+            yield {'error': 'Invalid batch: {}'.format(e)}
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                yield fut.result()
@@ -0,0 +1,97 @@
+"""Small in-process caches shared by the hot paths of the app.
+
+Nothing fancy, `functools.lru_cache` would do if we did not need an
+expiry, counters, and to cache negative results (exceptions).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Bounded, thread-safe LRU cache with an optional TTL.
+
+    Keeps hit/miss counters so callers can expose the hit rate.
+    """
+
+    _missing = object()
+
+    def __init__(self, maxsize=1024, ttl=None, clock=time.monotonic):
+        """
+        Args:
+          maxsize (int): Max number of entries, the least recently used
+            entry is evicted past that
+          ttl (Optional[float]): Seconds after which an entry expires,
+            never if None
+          clock (callable): Returns the current time in seconds
+        """
+        if maxsize < 1:
+            raise ValueError("maxsize must be >= 1")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the cached value or `default`, counting hits/misses.
+        """
+        with self._lock:
+            value, expires = self._data.get(key, (self._missing, None))
+            if value is self._missing or \
+               (expires is not None and expires <= self._clock()):
+                if value is not self._missing:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            expires = None if self.ttl is None else self._clock() + self.ttl
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_set(self, key, func):
+        """Returns the cached value, or computes it with `func(key)` and
+        caches it.
+
+        Note:
+            `func` is called outside of the lock, two threads missing on
+            the same key may both compute it. It's only wasted work.
+        """
+        value = self.get(key, self._missing)
+        if value is self._missing:
+            value = func(key)
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        """Returns the counters as a (dict), handy for monitoring.
+        """
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate,
+        }
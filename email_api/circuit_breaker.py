@@ -0,0 +1,198 @@
+"""Circuit breakers, one per provider.
+
+When a provider is degraded, trying it first for every email adds its
+whole failure latency (often a timeout) to each send. A breaker counts
+the consecutive failures of a provider (no answer, 5XX or 429: an email
+rejected with another 4XX is not the provider's fault) and once it
+reaches a threshold the circuit opens: the `ProvidersManager` moves the
+provider to the end of the failover chain (or skips it). After
+`reset_timeout` the circuit is half-open and the next email probes the
+provider: a success closes it, a failure opens it again for another
+`reset_timeout`.
+
+Note:
+    The state lives in memory, each gunicorn worker has its own
+    breakers.
+
+"""
+import threading
+import time
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+BREAKER_KEY = 'circuit_breaker'
+DEFAULTS = {
+    'failure_threshold': 5,  # Consecutive failures before opening
+    'reset_timeout': 30,     # Seconds before probing an open provider
+    'open_providers': 'demote',  # Or 'skip'
+}
+
+
+class CircuitBreaker:
+    """Closed -> open -> half-open state machine of one provider.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30,
+                 clock=time.monotonic):
+        """
+        Args:
+          failure_threshold (int): Consecutive failures before opening
+          reset_timeout (float): Seconds before letting a probe through
+          clock (callable): Returns the current time in seconds
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probe_started = None
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return CLOSED
+        if self._clock() - self._opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    @property
+    def available(self):
+        """True if `allow` would let a request through. Only reads the
+        state, the half-open probe slot is not taken.
+        """
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == OPEN:
+            return False
+        return self._probe_started is None or \
+            self._clock() - self._probe_started >= self.reset_timeout
+
+    def allow(self):
+        """Returns True if the provider should be tried now. Call it only
+        right before trying it.
+
+        In half-open state, only one probe is let through at a time (or
+        again after `reset_timeout` if the probe never reported back).
+        """
+        with self._lock:
+            if not self.available:
+                return False
+            if self.state == HALF_OPEN:
+                self._probe_started = self._clock()
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_started = None
+            if self._opened_at is not None or \
+               self._failures >= self.failure_threshold:
+                # (Re)open, a failed probe waits another full timeout
+                self._opened_at = self._clock()
+
+    def snapshot(self):
+        return {
+            'state': self.state,
+            'failures': self._failures,
+            'failure_threshold': self.failure_threshold,
+            'reset_timeout': self.reset_timeout,
+        }
+
+
+class CircuitBreakers:
+    """The breakers of all the providers, by nickname.
+
+    Configured by the `circuit_breaker` section of the config, which can
+    be overridden per provider under `providers.<nickname>`::
+
+        circuit_breaker:
+          failure_threshold: 5
+          reset_timeout: 30
+          open_providers: demote  # Try them last, or 'skip' them
+
+    """
+
+    def __init__(self, config=None, clock=time.monotonic):
+        """
+        Args:
+          config (Optional[dict]): The full application config
+          clock (callable): Returns the current time in seconds
+        """
+        config = config or {}
+        self._defaults = dict(DEFAULTS, **(config.get(BREAKER_KEY) or {}))
+        self._providers_conf = config.get('providers') or {}
+        self._clock = clock
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self.skip_open = self._defaults['open_providers'] == 'skip'
+
+    def get(self, nickname):
+        breaker = self._breakers.get(nickname)
+        if breaker is not None:
+            return breaker
+
+        with self._lock:
+            if nickname not in self._breakers:
+                provider_conf = self._providers_conf.get(nickname) or {}
+                conf = dict(self._defaults,
+                            **(provider_conf.get(BREAKER_KEY) or {}))
+                self._breakers[nickname] = CircuitBreaker(
+                    conf['failure_threshold'], conf['reset_timeout'],
+                    self._clock
+                )
+            return self._breakers[nickname]
+
+    def order(self, providers, nickname=lambda p: p.nickname):
+        """Moves the providers whose circuit is open to the end, or drops
+        them if `open_providers` is 'skip'. Has no side effect, see
+        `allow`.
+
+        Args:
+          providers (list): Providers (classes or instances) by priority
+          nickname (callable): Returns the nickname of a provider
+
+        Returns:
+          list: The providers, reordered
+        """
+        allowed, demoted = [], []
+        for provider in providers:
+            if self.get(nickname(provider)).available:
+                allowed.append(provider)
+            elif not self.skip_open:
+                demoted.append(provider)
+        return allowed + demoted
+
+    def skips(self, nickname):
+        """Returns True if the provider must be skipped: its circuit is
+        open and `open_providers` is 'skip'. Has no side effect, see
+        `allow`.
+        """
+        return self.skip_open and not self.get(nickname).available
+
+    def allow(self, nickname):
+        """Called right before a request to a provider, takes the probe
+        slot of a half-open circuit: the request must follow, to report
+        back with `record_success` or `record_failure`.
+
+        Returns:
+          bool: False if the provider must be skipped: its circuit is
+            open and `open_providers` is 'skip'. Demoted providers are
+            still tried, last.
+        """
+        return self.get(nickname).allow() or not self.skip_open
+
+    def snapshot(self):
+        """Returns the state of every breaker, by nickname.
+        """
+        return {nick: b.snapshot() for nick, b in list(self._breakers.items())}
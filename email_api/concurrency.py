@@ -0,0 +1,260 @@
+"""Adaptive limits of the requests in flight to each provider (AIMD).
+
+A fixed limit is either too low when a provider has capacity to spare,
+or too high when it is struggling. Each provider gets a limit of
+concurrent requests that grows additively while calls succeed (about
+`increase` per `limit` successes) and is cut multiplicatively (times
+`decrease`) on signs of congestion: 429, 5xx or timeouts, at most once
+per `cooldown` seconds so that a burst of requests failing together
+counts as one signal. A `Retry-After` header also stops sending to the
+provider until the date it gives.
+
+The `ProvidersManager` tries the providers with room for one more
+request first. The full or backing off ones are tried last, and skipped
+if they are still busy when their turn comes::
+
+    adaptive_concurrency:
+      enabled: false
+      initial: 10     # Concurrent requests per provider
+      min: 1
+      max: 100
+      increase: 1     # Added to the limit per limit successes
+      decrease: 0.5   # Limit multiplier on congestion
+      cooldown: 1     # Seconds other congestion signals are ignored
+                      # after a decrease
+
+Like `circuit_breaker`, the section can be overridden per provider under
+`providers.<nickname>.adaptive_concurrency`.
+
+Note:
+    The limits live in memory, each gunicorn worker adapts its own.
+
+"""
+import email.utils
+import threading
+import time
+
+import requests
+
+
+CONCURRENCY_KEY = 'adaptive_concurrency'
+DEFAULTS = {
+    'enabled': False,
+    'initial': 10,
+    'min': 1,
+    'max': 100,
+    'increase': 1,
+    'decrease': 0.5,
+    'cooldown': 1,
+}
+
+# Exceptions meaning the provider is overloaded, or can't be reached
+CONGESTION_ERRORS = (requests.Timeout, requests.ConnectionError)
+
+
+def parse_retry_after(value, now=None):
+    """Returns the seconds to wait from a `Retry-After` header.
+
+    Args:
+      value (Optional[str]): Seconds, or an HTTP date
+      now (Optional[float]): Current UNIX time, for dates
+
+    Returns:
+      float: None if the header is missing or invalid
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date is None:
+        return None
+    now = time.time() if now is None else now
+    return max(date.timestamp() - now, 0)
+
+
+def is_congestion(status_code):
+    return status_code == 429 or 500 <= status_code < 600
+
+
+class AdaptiveLimit:
+    """The in flight requests and AIMD limit of one provider.
+    """
+
+    def __init__(self, initial=10, min_limit=1, max_limit=100, increase=1,
+                 decrease=0.5, cooldown=1, clock=time.monotonic):
+        """
+        Args:
+          initial (float): Starting limit
+          min_limit (float): The limit never goes below
+          max_limit (float): The limit never goes above
+          increase (float): Added to the limit per `limit` successes
+          decrease (float): Multiplies the limit on congestion
+          cooldown (float): Seconds after a decrease during which
+            congestion signals don't decrease the limit again
+          clock (callable): Returns the current time in seconds
+        """
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._clock = clock
+        self._blocked_until = 0
+        self._decreased_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def blocked_for(self):
+        """Seconds left before the provider can be sent to again, after a
+        `Retry-After`.
+        """
+        return max(self._blocked_until - self._clock(), 0)
+
+    @property
+    def available(self):
+        """True if a request can be sent now.
+        """
+        return not self.blocked_for and self.in_flight < int(self.limit)
+
+    def acquire(self):
+        """Takes a slot for a request.
+
+        Returns:
+          bool: False if the provider is full, or backing off
+        """
+        with self._lock:
+            if not self.available:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight = max(self.in_flight - 1, 0)
+
+    def record_success(self):
+        with self._lock:
+            self.limit = min(self.max_limit,
+                             self.limit + self.increase / self.limit)
+
+    def record_congestion(self, retry_after=None):
+        """
+        Args:
+          retry_after (Optional[float]): Seconds the provider asked us to
+            wait
+        """
+        with self._lock:
+            now = self._clock()
+            if retry_after:
+                self._blocked_until = max(self._blocked_until,
+                                          now + retry_after)
+            if self._decreased_at is not None and \
+               now - self._decreased_at < self.cooldown:
+                # Same congestion as the one we already reacted to
+                return
+            self._decreased_at = now
+            self.limit = max(self.min_limit, self.limit * self.decrease)
+
+    def snapshot(self):
+        return {
+            'limit': round(self.limit, 2),
+            'in_flight': self.in_flight,
+            'blocked_for': round(self.blocked_for, 2),
+        }
+
+
+class AdaptiveLimits:
+    """The adaptive limits of all the providers, by nickname.
+    """
+
+    def __init__(self, config=None, clock=time.monotonic):
+        """
+        Args:
+          config (Optional[dict]): The full application config
+          clock (callable): Returns the current time in seconds
+        """
+        config = config or {}
+        self._defaults = dict(DEFAULTS,
+                              **(config.get(CONCURRENCY_KEY) or {}))
+        self._providers_conf = config.get('providers') or {}
+        self._clock = clock
+        self._limits = {}
+        self._lock = threading.Lock()
+        self.enabled = self._defaults['enabled']
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Returns:
+          AdaptiveLimits: None if not enabled
+        """
+        limits = cls(config)
+        return limits if limits.enabled else None
+
+    def get(self, nickname):
+        limit = self._limits.get(nickname)
+        if limit is not None:
+            return limit
+
+        with self._lock:
+            if nickname not in self._limits:
+                provider_conf = self._providers_conf.get(nickname) or {}
+                conf = dict(self._defaults,
+                            **(provider_conf.get(CONCURRENCY_KEY) or {}))
+                self._limits[nickname] = AdaptiveLimit(
+                    conf['initial'], conf['min'], conf['max'],
+                    conf['increase'], conf['decrease'], conf['cooldown'],
+                    self._clock
+                )
+            return self._limits[nickname]
+
+    def order(self, providers, nickname=lambda p: p.nickname):
+        """Moves the providers that are full or backing off to the end,
+        keeping the order of the others.
+
+        Args:
+          providers (list): Providers (classes or instances) by priority
+          nickname (callable): Returns the nickname of a provider
+
+        Returns:
+          list: The providers, reordered
+        """
+        available, busy = [], []
+        for provider in providers:
+            if self.get(nickname(provider)).available:
+                available.append(provider)
+            else:
+                busy.append(provider)
+        return available + busy
+
+    def record_response(self, nickname, response, success):
+        """Adapts the limit of a provider to its answer.
+        """
+        limit = self.get(nickname)
+        status = getattr(response, 'status_code', None)
+        if success:
+            limit.record_success()
+        elif isinstance(status, int) and is_congestion(status):
+            headers = getattr(response, 'headers', None) or {}
+            limit.record_congestion(
+                parse_retry_after(headers.get('Retry-After'))
+            )
+
+    def record_error(self, nickname, error):
+        """Adapts the limit of a provider to an exception it raised.
+        """
+        if isinstance(error, CONGESTION_ERRORS):
+            self.get(nickname).record_congestion()
+
+    def snapshot(self):
+        """Returns the state of every limit, by nickname.
+        """
+        return {nick: l.snapshot() for nick, l in list(self._limits.items())}
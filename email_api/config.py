@@ -35,7 +35,7 @@ def _exit_if_no_providers(config):
 def load_config(path):
     try:
         with open(path, 'r') as conf:
-            return yaml.load(conf.read())
+            return yaml.safe_load(conf.read())
     except yaml.parser.ParserError:
         _LOG.error("Invalid YAML file: %s. Exiting", path)
         exit(1)
@@ -0,0 +1,110 @@
+"""Time budget of a send, across the whole failover chain.
+
+Without timeouts a hanging provider ties up a worker forever, and the
+failover loop has no overall time bound. Each send gets a total budget,
+every attempt gets its connect and read timeouts from the provider
+config, capped by what is left of the budget::
+
+    deadline:
+      budget: 20            # Seconds for the whole failover chain
+      connect_timeout: 3.05
+      read_timeout: 10
+
+    providers:
+      mailgun:
+        timeout:            # Overrides the defaults for this provider
+          connect: 2
+          read: 5
+
+Note:
+    `requests` read timeouts are per socket read, not for the whole
+    response: a provider trickling bytes can go a bit over budget.
+
+"""
+import time
+
+
+DEADLINE_KEY = 'deadline'
+DEFAULTS = {
+    'budget': 20,
+    'connect_timeout': 3.05,
+    'read_timeout': 10,
+}
+
+
+class DeadlineExceededError(Exception):
+    """Raise when the time budget of a send ran out before an email
+    could be sent.
+    """
+    pass
+
+
+class Deadline:
+    """A point in time we must be done by.
+    """
+
+    def __init__(self, budget, clock=time.monotonic):
+        """
+        Args:
+          budget (float): Seconds from now
+          clock (callable): Returns the current time in seconds
+        """
+        self.budget = budget
+        self._clock = clock
+        self._end = clock() + budget
+
+    def remaining(self):
+        return max(self._end - self._clock(), 0)
+
+    @property
+    def expired(self):
+        return self._clock() >= self._end
+
+    def timeout(self, connect, read):
+        """Returns the (connect, read) timeouts to use for a request,
+        capped by the remaining budget.
+
+        Raises:
+          DeadlineExceededError: If there is no time left
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceededError(
+                "Budget of {}s exhausted".format(self.budget)
+            )
+        return min(connect, remaining), min(read, remaining)
+
+
+class Timeouts:
+    """The budget and per provider timeouts from the config.
+    """
+
+    def __init__(self, config=None):
+        """
+        Args:
+          config (Optional[dict]): The full application config
+        """
+        config = config or {}
+        conf = dict(DEFAULTS, **(config.get(DEADLINE_KEY) or {}))
+        self.budget = conf['budget']
+        self._default = (conf['connect_timeout'], conf['read_timeout'])
+        self._by_provider = {}
+        for nick, provider_conf in (config.get('providers') or {}).items():
+            timeout = (provider_conf or {}).get('timeout') or {}
+            self._by_provider[nick] = (
+                timeout.get('connect', self._default[0]),
+                timeout.get('read', self._default[1])
+            )
+
+    def for_provider(self, nickname):
+        """Returns the (connect, read) timeouts of a provider.
+        """
+        return self._by_provider.get(nickname, self._default)
+
+    def deadline(self):
+        """Starts the clock of a new send.
+
+        Returns:
+          Deadline
+        """
+        return Deadline(self.budget)
@@ -1,23 +1,43 @@
 """Concrete provider implementation for sendgrid
 
 https://sendgrid.com/docs
+
+Notifications are not signed, add a secret `token` query parameter to the
+notification URL and to the config (`webhook_token`) to check them.
 """
+import hmac
+from datetime import datetime, timezone
+
 from email_api.abstract_provider import (
     AProvider,
     HttpMethod,
-    DataFormat
+    DataFormat,
+    InvalidCallbackError
 )
+from email_api import webhooks
+
+
+# Notification statuses
+EVENTS = {
+    'Sent': webhooks.DELIVERED,
+    'Opened': webhooks.OPENED,
+    'Clicked': webhooks.CLICKED,
+    'Unsubscribed': webhooks.UNSUBSCRIBED,
+    'AbuseReport': webhooks.COMPLAINED,
+    'Error': webhooks.BOUNCED,
+}
+DATE_FORMAT = '%m/%d/%Y %I:%M:%S %p'
 
 
 class ElasticEmailProvider(AProvider):
     nickname = 'elasticemail'
+    # Recipients are joined in a single parameter, keep it reasonable
+    max_recipients = 500
+    api_url = 'https://api.elasticemail.com'
 
     @property
     def send_url(self):
-        return (  # Should come from conf
-            HttpMethod.post,
-            'https://api.elasticemail.com/v2/email/send'
-        )
+        return HttpMethod.post, '{}/v2/email/send'.format(self.base_url)
 
     @property
     def auth(self):
@@ -40,9 +60,9 @@ class ElasticEmailProvider(AProvider):
         """
         e = email.to_dict()
         mail = {}
-        mail['msgTo'] = ';'.join([r.email for r in email.get_recipients('to')])
-        mail['msgCC'] = ';'.join([r.email for r in email.get_recipients('cc')])
-        mail['msgBcc'] = ';'.join([r.email for r in email.get_recipients('bcc')])
+        mail['msgTo'] = ';'.join(email.recipient_addresses('to'))
+        mail['msgCC'] = ';'.join(email.recipient_addresses('cc'))
+        mail['msgBcc'] = ';'.join(email.recipient_addresses('bcc'))
         mail['from'] = email.from_.email
         mail['fromName'] = email.from_.display_name
         mail['apiKey'] = self._key
@@ -60,3 +80,37 @@ class ElasticEmailProvider(AProvider):
             return False
 
         return False
+
+    def message_id(self, response):
+        try:
+            return response.json()['data']['messageid']
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return None
+
+    def parse_callback(self, data):
+        """Parses an HTTP web notification (one event), its parameters
+        are in the query string.
+        """
+        token = (getattr(self, '_config', None) or {}).get('webhook_token')
+        if token and not hmac.compare_digest(
+                str(data.get('token') or '').encode('utf-8'),
+                str(token).encode('utf-8')):
+            raise InvalidCallbackError("Invalid elasticemail token")
+        type_ = EVENTS.get(data.get('status'))
+        if type_ is None:
+            return []
+        if not data.get('messageid'):
+            raise InvalidCallbackError("elasticemail event without messageid")
+        try:
+            timestamp = datetime.strptime(
+                data['date'], DATE_FORMAT
+            ).replace(tzinfo=timezone.utc).timestamp()
+        except (KeyError, TypeError, ValueError):
+            raise InvalidCallbackError(
+                "Invalid elasticemail date: {}".format(data.get('date'))
+            )
+        return [webhooks.DeliveryEvent(
+            self.nickname, data['messageid'], data.get('to'), type_,
+            timestamp, data.get('category') if type_ == webhooks.BOUNCED
+            else None
+        )]
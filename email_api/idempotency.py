@@ -0,0 +1,385 @@
+"""Idempotency keys, so that client retries don't send an email twice.
+
+A client timing out on POST /email can't tell if the email went out.
+When it retries with the same `Idempotency-Key` header, it gets the
+result of the first request instead of a second email. A retry arriving
+while the first request is still sending waits for its result.
+
+Results are kept `ttl` seconds in a bounded in-memory LRU cache, and in
+a SQLite file shared by the workers if `path` is set::
+
+    idempotency:
+      enabled: true
+      header: Idempotency-Key
+      ttl: 86400          # Seconds a result is replayed
+      maxsize: 10000      # Results kept in memory, per worker
+      path: idempotency.db
+      wait_timeout: 30    # Seconds a retry waits for the first request
+      lease: 60           # Seconds after which a first request that did
+                          # not finish (dead worker) is taken over,
+                          # renewed while it is sending
+
+A key is bound to the request it came with (its parameters and the
+content of its attachments): reusing it for a different request is an
+error. Failures that did not send anything (5xx, nothing
+sent) are not kept, the client may retry them.
+
+Note:
+    Without a `path`, retries only find the results of the worker that
+    answered the first request.
+
+"""
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from email_api.cache import LRUCache
+
+
+_LOG = logging.getLogger()
+IDEMPOTENCY_KEY = 'idempotency'
+DEFAULTS = {
+    'enabled': True,
+    'header': 'Idempotency-Key',
+    'ttl': 86400,
+    'maxsize': 10000,
+    'path': None,
+    'wait_timeout': 30,
+    'lease': 60,
+}
+
+MAX_KEY_LENGTH = 255
+
+Record = namedtuple('Record', ['fingerprint', 'result'])
+"""The request `fingerprint` a key came with, and its `result` (None
+while in flight).
+"""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    result TEXT,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idempotency_keys_expires
+    ON idempotency_keys (expires);
+"""
+
+
+class KeyReusedError(Exception):
+    """Raise if an idempotency key comes back with a different request.
+    """
+    pass
+
+
+class InFlightError(Exception):
+    """Raise if the first request with an idempotency key did not finish
+    in time.
+    """
+    pass
+
+
+def fingerprint(*parts):
+    """Returns a hash of the JSON serializable parts of a request.
+    """
+    return hashlib.sha256(
+        json.dumps(parts, sort_keys=True, default=str).encode('utf-8')
+    ).hexdigest()
+
+
+class SqliteIdempotencyStore:
+    """Idempotency keys in a SQLite file, shared by all the processes
+    using it.
+
+    Thread-safe: every thread gets its own connection.
+    """
+
+    def __init__(self, path, clock=time.time):
+        """
+        Args:
+          path (str): The SQLite file, created if need be
+          clock (callable): Wall clock, the same for all the processes
+        """
+        self.path = path
+        self._clock = clock
+        self._local = threading.local()
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self):
+        # Connections can't be shared across threads, nor processes
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None
+            )
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def claim(self, key, fingerprint_, lease):
+        """Marks a key in flight, unless it is already.
+
+        Args:
+          key (str):
+          fingerprint_ (str): Of the request
+          lease (float): Seconds after which the claim can be taken over
+
+        Returns:
+          Record: None if the key was claimed, the current record
+            otherwise
+        """
+        conn = self._conn()
+        now = self._clock()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT fingerprint, result, expires FROM idempotency_keys '
+                'WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None or row[2] <= now:
+                conn.execute(
+                    'INSERT OR REPLACE INTO idempotency_keys '
+                    '(key, fingerprint, result, expires) '
+                    'VALUES (?, ?, NULL, ?)',
+                    (key, fingerprint_, now + lease)
+                )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        if row is None or row[2] <= now:
+            return None
+        return Record(row[0], json.loads(row[1]) if row[1] else None)
+
+    def complete(self, key, result, ttl):
+        """Saves the result of a claimed key, and purges the expired ones.
+        """
+        now = self._clock()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                'UPDATE idempotency_keys SET result = ?, expires = ? '
+                'WHERE key = ?', (json.dumps(result), now + ttl, key)
+            )
+            conn.execute(
+                'DELETE FROM idempotency_keys WHERE expires <= ?', (now,)
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def renew(self, key, fingerprint_, lease):
+        """Extends the claim of a key still in flight.
+
+        Returns:
+          bool: False if it was taken over, or completed
+        """
+        return bool(self._conn().execute(
+            'UPDATE idempotency_keys SET expires = ? '
+            'WHERE key = ? AND fingerprint = ? AND result IS NULL',
+            (self._clock() + lease, key, fingerprint_)
+        ).rowcount)
+
+    def close(self):
+        """Closes the connection of the calling thread.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def release(self, key):
+        """Forgets a claimed key without result, so it can be retried.
+        """
+        self._conn().execute(
+            'DELETE FROM idempotency_keys WHERE key = ? AND result IS NULL',
+            (key,)
+        )
+
+
+class _InFlight:
+    __slots__ = ('fingerprint', 'done')
+
+    def __init__(self, fingerprint_):
+        self.fingerprint = fingerprint_
+        self.done = threading.Event()
+
+
+class Idempotency:
+    """Runs requests at most once per idempotency key, and replays their
+    results.
+    """
+
+    def __init__(self, ttl=86400, maxsize=10000, store=None,
+                 wait_timeout=30, lease=60, header='Idempotency-Key',
+                 poll_interval=0.05):
+        """
+        Args:
+          ttl (float): Seconds a result is replayed
+          maxsize (int): Max results kept in memory
+          store (Optional[SqliteIdempotencyStore]): To share the keys
+            with other processes
+          wait_timeout (float): Max seconds to wait for a request in
+            flight with the same key
+          lease (float): Seconds after which a request in flight in
+            another process is considered dead
+          header (str): The request header holding the key
+          poll_interval (float): Seconds between checks of a request in
+            flight in another process
+        """
+        self.ttl = ttl
+        self.store = store
+        self.wait_timeout = wait_timeout
+        self.lease = lease
+        self.header = header
+        self.poll_interval = poll_interval
+        self._results = LRUCache(maxsize, ttl)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Args:
+          config (Optional[dict]): The `idempotency` section of the config
+
+        Returns:
+          Idempotency: None if not enabled
+        """
+        conf = dict(DEFAULTS, **(config or {}))
+        if not conf['enabled']:
+            return None
+        store = SqliteIdempotencyStore(conf['path']) \
+            if conf['path'] else None
+        return cls(conf['ttl'], conf['maxsize'], store,
+                   conf['wait_timeout'], conf['lease'], conf['header'])
+
+    def run(self, key, fingerprint_, func, keep=lambda result: True):
+        """Returns the result of the first request with a key, or calls
+        `func` if it is the first.
+
+        Args:
+          key (str): The idempotency key
+          fingerprint_ (str): Of the request, see `fingerprint`
+          func (callable): Handles the request, returns a JSON
+            serializable result
+          keep (callable): Returns False for the results not to replay
+
+        Raises:
+          KeyReusedError: If the key came with another request
+          InFlightError: If a request with the key is still in flight
+            after `wait_timeout`
+
+        Returns:
+          tuple: The result, and True if it is replayed
+        """
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            with self._lock:
+                record = self._results.get(key)
+                in_flight = self._in_flight.get(key) \
+                    if record is None else None
+                if record is None and in_flight is None:
+                    in_flight = self._in_flight[key] = _InFlight(
+                        fingerprint_
+                    )
+                    break
+
+            if record is not None:
+                self._check(key, record.fingerprint, fingerprint_)
+                return record.result, True
+            # Another thread of this process has the key
+            self._check(key, in_flight.fingerprint, fingerprint_)
+            if not in_flight.done.wait(max(deadline - time.monotonic(), 0)):
+                raise InFlightError(
+                    "A request with key {} is in progress".format(key)
+                )
+
+        try:
+            return self._run(key, fingerprint_, func, keep, deadline)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            in_flight.done.set()
+
+    def _run(self, key, fingerprint_, func, keep, deadline):
+        if self.store is not None:
+            record = self._claim(key, fingerprint_, deadline)
+            if record is not None:
+                self._results.set(key, record)
+                return record.result, True
+
+        try:
+            with self._renewing(key, fingerprint_):
+                result = func()
+        except BaseException:
+            if self.store is not None:
+                self.store.release(key)
+            raise
+
+        if keep(result):
+            self._results.set(key, Record(fingerprint_, result))
+            if self.store is not None:
+                self.store.complete(key, result, self.ttl)
+        elif self.store is not None:
+            self.store.release(key)
+        return result, False
+
+    @contextlib.contextmanager
+    def _renewing(self, key, fingerprint_):
+        """Renews the claim of a key in the store while its request runs,
+        so a slow send (failover, chunks) is not taken over by a retry.
+        """
+        if self.store is None:
+            yield
+            return
+        done = threading.Event()
+
+        def renew():
+            while not done.wait(self.lease / 3):
+                try:
+                    self.store.renew(key, fingerprint_, self.lease)
+                except sqlite3.Error:
+                    _LOG.exception("Could not renew idempotency key %s", key)
+            self.store.close()
+
+        thread = threading.Thread(target=renew, daemon=True,
+                                  name='idempotency-lease')
+        thread.start()
+        try:
+            yield
+        finally:
+            done.set()
+            thread.join()
+
+    def _claim(self, key, fingerprint_, deadline):
+        # Polls while another process has the key in flight
+        while True:
+            record = self.store.claim(key, fingerprint_, self.lease)
+            if record is None:
+                return None
+            self._check(key, record.fingerprint, fingerprint_)
+            if record.result is not None:
+                return record
+            if time.monotonic() >= deadline:
+                raise InFlightError(
+                    "A request with key {} is in progress".format(key)
+                )
+            time.sleep(self.poll_interval)
+
+    @staticmethod
+    def _check(key, expected, fingerprint_):
+        if expected != fingerprint_:
+            raise KeyReusedError(
+                "Key {} was used for a different request".format(key)
+            )
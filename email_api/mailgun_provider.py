@@ -1,24 +1,56 @@
 """Concrete Provider implementation for mailgun.
 
 https://documentation.mailgun.com/user_manual.html
+
+Webhooks are signed with the HTTP webhook signing key of the account,
+calls are only checked if it is in the config (`webhook_signing_key`).
+Signed calls older than `webhook_max_age` seconds (or from the future,
+by as much) are rejected, so a captured call can't be replayed later.
 """
+import hashlib
+import hmac
+import json
+import time
+
 from email_api.abstract_provider import (
     AProvider,
     DataFormat,
-    HttpMethod
+    HttpMethod,
+    InvalidCallbackError
 )
+from email_api.templates import compile_template
+from email_api import webhooks
+
+
+# Mailgun event types, `failed` depends on the severity
+EVENTS = {
+    'accepted': webhooks.ACCEPTED,
+    'delivered': webhooks.DELIVERED,
+    'rejected': webhooks.DROPPED,
+    'complained': webhooks.COMPLAINED,
+    'unsubscribed': webhooks.UNSUBSCRIBED,
+    'opened': webhooks.OPENED,
+    'clicked': webhooks.CLICKED,
+}
+WEBHOOK_MAX_AGE = 300
 
 
 class MailgunProvider(AProvider):
     nickname = "mailgun"
+    # Batch sending: one message to many recipients, each one gets its
+    # own copy thanks to `recipient-variables`
+    max_batch_size = 1000
+    max_recipients = 1000
+    # Mail merge with %recipient.name% placeholders and recipient-variables
+    supports_templates = True
+    attachment_field = 'attachment'
+    api_url = 'https://api.mailgun.net'
 
     @property
     def send_url(self):
-        return (  # This should be seeded from the conf.
+        return (
             HttpMethod.post,
-            'https://api.mailgun.net/v3/{}/messages'.format(
-                self._config['domain']
-            )
+            '{}/v3/{}/messages'.format(self.base_url, self._config['domain'])
         )
 
     @property
@@ -42,19 +74,120 @@ class MailgunProvider(AProvider):
         """
         e = email.to_dict()
         mail = dict(
-            **{k: e[k] for k in ['replyto', 'text', 'html', 'files', 'subject']}
+            **{k: e[k] for k in ['replyto', 'text', 'html', 'subject']}
         )
         # Orgnize recipients by type (to,cc,bcc)
         # Store a list of standard email strings such as:
         # {'to':['my name <my@name.com>', 'my@address.com'], 'cc': [...], ...}
-        for recp in email.get_recipients():
-            mail.setdefault(recp.type_, []).append(str(recp))
+        for type_ in ('to', 'cc', 'bcc'):
+            strings = email.recipient_strings(type_)
+            if strings:
+                mail[type_] = list(strings)
 
         # Remap replyto
         mail['h:Reply-To'] = mail.get('replyto')
         mail['from'] = str(email.from_)
 
+        if email.templated:
+            for field in ('subject', 'text', 'html'):
+                if getattr(email, field) is not None:
+                    mail[field] = compile_template(mail[field]).to(
+                        '%recipient.{}%'.format
+                    )
+            mail['recipient-variables'] = json.dumps({
+                address: email.variables.get(address) or {}
+                for address in email.recipient_addresses('to')
+            })
+
         return DataFormat.form, mail
 
+    def batch_key(self, email):
+        """Emails with a single 'to' recipient and the same content can be
+        batched. Others would need their recipients to see each other.
+        """
+        if len(email.get_recipients('to')) != 1 \
+           or email.get_recipients('cc') or email.get_recipients('bcc') \
+           or email.files or email.templated:
+            return None
+        return (
+            str(email.from_) if email.from_ else None,
+            email.subject, email.text, email.html, email.replyto
+        )
+
+    def emails_to_batch_data(self, emails):
+        """Converts emails sharing a `batch_key` to a single mailgun batch
+        sending call.
+
+        Returns:
+          tuple::
+
+            (Dataformat.form, dict)
+
+        """
+        format_, first = self.email_to_data(emails[0])
+        mail = dict(first)
+        mail['to'] = [e.recipient_strings('to')[0] for e in emails]
+        mail['recipient-variables'] = json.dumps({
+            e.recipient_addresses('to')[0]: {} for e in emails
+        })
+        return format_, mail
+
     def is_success(self, response):
         return response.status_code == 200
+
+    def message_id(self, response):
+        try:
+            return response.json()['id'].strip('<>')
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return None
+
+    def parse_callback(self, data):
+        """Parses a webhook call (one event).
+
+        https://documentation.mailgun.com/en/latest/user_manual.html#webhooks
+        """
+        try:
+            event = data['event-data']
+            self._check_signature(data['signature'])
+            type_ = event['event']
+            if type_ == 'failed':
+                type_ = webhooks.BOUNCED \
+                    if event.get('severity') == 'permanent' \
+                    else webhooks.DEFERRED
+            elif type_ in EVENTS:
+                type_ = EVENTS[type_]
+            else:
+                return []
+            status = event.get('delivery-status') or {}
+            return [webhooks.DeliveryEvent(
+                self.nickname,
+                event['message']['headers']['message-id'],
+                event.get('recipient'),
+                type_,
+                float(event['timestamp']),
+                status.get('description') or status.get('message') or
+                event.get('reason') or None
+            )]
+        except (KeyError, TypeError, ValueError) as e:
+            raise InvalidCallbackError(
+                "Invalid mailgun event: {!r}".format(e)
+            )
+
+    def _check_signature(self, signature):
+        conf = getattr(self, '_config', None) or {}
+        key = conf.get('webhook_signing_key')
+        if not key:
+            return
+        max_age = conf.get('webhook_max_age', WEBHOOK_MAX_AGE)
+        if abs(time.time() - float(signature['timestamp'])) > max_age:
+            raise InvalidCallbackError("Stale mailgun signature")
+        expected = hmac.new(
+            key.encode('utf-8'),
+            '{}{}'.format(signature['timestamp'],
+                          signature['token']).encode('utf-8'),
+            hashlib.sha256
+        ).hexdigest()
+        if not hmac.compare_digest(
+                expected.encode('utf-8'),
+                str(signature['signature']).encode('utf-8')):
+            raise InvalidCallbackError("Invalid mailgun signature")
@@ -6,7 +6,6 @@ The web framework and the third party providers should be aware of this
 core data structure, but not the other way around (to avoid coupling)
 
 TODO:
-  - Implement `Attachment`
   - Enable HTML
   - Use constants/enum for: ('from', 'to'...)?
 """
@@ -19,8 +18,34 @@ from collections import namedtuple
 # Easily replacable
 from email_validator import validate_email, EmailNotValidError
 
+from email_api.cache import LRUCache
+from email_api.templates import compile_template
+from email_api.attachments import Attachment
+
 _LOG = logging.getLogger()
 
+VALIDATION_CACHE_KEY = 'validation_cache'
+VALIDATION_CACHE_DEFAULTS = {
+    'maxsize': 100000,
+    'ttl': 3600,  # Seconds, None to never expire
+}
+
+validation_cache = LRUCache(**VALIDATION_CACHE_DEFAULTS)
+"""Results of `Recipient.check_email` by address: None if valid, the error
+message otherwise. Check `validation_cache.stats()` for the hit rate.
+"""
+
+
+def configure_validation_cache(config=None):
+    """Replaces the validation cache with one sized from the config.
+
+    Args:
+        config (Optional[dict]): The `validation_cache` section
+    """
+    global validation_cache  # pylint: disable=W0603
+    conf = dict(VALIDATION_CACHE_DEFAULTS, **(config or {}))
+    validation_cache = LRUCache(conf['maxsize'], conf['ttl'])
+
 
 class InvalidRecipientError(Exception):
     """ Raise if the email address is improper.
@@ -39,6 +64,7 @@ class Recipient(namedtuple('Recipient', ['email', 'display_name', 'type_'])):
 
     Provides a validation method and utils
     """
+    __slots__ = ()  # No per instance __dict__, emails can have thousands
 
     @classmethod
     def from_string(cls, email_string, type_):
@@ -68,15 +94,35 @@ class Recipient(namedtuple('Recipient', ['email', 'display_name', 'type_'])):
         return self.email
 
     @staticmethod
-    def check_email(email):
+    def _validation_error(email):
+        """Returns None if the address is valid, the error otherwise.
+        """
         try:
             validate_email(email, check_deliverability=False)
-        except EmailNotValidError as e:
+        except EmailNotValidError:
+            return 'Invalid email address format: "{}"'.format(email)
+        return None
+
+    @staticmethod
+    def check_email(email):
+        """Checks the address format.
+
+        Results (valid or not) are cached in `validation_cache`, as the
+        same addresses come back over and over.
+
+        Raises:
+            InvalidRecipientError
+        """
+        try:
+            error = validation_cache.get_or_set(
+                email, Recipient._validation_error
+            )
+        except TypeError:  # Unhashable
+            error = Recipient._validation_error(email)
+        if error is not None:
             # We re-raise with custom exception not to create dep on
             # the lib
-            raise InvalidRecipientError(
-                'Invalid email address format: "{}"'.format(email)
-            ) from e
+            raise InvalidRecipientError(error)
 
     def validate(self):
         """ Checks if email's structure is valid.
@@ -105,6 +151,10 @@ class Email:
     to current machine hostname.
     Adds a default in case of empty subject
 
+    Once validated, an email is frozen (see `Email.freeze`): the
+    providers tried during failover all get the same immutable
+    snapshot, which memoizes their payloads.
+
     Note:
         We disable two pylint warnings because it does not
         understand the setters & getters properly
@@ -113,6 +163,12 @@ class Email:
     default_subject = '(no subject)'
     default_from = "noreply@{}".format(socket.gethostname())
 
+    __slots__ = (
+        '_recipients', '_count', '_strings', '_frozen', '_payloads',
+        '__from', '__subject', 'replyto', 'text', 'html', 'files',
+        'variables'
+    )
+
     def __init__(self, **kwargs):
         """ Creates an empty email if no arguments are provided.
 
@@ -121,15 +177,169 @@ class Email:
           replyto (Optional[str]): email address (validity not enforced)
           text (Optional[str]): text/plain email body
           html (Optional[str]):text/html email body
-          files (Optional[Attachment]): not implemented
+          files (Optional[list[Attachment]]): See
+            `email_api.attachments`
+          variables (Optional[dict]): Mail merge, template variables by
+            'to' address. If set subject, text and html are templates
+            (see `email_api.templates`) and each recipient gets its own
+            rendered copy
         """
-        self._recipients = []
+        # Recipients by type, in the order they were added
+        self._recipients = {}
+        self._count = 0
+        # Serialized recipients by (type, 'string' or 'address')
+        self._strings = {}
+        self._payloads = None
         self.from_ = kwargs.get('from_')
         self.subject = kwargs.get('subject')
         self.replyto = kwargs.get('replyto')
         self.text = kwargs.get('text')
         self.html = kwargs.get('html')
         self.files = kwargs.get('files')
+        self.variables = kwargs.get('variables')
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError("Email is frozen, use Email.replace")
+        super().__setattr__(name, value)
+
+    @property
+    def frozen(self):
+        return getattr(self, '_frozen', False)
+
+    @property
+    def payloads(self):
+        """Serialized payloads of a frozen email, by provider. None if the
+        email is not frozen.
+
+        Filled by `email_api.providers_manager.ProvidersManager`, so a
+        provider serializes an email once, whatever the number of
+        retries.
+        """
+        return self._payloads
+
+    def freeze(self):
+        """Returns an immutable snapshot of this email, itself if it is
+        already frozen.
+
+        Returns:
+          Email
+        """
+        if self.frozen:
+            return self
+        return self.replace()
+
+    def replace(self, **changes):
+        """Returns a frozen copy of this email, with some fields changed.
+
+        Args:
+          changes: Same arguments as `Email.__init__`
+
+        Returns:
+          Email
+        """
+        return self._copy(None, **changes)
+
+    def _copy(self, recipients, **changes):
+        """Frozen copy, with other `recipients` if not None.
+        """
+        fields = {
+            'from_': self.from_,
+            'subject': self.__subject,
+            'replyto': self.replyto,
+            'text': self.text,
+            'html': self.html,
+            'files': self.files,
+            'variables': self.variables,
+        }
+        fields.update(changes)
+        email = Email(**fields)
+        if recipients is None:
+            email._recipients = {  # pylint: disable=W0212
+                type_: list(recps)
+                for type_, recps in self._recipients.items()
+            }
+            email._count = self._count  # pylint: disable=W0212
+            email._strings = dict(self._strings)  # pylint: disable=W0212
+        else:
+            email.add_recipients(recipients)
+        email._payloads = {}  # pylint: disable=W0212
+        email._frozen = True  # pylint: disable=W0212
+        return email
+
+    def split(self, max_recipients):
+        """Splits this email in frozen copies of at most `max_recipients`
+        recipients each, recipients keep their type.
+
+        Note:
+            Recipients of different copies don't see each other.
+
+        Returns:
+          list[Email]: This email (frozen) if it is small enough
+        """
+        if self._count <= max_recipients:
+            return [self.freeze()]
+        recipients = self.get_recipients()
+
+        return [
+            self.with_recipients(recipients[start:start + max_recipients])
+            for start in range(0, len(recipients), max_recipients)
+        ]
+
+    def with_recipients(self, recipients):
+        """Returns a frozen copy of this email, with other recipients.
+
+        Args:
+          recipients (list[Recipient]):
+
+        Raises:
+          TypeError: If a recipient is not a `Recipient`
+
+        Returns:
+          Email
+        """
+        return self._copy(recipients)
+
+    @property
+    def templated(self):
+        return self.variables is not None
+
+    def render_all(self):
+        """Renders a mail merge email, one frozen email per 'to'
+        recipient with its variables substituted.
+
+        Templates are compiled once for all the recipients.
+
+        Returns:
+          list[Email]: This email (frozen) if it is not templated
+        """
+        if not self.templated:
+            return [self.freeze()]
+
+        templates = {
+            'subject': compile_template(self.__subject),
+            'text': compile_template(self.text),
+            'html': compile_template(self.html),
+        }
+        emails = []
+        for recp in self.get_recipients('to'):
+            variables = self.variables.get(recp.email) or {}
+            rendered = {
+                field: tpl.render(variables) if tpl else None
+                for field, tpl in templates.items()
+            }
+            emails.append(self._copy([recp], variables=None, **rendered))
+        return emails
+
+    @property
+    def body(self):
+        """Alias of `text`, the text/plain body.
+        """
+        return self.text
+
+    @body.setter
+    def body(self, body):
+        self.text = body
 
     @property
     def from_(self):
@@ -170,12 +380,48 @@ class Email:
           type_ (str): Optionnal, if you want to filter by (to, cc...)
 
         Returns:
-          List[Recipients]
+          List[Recipients]: Must not be modified, use `add_recipient`
 
         """
         if not type_:
-            return self._recipients
-        return filter(lambda r: r.type_ == type_, self._recipients)
+            return [r for recps in self._recipients.values() for r in recps]
+        return self._recipients.get(type_, [])
+
+    @property
+    def recipient_count(self):
+        return self._count
+
+    def recipient_strings(self, type_):
+        """Returns the standard string of each recipient of a type, e.g.
+        'My Name <my@name.com>'.
+
+        Computed once, until a recipient is added.
+
+        Returns:
+          tuple[str]
+        """
+        return self._serialized(type_, 'string')
+
+    def recipient_addresses(self, type_):
+        """Returns the bare address of each recipient of a type.
+
+        Computed once, until a recipient is added.
+
+        Returns:
+          tuple[str]
+        """
+        return self._serialized(type_, 'address')
+
+    def _serialized(self, type_, kind):
+        strings = self._strings.get((type_, kind))
+        if strings is None:
+            recipients = self.get_recipients(type_)
+            if kind == 'address':
+                strings = tuple(r.email for r in recipients)
+            else:
+                strings = tuple(str(r) for r in recipients)
+            self._strings[(type_, kind)] = strings
+        return strings
 
     def _check_recipient(self, recipient):
         if not isinstance(recipient, Recipient):
@@ -190,10 +436,17 @@ class Email:
 
         Raises:
           TypeError: If arg is not a `Recipient`
+          AttributeError: If the email is frozen
 
         """
+        if self.frozen:
+            raise AttributeError("Email is frozen, use Email.replace")
         self._check_recipient(recipient)
-        self._recipients.append(recipient)
+        self._recipients.setdefault(recipient.type_, []).append(recipient)
+        self._count += 1
+        # Invalidates the serialized recipients of this type
+        self._strings.pop((recipient.type_, 'string'), None)
+        self._strings.pop((recipient.type_, 'address'), None)
 
     def add_recipients(self, recipients):
         """ Append a list or recipients
@@ -222,8 +475,13 @@ class Email:
             dict
         """
 
-        new_dict = {k: v for k, v in self.__dict__.items()}
-        new_dict['subject'] = self.subject
+        new_dict = {
+            'subject': self.subject,
+            'replyto': self.replyto,
+            'text': self.text,
+            'html': self.html,
+            'files': self.files,
+        }
         # Most provider refuse to send an email without a body, but I
         # think it should be allowed
         if not self.text and not self.html:
@@ -231,8 +489,57 @@ class Email:
 
         return new_dict
 
+    def to_record(self):
+        """Returns this instance as a (dict) of plain values, e.g. to be
+        stored as JSON.
+
+        Use `Email.from_record` to get the email back. Attachments are
+        not part of the record.
+
+        Returns:
+            dict
+        """
+        record = {
+            type_: list(self.recipient_strings(type_))
+            for type_ in ('to', 'cc', 'bcc')
+        }
+        record.update({
+            'from': str(self.from_) if self.from_ else None,
+            'subject': self.__subject,
+            'replyto': self.replyto,
+            'text': self.text,
+            'html': self.html,
+            'variables': self.variables,
+        })
+        return record
+
+    @classmethod
+    def from_record(cls, record):
+        """Builds an email from the output of `Email.to_record`.
+
+        Note:
+            The record is trusted, recipients are not validated again.
+
+        Returns:
+            Email
+        """
+        email = cls(
+            subject=record.get('subject'),
+            replyto=record.get('replyto'),
+            text=record.get('text'),
+            html=record.get('html'),
+            variables=record.get('variables')
+        )
+        for type_ in ('to', 'cc', 'bcc'):
+            email.add_recipients(
+                Recipient.from_string(r, type_) for r in record.get(type_, [])
+            )
+        if record.get('from'):
+            email.from_ = Recipient.from_string(record['from'], 'from')
+        return email
+
     def validate(self):
-        if not len(self._recipients):
+        if not self._count:
             raise InvalidEmailError("Email must have at least one Recipient")
 
         # RFC soft limit
@@ -241,6 +548,22 @@ class Email:
                 "Subject must be less that 79 characters"
             )
 
+        if self.files is not None and (
+                not isinstance(self.files, (list, tuple)) or
+                not all(isinstance(f, Attachment) for f in self.files)):
+            raise InvalidEmailError("Files must be a list of Attachment")
+
+        if self.templated:
+            if not isinstance(self.variables, dict) or not all(
+                    isinstance(v, dict) for v in self.variables.values()):
+                raise InvalidEmailError(
+                    "Variables must map 'to' addresses to objects"
+                )
+            if len(self.get_recipients('to')) != self._count:
+                raise InvalidEmailError(
+                    "Templated emails can only have 'to' recipients"
+                )
+
         return True
 
 
@@ -270,15 +593,21 @@ def build_recipients(recp_dict):
     return recipients
 
 
-def build_email(recipients, subject, text, html, from_=None, replyto=None):
+def build_email(recipients, subject, text, html, from_=None, replyto=None,
+                variables=None, files=None):
     """ Convenience function to construct an email and validate.
 
+    Returns a frozen email, see `Email.freeze`.
+
     Args:
        recipients (list): List of `Recipient`
        subject (str): '' or None will default to (no subject)
        body (str): Can be None. The body of the email (text/plain) only
        from_ (Optional[str]): Must be a valid recipient string
        replyto (Optional[str]): Must be a valid email format
+       variables (Optional[dict]): Template variables by 'to' address,
+         see `Email`
+       files (Optional[list[Attachment]]): Attachments
 
     Raises:
        InvalidEmailError
@@ -296,6 +625,8 @@ def build_email(recipients, subject, text, html, from_=None, replyto=None):
     email.subject = subject
     email.text = text
     email.html = html
+    email.variables = variables
+    email.files = files or None
     if from_:
         from_ = Recipient.from_string(from_, 'from')
         from_.validate()
@@ -309,4 +640,4 @@ def build_email(recipients, subject, text, html, from_=None, replyto=None):
 
     email.validate()
 
-    return email
+    return email.freeze()
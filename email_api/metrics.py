@@ -0,0 +1,340 @@
+"""Prometheus style metrics, served on GET /metrics.
+
+Metrics are plain counters and histograms updated in memory, behind a
+lock, so recording costs a dict lookup and an addition::
+
+    ATTEMPTS.inc(provider='mailgun')
+    LATENCY.observe(0.25, provider='mailgun')
+
+gunicorn runs several worker processes, each with its own metrics. To
+expose totals each worker dumps its metrics to a file of a shared
+directory (see `MetricsExporter`), every few seconds and when it exits.
+Any worker answering /metrics adds up the files of the others to its own
+live values::
+
+    metrics:
+      dir: /tmp/email_api_metrics  # Shared by the workers
+      flush_interval: 5            # Seconds
+
+Without a `dir` each worker only reports its own metrics. Only the
+`email_api_metrics-<pid>.json` dumps are read, and removed at startup,
+the other files of the directory are left alone.
+
+"""
+import glob
+import json
+import logging
+import os
+import threading
+from bisect import bisect_left
+
+
+_LOG = logging.getLogger()
+
+METRICS_KEY = 'metrics'
+DEFAULTS = {
+    'dir': None,
+    'flush_interval': 5,
+}
+_DUMP_PREFIX = 'email_api_metrics-'
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+TIMING_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1)
+
+
+class _Metric:
+    """Values by label values, the base of `Counter` and `Histogram`.
+    """
+    type_ = None
+
+    def __init__(self, name, description, labels=()):
+        """
+        Args:
+          name (str): Prometheus name
+          description (str): The HELP text
+          labels (tuple[str]): Label names
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def snapshot(self):
+        """Returns the values as JSON friendly [label values, value] pairs.
+        """
+        with self._lock:
+            return [[list(k), self._copy(v)] for k, v in self._values.items()]
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(_Metric):
+    type_ = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    @staticmethod
+    def merge(values, other):
+        return values + other
+
+    def samples(self, key, value):
+        yield self.name + '_total', key, value
+
+
+class Histogram(_Metric):
+    type_ = 'histogram'
+
+    def __init__(self, name, description, labels=(),
+                 buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            hist = self._values.get(key)
+            if hist is None:
+                # Count per bucket (+Inf last), then sum
+                hist = self._values[key] = [0] * (len(self.buckets) + 2)
+            hist[index] += 1
+            hist[-1] += value
+
+    def get(self, **labels):
+        """Returns (count, sum) of the observations.
+        """
+        hist = self._values.get(self._key(labels))
+        if hist is None:
+            return 0, 0
+        return sum(hist[:-1]), hist[-1]
+
+    @staticmethod
+    def _copy(value):
+        return list(value)
+
+    @staticmethod
+    def merge(values, other):
+        return [a + b for a, b in zip(values, other)]
+
+    def samples(self, key, value):
+        cumulated = 0
+        for bound, count in zip(self.buckets + ('+Inf',), value[:-1]):
+            cumulated += count
+            yield self.name + '_bucket', key + (('le', bound),), cumulated
+        yield self.name + '_sum', key, value[-1]
+        yield self.name + '_count', key, cumulated
+
+
+ATTEMPTS = Counter(
+    'email_api_provider_attempts', 'Requests sent to a provider',
+    ('provider',)
+)
+SUCCESSES = Counter(
+    'email_api_provider_successes', 'Emails accepted by a provider',
+    ('provider',)
+)
+FAILURES = Counter(
+    'email_api_provider_failures',
+    'Failed provider attempts, by exception class (Rejected if the provider'
+    ' answered but did not accept the email)',
+    ('provider', 'error')
+)
+THROTTLED = Counter(
+    'email_api_provider_throttled',
+    'Providers skipped because they were over their rate limits',
+    ('provider',)
+)
+LATENCY = Histogram(
+    'email_api_provider_latency_seconds', 'Duration of provider attempts',
+    ('provider',)
+)
+FAILOVER_DEPTH = Histogram(
+    'email_api_failover_depth',
+    'Providers tried to send an email, 1 if the first one took it',
+    buckets=(1, 2, 3, 4, 5)
+)
+VALIDATION = Histogram(
+    'email_api_validation_seconds', 'Time to build and validate an email',
+    buckets=TIMING_BUCKETS
+)
+ROUTING = Histogram(
+    'email_api_routing_seconds', 'Time to pick the providers of an email',
+    buckets=TIMING_BUCKETS
+)
+
+WEBHOOK_EVENTS = Counter(
+    'email_api_webhook_events', 'Delivery events received from a provider',
+    ('provider', 'event')
+)
+
+ALL = (ATTEMPTS, SUCCESSES, FAILURES, THROTTLED, LATENCY, FAILOVER_DEPTH,
+       VALIDATION, ROUTING, WEBHOOK_EVENTS)
+
+
+def snapshot(metrics=ALL):
+    """Returns the values of this process, by metric name.
+    """
+    return {metric.name: metric.snapshot() for metric in metrics}
+
+
+def _merge(totals, metrics, snap):
+    for metric in metrics:
+        values = totals.setdefault(metric.name, {})
+        for key, value in snap.get(metric.name, []):
+            key = tuple(key)
+            if key in values:
+                values[key] = metric.merge(values[key], value)
+            else:
+                values[key] = value
+
+
+def _format_labels(names, key):
+    pairs = list(zip(names, key[:len(names)])) + list(key[len(names):])
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    ) + '}'
+
+
+def render(snapshots, metrics=ALL):
+    """Formats snapshots, added up, in the Prometheus text format.
+
+    Args:
+      snapshots (list[dict]): `snapshot` results, e.g. one per process
+
+    Returns:
+      str
+    """
+    totals = {}
+    for snap in snapshots:
+        _merge(totals, metrics, snap)
+
+    lines = []
+    for metric in metrics:
+        lines.append('# HELP {} {}'.format(metric.name, metric.description))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.type_))
+        for key, value in sorted(totals.get(metric.name, {}).items()):
+            for name, sample_key, sample in metric.samples(key, value):
+                lines.append('{}{} {}'.format(
+                    name, _format_labels(metric.labels, sample_key), sample
+                ))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter:
+    """Shares the metrics of the worker processes through files.
+    """
+
+    def __init__(self, directory, flush_interval=5, metrics=ALL):
+        """
+        Args:
+          directory (str): Shared by all the workers
+          flush_interval (float): Seconds between dumps
+          metrics (tuple): The metrics to share
+        """
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.metrics = metrics
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Args:
+          config (Optional[dict]): The `metrics` section
+
+        Returns:
+          MetricsExporter: None if there is no `dir`
+        """
+        conf = dict(DEFAULTS, **(config or {}))
+        if not conf['dir']:
+            return None
+        return cls(conf['dir'], conf['flush_interval'])
+
+    def reset(self):
+        """Removes the dumps of previous runs, to be called before the
+        workers start. Other files of the directory are kept.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        for path in self._dumps() + glob.glob(self._path('*') + '.tmp'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _path(self, pid):
+        return os.path.join(self.directory,
+                            '{}{}.json'.format(_DUMP_PREFIX, pid))
+
+    def _dumps(self):
+        return glob.glob(self._path('*'))
+
+    def flush(self):
+        """Dumps the metrics of this process to its file.
+        """
+        path = self._path(os.getpid())
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as out:
+            json.dump(snapshot(self.metrics), out)
+        os.replace(tmp, path)  # Readers never see a partial file
+
+    def collect(self):
+        """Returns the snapshots of all the workers: the live values of
+        this one and the last dump of the others.
+
+        Returns:
+          list[dict]
+        """
+        snapshots = [snapshot(self.metrics)]
+        own = self._path(os.getpid())
+        for path in self._dumps():
+            if path == own:
+                continue
+            try:
+                with open(path) as dump:
+                    snapshots.append(json.load(dump))
+            except (OSError, ValueError):
+                _LOG.warning("Unreadable metrics file %s", path)
+        return snapshots
+
+    def start(self):
+        """Starts dumping in the background, in each worker.
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='metrics')
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.flush_interval)
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError:
+                _LOG.exception("Could not dump the metrics")
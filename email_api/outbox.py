@@ -0,0 +1,528 @@
+"""Durable outbox: emails are saved to SQLite and sent in the background.
+
+POST /email only has to validate the email and write it to the outbox,
+background workers drain it through the `ProvidersManager`. This takes
+the providers latency out of the request path, absorbs traffic spikes,
+and as the email is committed before we answer, a crash loses nothing:
+rows being sent when a worker dies are claimed again once their lease
+expires. Workers renew the lease of their rows while sending them, and
+each claim has its own token: a worker whose rows were claimed again
+can't overwrite the status the new owner gives them.
+
+The database is in WAL mode so that the API and the workers of all the
+gunicorn processes can read and write it at the same time.
+
+A row goes through::
+
+    queued -> sending -> sent
+                  \\-> queued (retry, with backoff) -> ... -> failed
+
+When an email sent in chunks is only partly sent, the row goes back to
+queued with only the recipients of the unsent chunks.
+
+Sent rows keep the message ID given by the provider, the delivery events
+it posts later to our webhooks (`email_api.webhooks`) are saved in the
+same database and matched to the emails with it.
+
+"""
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from email_api.message import Email
+from email_api.providers_manager import ChunkedResponse
+
+
+_LOG = logging.getLogger()
+OUTBOX_KEY = 'outbox'
+
+DEFAULTS = {
+    'path': 'outbox.db',
+    'workers': 2,         # Sender threads per process
+    'batch_size': 20,     # Rows claimed at a time by a worker
+    'poll_interval': 1,   # Seconds between polls when idle
+    'lease': 300,         # Seconds before a claimed row is up for grabs
+    'max_attempts': 5,
+    'retry_delay': 30,    # Seconds, doubled after each failed attempt
+    'synchronous': 'NORMAL',  # FULL to also survive power losses
+}
+
+QUEUED = 'queued'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    route TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    provider TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    available_at REAL NOT NULL,
+    message_id TEXT,
+    claim_token TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_available
+    ON outbox (status, available_at);
+CREATE TABLE IF NOT EXISTS email_events (
+    id INTEGER PRIMARY KEY,
+    provider TEXT NOT NULL,
+    message_id TEXT,
+    recipient TEXT,
+    event TEXT NOT NULL,
+    reason TEXT,
+    timestamp REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS email_events_message
+    ON email_events (message_id);
+"""
+
+# Columns added to the tables of older databases
+_MIGRATIONS = [
+    ('outbox', 'message_id', 'TEXT'),
+    ('outbox', 'claim_token', 'TEXT'),
+]
+
+
+class OutboxItem:
+    """A claimed row, `token` identifies the claim.
+    """
+    __slots__ = ('id', 'email', 'route', 'attempts', 'token')
+
+    def __init__(self, id_, email, route, attempts, token=None):
+        self.id = id_
+        self.email = email
+        self.route = route
+        self.attempts = attempts
+        self.token = token
+
+
+class Outbox:
+    """The SQLite backed queue.
+
+    Thread-safe: every thread gets its own connection.
+    """
+
+    def __init__(self, path, lease=300, max_attempts=5, retry_delay=30,
+                 synchronous='NORMAL'):
+        """
+        Args:
+          path (str): The SQLite file, created if need be
+          lease (float): Seconds a claimed row stays claimed
+          max_attempts (int): Attempts before giving up on an email
+          retry_delay (float): Delay before the first retry, in seconds
+          synchronous (str): SQLite `synchronous` pragma
+        """
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._synchronous = synchronous
+        self._local = threading.local()
+        self._conn().executescript(_SCHEMA)
+        self._migrate()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Args:
+          config (dict): The `outbox` section of the config
+        """
+        conf = dict(DEFAULTS, **(config or {}))
+        return cls(conf['path'], conf['lease'], conf['max_attempts'],
+                   conf['retry_delay'], conf['synchronous'])
+
+    def _conn(self):
+        # Connections can't be shared across threads, nor processes
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None
+            )
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous={}'.format(self._synchronous))
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _migrate(self):
+        conn = self._conn()
+        for table, column, type_ in _MIGRATIONS:
+            columns = [row[1] for row in conn.execute(
+                'PRAGMA table_info({})'.format(table)
+            )]
+            if column not in columns:
+                conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    table, column, type_
+                ))
+
+    def put(self, email, route=None):
+        """Saves an email to be sent.
+
+        Args:
+          email (class:Email): A validated email
+          route (Optional[str]): The routing type
+
+        Returns:
+          str: The email ID
+        """
+        id_ = uuid.uuid4().hex
+        now = time.time()
+        self._conn().execute(
+            'INSERT INTO outbox (id, payload, route, status, created, '
+            'updated, available_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (id_, json.dumps(email.to_record()), route, QUEUED, now, now,
+             now)
+        )
+        return id_
+
+    def claim(self, limit):
+        """Claims up to `limit` emails ready to be sent, oldest first.
+
+        Rows claimed by a worker that died are claimed again once their
+        lease expired, see `renew`.
+
+        Returns:
+          list[OutboxItem]
+        """
+        now = time.time()
+        token = uuid.uuid4().hex
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(
+                'SELECT id, payload, route, attempts FROM outbox '
+                'WHERE status IN (?, ?) AND available_at <= ? '
+                'ORDER BY available_at LIMIT ?',
+                (QUEUED, SENDING, now, limit)
+            ).fetchall()
+            conn.executemany(
+                'UPDATE outbox SET status = ?, attempts = attempts + 1, '
+                'updated = ?, available_at = ?, claim_token = ? '
+                'WHERE id = ?',
+                [(SENDING, now, now + self.lease, token, row[0])
+                 for row in rows]
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+        return [
+            OutboxItem(id_, Email.from_record(json.loads(payload)), route,
+                       attempts + 1, token)
+            for id_, payload, route, attempts in rows
+        ]
+
+    def renew(self, items):
+        """Extends the lease of claimed rows, unless they were claimed
+        again.
+
+        Args:
+          items (list[OutboxItem]):
+
+        Returns:
+          int: The number of rows renewed
+        """
+        now = time.time()
+        return self._conn().executemany(
+            'UPDATE outbox SET available_at = ? '
+            'WHERE id = ? AND status = ? AND claim_token = ?',
+            [(now + self.lease, item.id, SENDING, item.token)
+             for item in items]
+        ).rowcount
+
+    def _update(self, item, assignments, params):
+        # Only the worker holding the claim may change a row
+        updated = self._conn().execute(
+            'UPDATE outbox SET {} WHERE id = ? AND claim_token IS ?'.format(
+                assignments
+            ), tuple(params) + (item.id, item.token)
+        ).rowcount
+        if not updated:
+            _LOG.warning("%s was claimed again by another worker, its "
+                         "status is left to it", item.id)
+        return bool(updated)
+
+    def mark_sent(self, item, provider, message_id=None):
+        """
+        Args:
+          item (OutboxItem):
+          provider (str): Nickname of the provider that sent it
+          message_id (Optional[str]): The ID the provider gave it
+
+        Returns:
+          bool: False if the row was claimed again, and left alone
+        """
+        return self._update(
+            item, 'status = ?, provider = ?, error = NULL, updated = ?, '
+            'message_id = ?', (SENT, provider, time.time(), message_id)
+        )
+
+    def mark_failed(self, item, error, email=None):
+        """Schedules a retry with exponential backoff, or gives up after
+        `max_attempts`.
+
+        Args:
+          item (OutboxItem):
+          error (str):
+          email (Optional[Email]): What is left to send, if only part of
+            the email was sent
+
+        Returns:
+          bool: False if the row was claimed again, and left alone
+        """
+        now = time.time()
+        if item.attempts >= self.max_attempts:
+            status, available_at = FAILED, now
+        else:
+            status = QUEUED
+            available_at = now + self.retry_delay * 2 ** (item.attempts - 1)
+
+        if email is None:
+            return self._update(
+                item, 'status = ?, error = ?, updated = ?, available_at = ?',
+                (status, error, now, available_at)
+            )
+        return self._update(
+            item, 'status = ?, error = ?, updated = ?, available_at = ?, '
+            'payload = ?',
+            (status, error, now, available_at, json.dumps(email.to_record()))
+        )
+
+    def add_events(self, events):
+        """Saves delivery events, all in one transaction.
+
+        Args:
+          events (list[email_api.webhooks.DeliveryEvent]):
+        """
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                'INSERT INTO email_events (provider, message_id, '
+                'recipient, event, reason, timestamp) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(e.provider, e.message_id, e.recipient, e.event, e.reason,
+                  e.timestamp) for e in events]
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def get(self, id_):
+        """Returns the status of an email, or None if not found.
+
+        Returns:
+          dict: With the delivery `events` of its recipients, oldest
+            first
+        """
+        conn = self._conn()
+        row = conn.execute(
+            'SELECT id, status, attempts, provider, error, created, '
+            'updated, message_id, payload FROM outbox WHERE id = ?', (id_,)
+        ).fetchone()
+        if row is None:
+            return None
+        keys = ('id', 'status', 'attempts', 'provider', 'error', 'created',
+                'updated')
+        status = dict(zip(keys, row))
+        status['events'] = self._events(row[7], row[8]) if row[7] else []
+        return status
+
+    def _events(self, message_id, payload):
+        # Batch sends share a message ID, keep the events of this email
+        record = json.loads(payload)
+        email = Email.from_record(record)
+        recipients = {
+            address.lower() for type_ in ('to', 'cc', 'bcc')
+            for address in email.recipient_addresses(type_)
+        }
+        keys = ('event', 'recipient', 'reason', 'timestamp', 'provider')
+        return [
+            dict(zip(keys, row)) for row in self._conn().execute(
+                'SELECT event, recipient, reason, timestamp, provider '
+                'FROM email_events WHERE message_id = ? '
+                'ORDER BY timestamp, id', (message_id,)
+            )
+            if not row[1] or row[1].lower() in recipients
+        ]
+
+    def close(self):
+        """Closes the connection of the calling thread.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class OutboxWorkers:
+    """A pool of threads draining the outbox.
+
+    Must be started in each process, after the fork for gunicorn.
+    """
+
+    def __init__(self, outbox, send, workers=2, batch_size=20,
+                 poll_interval=1, send_many=None, message_id=None):
+        """
+        Args:
+          outbox (Outbox):
+          send (callable): Sends an email: `send(email, route)` and returns
+            `(response, provider nickname)`, `(None, None)` on failure
+          workers (int): Number of threads
+          batch_size (int): Rows claimed at a time
+          poll_interval (float): Seconds between polls when idle
+          send_many (Optional[callable]): Sends the emails of a route
+            together: `send_many(emails, route)` returns the `send` result
+            of each email. If set the claimed emails are sent with it
+          message_id (Optional[callable]): Returns the ID a provider gave
+            to an email: `message_id(response, provider nickname)`, to
+            match its delivery events
+        """
+        self.outbox = outbox
+        self._send = send
+        self._send_many = send_many
+        self._message_id = message_id
+        self._workers = workers
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._threads = []
+
+    def start(self):
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._run, daemon=True,
+                             name='outbox-{}'.format(i))
+            for i in range(self._workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=10):
+        """Stops the workers once they are done with their current batch.
+        """
+        self._stop.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def wakeup(self):
+        """Tells idle workers there is something new, so they don't wait
+        for the next poll.
+        """
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                drained = self.drain_once()
+            except Exception:  # pylint: disable=W0703
+                _LOG.exception("Outbox worker error")
+                drained = 0
+            if not drained:
+                self._wakeup.wait(self._poll_interval)
+                self._wakeup.clear()
+        self.outbox.close()
+
+    def drain_once(self):
+        """Claims a batch and sends it.
+
+        Returns:
+          int: The number of emails processed
+        """
+        items = self.outbox.claim(self._batch_size)
+        if not items:
+            return 0
+        with self._renewing(items):
+            self._send_items(items)
+        return len(items)
+
+    @contextlib.contextmanager
+    def _renewing(self, items):
+        """Renews the lease of the claimed items while they are sent,
+        however long the providers take.
+        """
+        done = threading.Event()
+
+        def renew():
+            while not done.wait(self.outbox.lease / 3):
+                try:
+                    self.outbox.renew(items)
+                except sqlite3.Error:
+                    _LOG.exception("Could not renew the outbox lease")
+            self.outbox.close()
+
+        thread = threading.Thread(target=renew, daemon=True,
+                                  name='outbox-lease')
+        thread.start()
+        try:
+            yield
+        finally:
+            done.set()
+            thread.join()
+
+    def _send_items(self, items):
+        if self._send_many is None:
+            for item in items:
+                self._process(item)
+            return
+
+        by_route = {}
+        for item in items:
+            by_route.setdefault(item.route, []).append(item)
+        for route, group in by_route.items():
+            try:
+                results = self._send_many([i.email for i in group], route)
+            except Exception as e:  # pylint: disable=W0703
+                _LOG.exception("Failed to send %s emails", len(group))
+                for item in group:
+                    self.outbox.mark_failed(item, type(e).__name__)
+                continue
+            for item, (res, provider) in zip(group, results):
+                self._record(item, res, provider)
+
+    def _process(self, item):
+        try:
+            res, provider = self._send(item.email, item.route)
+        except Exception as e:  # pylint: disable=W0703
+            _LOG.exception("Failed to send %s", item.id)
+            self.outbox.mark_failed(item, type(e).__name__)
+            return
+        self._record(item, res, provider)
+
+    def _record(self, item, res, provider):
+        if res is None:
+            _LOG.warning("No provider could send %s (attempt %s)",
+                         item.id, item.attempts)
+            self.outbox.mark_failed(item, 'All providers failed')
+        elif isinstance(res, ChunkedResponse) and not res:
+            # Some chunks were not sent: only their recipients are sent
+            # again
+            unsent = res.unsent_recipients()
+            _LOG.warning("%s partly sent (attempt %s)", item.id,
+                         item.attempts)
+            self.outbox.mark_failed(
+                item,
+                'Partly sent: {} of {} chunks'.format(res.sent, len(res)),
+                item.email.with_recipients(unsent) if unsent else None
+            )
+        else:
+            message_id = None
+            if self._message_id is not None:
+                message_id = self._message_id(res, provider)
+            self.outbox.mark_sent(item, provider, message_id)
@@ -0,0 +1,101 @@
+"""Provider instances built and validated once, at startup.
+
+Creating a provider, validating it and formatting its URL and auth from
+the config gives the same result for every email. The registry does it
+once per process and `ProvidersManager` reuses the instances, with the
+request method, URL and auth precomputed::
+
+    registry = ProviderRegistry(REGISTERED_PROVIDERS, config['providers'])
+    manager = ProvidersManager(providers, config, registry=registry)
+
+Providers are shared by all the threads of a worker: they must not keep
+per email state (the `AProvider` contract already says they should not
+have side effects).
+
+"""
+from collections import namedtuple
+
+from email_api.abstract_provider import AProvider, InvalidProviderError
+
+
+RequestTarget = namedtuple('RequestTarget', ['method', 'url', 'auth'])
+"""Immutable (method:str, url:str, auth:Optional[tuple]) of a provider
+send request.
+"""
+
+
+def create_provider(provider_class, config):
+    """ Instanciate and validate the provider.
+
+    Args:
+        provider_class (class:AProvider): An AProvider subclass
+        config (dict): Configuration that will be passed to the provider
+
+    Raises:
+        InvalidProviderError: If provider_class is not:
+          - Inheriting `AProvider`
+          - Successfully passing `AProvider` validation
+
+    Returns:
+        AProvider: An AProvider speciliazation instance
+    """
+    try:
+        provider = provider_class(config)
+    except TypeError:
+        raise InvalidProviderError("Provider must sub-class AProvider")
+
+    if not isinstance(provider, AProvider):
+        raise InvalidProviderError("Provider must sub-class AProvider")
+
+    provider.validate()
+    return provider
+
+
+def request_target(provider):
+    """Reads the method, URL and auth of a (validated) provider.
+
+    Returns:
+        RequestTarget
+    """
+    method, url = provider.send_url
+    return RequestTarget(method.value, url, provider.auth)
+
+
+class ProviderRegistry:
+    """Validated provider instances and their `RequestTarget`, by class.
+    """
+
+    def __init__(self, provider_classes, config):
+        """
+        Args:
+          provider_classes (list[AProvider]): `AProvider` subclasses
+          config (dict): Configuration that will be passed to providers
+
+        Raises:
+          InvalidProviderError: If a provider is invalid or badly
+            configured
+        """
+        self._providers = {}
+        self._targets = {}
+        for klass in provider_classes:
+            provider = create_provider(klass, config)
+            self._providers[klass] = provider
+            self._targets[id(provider)] = request_target(provider)
+
+    def __contains__(self, provider_class):
+        return provider_class in self._providers
+
+    def __len__(self):
+        return len(self._providers)
+
+    def get(self, provider_class):
+        """Returns the instance of a provider class, None if it is not
+        registered.
+        """
+        return self._providers.get(provider_class)
+
+    def target(self, provider):
+        """Returns the precomputed `RequestTarget` of a registered
+        instance, None for any other provider.
+        """
+        return self._targets.get(id(provider))
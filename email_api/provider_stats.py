@@ -0,0 +1,129 @@
+"""Latency and success rate of each provider, as seen by this worker.
+
+`ProvidersManager.send` records every attempt here. With adaptive
+routing on, `email_api.api.get_route` re-ranks the providers allowed by
+the config, fastest healthy provider first::
+
+    adaptive_routing:
+      enabled: true
+      alpha: 0.2      # Weight of the last sample in the moving averages
+      min_samples: 5  # Below that a provider keeps its configured rank
+      failure_penalty: 5  # Seconds, cost of a failure on top of latency
+
+Stats are exponentially weighted moving averages (EWMA) so they follow
+the providers' performance through the day without keeping samples.
+
+"""
+import threading
+
+
+STATS_KEY = 'adaptive_routing'
+DEFAULTS = {
+    'enabled': False,
+    'alpha': 0.2,
+    'min_samples': 5,
+    'failure_penalty': 5,
+}
+# Success rate floor, so a provider that always fails still gets a
+# (terrible) finite score
+_MIN_SUCCESS = 0.01
+
+
+class _Stat:
+    __slots__ = ('latency', 'success', 'samples')
+
+    def __init__(self):
+        self.latency = None
+        self.success = 1.0
+        self.samples = 0
+
+
+class ProviderStats:
+    """EWMA of latency and success rate, by provider nickname.
+    """
+
+    def __init__(self, alpha=0.2, min_samples=5, failure_penalty=5,
+                 enabled=True):
+        """
+        Args:
+          alpha (float): Weight of a new sample, in ]0, 1]
+          min_samples (int): Samples needed before ranking a provider
+          failure_penalty (float): Seconds added to the score per failure,
+            so a provider failing fast does not look fast
+          enabled (bool): If routing should use `rank`, stats are
+            recorded either way
+        """
+        self.enabled = enabled
+        self.alpha = alpha
+        self.min_samples = min_samples
+        self.failure_penalty = failure_penalty
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Args:
+          config (Optional[dict]): The `adaptive_routing` section
+        """
+        conf = dict(DEFAULTS, **(config or {}))
+        return cls(conf['alpha'], conf['min_samples'],
+                   conf['failure_penalty'], conf['enabled'])
+
+    def record(self, nickname, success, latency):
+        """Records an attempt.
+
+        Args:
+          nickname (str): The provider nickname
+          success (bool): If the provider accepted the email
+          latency (float): Seconds the attempt took
+        """
+        with self._lock:
+            stat = self._stats.get(nickname)
+            if stat is None:
+                stat = self._stats[nickname] = _Stat()
+            if stat.latency is None:
+                stat.latency = latency
+            else:
+                stat.latency += self.alpha * (latency - stat.latency)
+            stat.success += self.alpha * (float(success) - stat.success)
+            stat.samples += 1
+
+    def score(self, nickname):
+        """Expected time to get an email through this provider, lower is
+        better. None if we don't know enough about it.
+        """
+        stat = self._stats.get(nickname)
+        if stat is None or stat.samples < self.min_samples:
+            return None
+        cost = stat.latency + (1 - stat.success) * self.failure_penalty
+        return cost / max(stat.success, _MIN_SUCCESS)
+
+    def rank(self, providers, nickname=lambda p: p.nickname):
+        """Sorts providers by score.
+
+        Providers without enough samples come first, so they get some,
+        in their configured order.
+
+        Args:
+          providers (list): Providers allowed by the config, by priority
+          nickname (callable): Returns the nickname of a provider
+
+        Returns:
+          list: A new sorted list
+        """
+        def key(provider):
+            score = self.score(nickname(provider))
+            return (0, 0) if score is None else (1, score)
+        return sorted(providers, key=key)
+
+    def snapshot(self):
+        return {
+            nick: {
+                'latency': stat.latency,
+                'success_rate': stat.success,
+                'samples': stat.samples,
+                'score': self.score(nick),
+            }
+            for nick, stat in list(self._stats.items())
+        }
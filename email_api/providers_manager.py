@@ -10,18 +10,123 @@ Its role is:
 """
 
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
 import requests
 
-from email_api.abstract_provider import (
-    DataFormat,
+from email_api.abstract_provider import DataFormat, InvalidProviderError
+from email_api.attachments import MultipartBody
+from email_api.provider_registry import create_provider, request_target
+from email_api.deadline import DeadlineExceededError
+from email_api import metrics
+
+
+_LOG = logging.getLogger()
+
+# Errors on which we move on to the next provider
+FAILOVER_ERRORS = (
     InvalidProviderError,
-    AProvider
+    requests.exceptions.MissingSchema,
+    requests.HTTPError,
+    requests.Timeout,
+    requests.TooManyRedirects,
+    requests.ConnectionError
 )
 
 
-_LOG = logging.getLogger()
+class ChunkedResponse:
+    """Result of an email sent in parts: chunks of an email too big for
+    the providers (see `email_api.message.Email.split`), or recipients
+    routed separately.
+
+    Truthy only if every chunk was sent.
+    """
+
+    @classmethod
+    def merge(cls, results, chunks=None):
+        """Returns the `ProvidersManager.send` result of an email sent in
+        parts.
+
+        Args:
+          results (list[tuple]): (response, provider nickname) of each part
+          chunks (Optional[list[Email]]): The parts, in the same order
+
+        Returns:
+          tuple: (ChunkedResponse, comma separated nicknames), (None, None)
+            if no part was sent
+        """
+        response = cls(results, chunks)
+        if not response.sent:
+            return None, None
+        return response, response.providers
+
+    def __init__(self, results, chunks=None):
+        """
+        Args:
+          results (list[tuple]): (response, provider nickname) of each
+            chunk, (None, None) for the chunks no provider could send
+          chunks (Optional[list[Email]]): The chunks, in the same order,
+            to know the recipients left to send
+        """
+        self.results = results
+        self.chunks = chunks
+
+    def __bool__(self):
+        return all(
+            res is not None and
+            (not isinstance(res, ChunkedResponse) or bool(res))
+            for res, _ in self.results
+        )
+
+    def __len__(self):
+        return len(self.results)
+
+    @property
+    def sent(self):
+        """Number of chunks sent.
+        """
+        return sum(1 for res, _ in self.results if res is not None)
+
+    @property
+    def providers(self):
+        """Nicknames of the providers that sent chunks, comma separated.
+        """
+        return ','.join(sorted({nick for _, nick in self.results if nick}))
+
+    def unsent_recipients(self):
+        """Returns the recipients of the chunks that were not sent, e.g.
+        to send them again.
+
+        Returns:
+          list[Recipient]: None if the chunks are unknown
+        """
+        if self.chunks is None:
+            return None
+        recipients = []
+        for (res, _), chunk in zip(self.results, self.chunks):
+            if isinstance(res, ChunkedResponse) and not res:
+                unsent = res.unsent_recipients()
+                recipients.extend(
+                    chunk.get_recipients() if unsent is None else unsent
+                )
+            elif res is None:
+                recipients.extend(chunk.get_recipients())
+        return recipients
+
+
+def _provider_failed(response):
+    """Returns True if a failed attempt is the fault of the provider:
+    no answer, a 5XX or a 429, rather than a rejected email (4XX).
+    """
+    status = getattr(response, 'status_code', None)
+    return not isinstance(status, int) or status >= 500 or status == 429
+
+
+def _nickname(klass):
+    # Provider factories (e.g. in tests) may not have a nickname
+    return getattr(klass, 'nickname', None)
 
 
 class ProvidersManager:
@@ -32,7 +137,10 @@ class ProvidersManager:
 
     """
 
-    def __init__(self, provider_classes, config):
+    def __init__(self, provider_classes, config, sessions=None,
+                 breakers=None, stats=None, timeouts=None, registry=None,
+                 max_parallel_chunks=4, rate_limits=None,
+                 concurrency=None):
         """
         Note:
            We take Classes as argument and not instances because we might
@@ -44,36 +152,71 @@ class ProvidersManager:
           provider_classes (list[AProvider]): List of
             `email_api.abstract_provider.AProvider` subclasses (!= objects)
           config (dict): Configuration that will be passed to providers
+          sessions (Optional[email_api.sessions.SessionPool]): Shared
+            HTTP sessions. If None a throw-away session is opened for
+            each `send`
+          breakers (Optional[email_api.circuit_breaker.CircuitBreakers]):
+            Shared circuit breakers, providers with an open circuit are
+            tried last (or skipped)
+          stats (Optional[email_api.provider_stats.ProviderStats]):
+            Where to record the latency and outcome of each attempt
+          timeouts (Optional[email_api.deadline.Timeouts]): Total budget
+            of a send and per provider timeouts, no timeout if None
+          registry (Optional[email_api.provider_registry.ProviderRegistry]):
+            Provider instances built once, classes that are not in it
+            are instanciated for each `send`
+          max_parallel_chunks (int): Chunks of an email sent at the same
+            time, when it has more recipients than a provider accepts
+          rate_limits (Optional[email_api.rate_limit.RateLimiter]):
+            Provider quotas, providers over theirs are skipped
+          concurrency (Optional[email_api.concurrency.AdaptiveLimits]):
+            Adaptive in flight limits, busy providers are tried last
 
         """
         self.config = config
         self.provider_classes = provider_classes
+        self.sessions = sessions
+        self.breakers = breakers
+        self.stats = stats
+        self.timeouts = timeouts
+        self.registry = registry
+        self.max_parallel_chunks = max_parallel_chunks
+        self.rate_limits = rate_limits
+        self.concurrency = concurrency
 
     @staticmethod
     def _create_provider(provider_class, config):
         """ Instanciate and validate the provider.
 
-        Args:
-            provider_class (class:AProvider): An AProvider subclass
+        See `email_api.provider_registry.create_provider`
 
         Raises:
-            InvalidProviderError: If provider_class is not:
-              - Inheriting `AProvider`
-              - Successfully passing `AProvider` validation
-
-        Returns:
-            AProvider: An AProvider speciliazation instance
+            InvalidProviderError
         """
-        try:
-            provider = provider_class(config)
-        except TypeError:
-            raise InvalidProviderError("Provider must sub-class AProvider")
+        return create_provider(provider_class, config)
 
-        if not isinstance(provider, AProvider):
-            raise InvalidProviderError("Provider must sub-class AProvider")
+    def _provider(self, provider_class):
+        """Returns the registered instance of a provider class, or a new
+        one if there is no registry or the class is not registered.
 
-        provider.validate()
-        return provider
+        Raises:
+            InvalidProviderError
+        """
+        if self.registry is not None:
+            provider = self.registry.get(provider_class)
+            if provider is not None:
+                return provider
+        return self._create_provider(provider_class, self.config)
+
+    def _target(self, provider):
+        """Returns the `RequestTarget` of a provider, precomputed if it
+        comes from the registry.
+        """
+        if self.registry is not None:
+            target = self.registry.target(provider)
+            if target is not None:
+                return target
+        return request_target(provider)
 
     @staticmethod
     def _get_serialized_data(provider, email):
@@ -82,6 +225,9 @@ class ProvidersManager:
 
         Makes sure the types are valid.
 
+        The result is memoized in the payloads of a frozen email, so
+        failover and retries don't serialize it again for a provider.
+
         Raises:
           InvalidProviderError: If the provider instance returned bad data
             formats
@@ -92,6 +238,17 @@ class ProvidersManager:
             (DataFormat, dict)
 
         """
+        payloads = email.payloads
+        if payloads is not None and provider in payloads:
+            return payloads[provider]
+
+        result = ProvidersManager._serialize(provider, email)
+        if payloads is not None:
+            payloads[provider] = result
+        return result
+
+    @staticmethod
+    def _serialize(provider, email):
         try:
             email = provider.fill_in_blanks(email)
             format_, mail_dict = provider.email_to_data(email)
@@ -99,7 +256,33 @@ class ProvidersManager:
             raise InvalidProviderError(
                 "Provider.email_to_data must return tuple"
             )
+        return ProvidersManager._check_data(format_, mail_dict)
+
+    @staticmethod
+    def _get_batch_data(provider, emails):
+        """Same as `_get_serialized_data` for a batch of emails, not
+        memoized.
+
+        Raises:
+          InvalidProviderError
+
+        Returns:
+          tuple::
+
+            (DataFormat, dict)
+
+        """
+        try:
+            emails = [provider.fill_in_blanks(e) for e in emails]
+            format_, mail_dict = provider.emails_to_batch_data(emails)
+        except ValueError:
+            raise InvalidProviderError(
+                "Provider.emails_to_batch_data must return tuple"
+            )
+        return ProvidersManager._check_data(format_, mail_dict)
 
+    @staticmethod
+    def _check_data(format_, mail_dict):
         if not isinstance(format_, DataFormat) or \
            not isinstance(mail_dict, dict):
             raise InvalidProviderError(
@@ -137,16 +320,49 @@ class ProvidersManager:
         format_, http_data = ProvidersManager._get_serialized_data(
             provider, email
         )
-        method, url = provider.send_url
-        auth = provider.auth
+        return self._bind_request(provider, format_, http_data, request_func,
+                                  email.files)
+
+    def _prep_batch_request(self, emails, provider, request_func):
+        """Same as `_prep_request` for a batch of emails, sent in a
+        single call to the provider batch API.
+
+        Raises:
+          InvalidProviderError
+        """
+        format_, http_data = ProvidersManager._get_batch_data(
+            provider, emails
+        )
+        return self._bind_request(provider, format_, http_data, request_func)
+
+    def _bind_request(self, provider, format_, http_data, request_func,
+                      files=None):
+        target = self._target(provider)
         # Build http request
-        if auth:  # Add HTTP auth if provider needs it
-            request_func = partial(request_func, auth=auth)
+        if target.auth:  # Add HTTP auth if provider needs it
+            request_func = partial(request_func, auth=target.auth)
+
+        if files:
+            if format_ is not DataFormat.form:
+                raise InvalidProviderError(
+                    "Attachments can only be sent with DataFormat.form"
+                )
+            # A new body for each attempt, attachments are re-opened
+            body = MultipartBody(
+                http_data, [(provider.attachment_field, f) for f in files]
+            )
+            return partial(
+                request_func,
+                method=target.method,
+                url=target.url,
+                data=body,
+                headers={'Content-Type': body.content_type}
+            )
 
         return partial(
             request_func,
-            method=method.value,
-            url=url,
+            method=target.method,
+            url=target.url,
             # Below is: data=http_data or json=.. or params=..
             **{format_.value: http_data}
         )
@@ -161,52 +377,554 @@ class ProvidersManager:
         Args:
 
           email (class:Email): The email structure to be
-            sent
+            sent, it is frozen (see `Email.freeze`) if it is not already
+
+        Emails with more recipients than one of the providers accepts
+        (see `AProvider.recipient_limit`) are split in chunks, sent in
+        parallel, each chunk with its own failover. Mail merge emails go
+        as is to the providers that render them (see
+        `AProvider.supports_templates`), and are rendered here, one email
+        per recipient, only for the recipients failed over to a provider
+        that can't.
+
+        Raises:
+          DeadlineExceededError: If the time budget ran out before
+            trying all the providers
 
         Returns:
-          bool: True if email was successfully sent
+          tuple: (response, provider nickname), (None, None) if no
+            provider could send it. For an email sent in chunks:
+            (ChunkedResponse, comma separated nicknames)
 
         """
-        with requests.session() as sess:
-            for klass in self.provider_classes:
-                try:
-                    # Prepare the request using the current provider
-                    provider = self._create_provider(klass, self.config)
-                    req = self._prep_request(email, provider, sess.request)
-                    response = req()
-                    if not provider.is_success(response):
-                        _LOG.error(
-                            "Failed to send with %s moving on",
-                            klass.nickname
-                        )
-                        continue
-                    # Reponse data is useless as it greatly varies
-                    # from one provider to another.
-                    # E.g sendgrid just replies: 'success'
-                    # To keep track of email statuses webhooks need to be setup
-                    return response, klass.nickname
-
-                except (InvalidProviderError,
-                        requests.exceptions.MissingSchema):
-                    # Failing here means bad coding/config
-                    _LOG.exception(
-                        "%s is an invalid provider class", klass
-                    )
+        email = email.freeze()
+        if self.sessions is None:
+            with requests.session() as sess:
+                return self._send_split(email, lambda _: sess)
+        return self._send_split(email, self.sessions.get)
+
+    def _send_split(self, email, get_session):
+        runs = self._template_runs(email)
+        if runs is not None:
+            return self._send_runs(email, runs, get_session)
+        chunks = self._chunks(email)
+        if len(chunks) == 1:
+            return self._send(chunks[0], get_session)
+        return ChunkedResponse.merge(
+            self._send_chunks(chunks, get_session), chunks
+        )
+
+    def _send_chunks(self, chunks, get_session, providers=None):
+        """Sends chunks in parallel, each with its own failover.
+
+        Returns:
+          list[tuple]: (response, provider nickname) of each chunk
+        """
+        def send_chunk(chunk):
+            try:
+                return self._send(chunk, get_session, providers)
+            except DeadlineExceededError as e:
+                _LOG.warning("Chunk not sent: %s", e)
+                return None, None
+
+        workers = min(len(chunks), self.max_parallel_chunks)
+        with ThreadPoolExecutor(workers) as pool:
+            return list(pool.map(send_chunk, chunks))
+
+    def _send_runs(self, email, runs, get_session):
+        """Sends a mail merge email through each run of providers in turn
+        (see `_template_runs`), with the recipients the previous runs
+        did not send.
+        """
+        results, parts = [], []
+        for providers in runs:
+            chunks = self._chunks(email, providers)
+            unsent = self._sent_parts(
+                self._send_chunks(chunks, get_session, providers), chunks,
+                results, parts
+            )
+            if not unsent:
+                break
+            email = email.with_recipients(unsent)
+        else:
+            results.append((None, None))
+            parts.append(email)
+        if len(results) == 1:
+            return results[0]
+        return ChunkedResponse.merge(results, parts)
+
+    @staticmethod
+    def _sent_parts(chunk_results, chunks, results, parts):
+        """Adds the chunks sent, and their results, to `parts` and
+        `results`.
+
+        Returns:
+          list[Recipient]: The recipients of the chunks not sent
+        """
+        unsent = []
+        for res, chunk in zip(chunk_results, chunks):
+            if res[0] is None:
+                unsent.extend(chunk.get_recipients())
+            else:
+                results.append(res)
+                parts.append(chunk)
+        return unsent
+
+    def _template_runs(self, email):
+        """Groups the providers of a mail merge email, in the order they
+        are tried, in runs of providers that all render templates server
+        side, or none does. The template is sent as is to the former, and
+        rendered here for the latter.
+
+        Returns:
+          list[list]: Provider classes, None if the email is not templated
+            or a single run
+        """
+        if not email.templated:
+            return None
+        runs = []
+        current = None
+        for klass in self._ordered():
+            try:
+                templates = bool(getattr(self._provider(klass),
+                                         'supports_templates', False))
+            except FAILOVER_ERRORS:
+                templates = None  # It will fail again when sending
+            if not runs or None not in (templates, current) and \
+               templates != current:
+                runs.append([klass])
+            else:
+                runs[-1].append(klass)
+            if templates is not None:
+                current = templates
+        return runs if len(runs) > 1 else None
+
+    def _chunks(self, email, providers=None):
+        """Splits an email in the emails to actually send: one per
+        recipient for a mail merge the providers can't do server side,
+        chunks for the smallest recipient limit of the providers.
+
+        Args:
+          email (Email):
+          providers (Optional[list]): The provider classes to send it
+            with, all of them by default
+
+        Returns:
+          list[Email]
+        """
+        limit, templates = self._capabilities(providers)
+        if email.templated and not templates:
+            return email.render_all()
+        if not limit:
+            return [email]
+        return email.split(limit)
+
+    def _needs_split(self, email):
+        limit, templates = self._capabilities()
+        return (email.templated and not templates) or \
+            bool(limit and email.recipient_count > limit)
+
+    def _capabilities(self, providers=None):
+        """Returns what all the providers can handle.
+
+        Args:
+          providers (Optional[list]): Provider classes, all of them by
+            default
+
+        Returns:
+          tuple: (smallest recipient limit or None, if they all support
+            server side templates)
+        """
+        limits = []
+        templates = True
+        for klass in self.provider_classes if providers is None \
+                else providers:
+            try:
+                provider = self._provider(klass)
+            except FAILOVER_ERRORS:
+                continue  # It will fail again when sending
+            limit = getattr(provider, 'recipient_limit', None)
+            if limit:
+                limits.append(limit)
+            templates &= bool(getattr(provider, 'supports_templates', False))
+        return min(limits) if limits else None, templates
+
+    def _send(self, email, get_session, providers=None):
+        """The failover loop of `send`.
+
+        Args:
+          email (class:Email): The email structure to be sent
+          get_session (callable): Returns the `requests.Session` to use
+            for a provider nickname
+          providers (Optional[list]): The provider classes to try, in
+            order, instead of all of them
+
+        """
+        deadline = self.timeouts.deadline() if self.timeouts else None
+        tried = 0
+        for klass in self._ordered() if providers is None else providers:
+            start = time.monotonic()
+            entered = None
+            try:
+                # Prepare the request using the current provider
+                provider = self._provider(klass)
+                if not self._can_send(provider, email) or \
+                   not self._enter(provider):
                     continue
-                except requests.HTTPError as e:
-                    # If 4XX most likely because of unsanitized or bad
-                    # data format
-                    _LOG.warning(e)
+                entered = provider
+                if not self._acquire(provider, deadline):
                     continue
-                except (requests.Timeout, requests.TooManyRedirects,
-                        requests.ConnectionError) as e:
-                    _LOG.warning(e)
+                tried += 1
+                sess = get_session(provider.nickname)
+                req = self._prep_request(email, provider, sess.request)
+                kwargs = self._request_kwargs(provider, deadline)
+                if not self._allow(provider):
                     continue
+                response = req(**kwargs)
+            except FAILOVER_ERRORS as e:
+                self._on_error(klass, e, time.monotonic() - start)
+                continue
+            finally:
+                self._leave(entered)
+
+            if self._on_response(provider, response,
+                                 time.monotonic() - start):
+                # Reponse data is useless as it greatly varies
+                # from one provider to another.
+                # E.g sendgrid just replies: 'success'
+                # To keep track of email statuses webhooks need to be setup
+                metrics.FAILOVER_DEPTH.observe(tried)
+                return response, provider.nickname
 
         # if we exit the loop it means no provider successfully worked
+        metrics.FAILOVER_DEPTH.observe(tried)
         return None, None
 
+    def send_many(self, emails):
+        """Send many emails, using the provider batch APIs when possible.
+
+        For each provider in turn, the emails not sent yet are grouped
+        by `AProvider.batch_key` and sent in batches of at most
+        `AProvider.max_batch_size`. Providers without a batch API, and
+        emails that can't be batched, get one call per email. Whatever
+        failed moves on to the next provider, like `send`.
+
+        Args:
+          emails (list[Email]): They are frozen if they are not already
+
+        Returns:
+          list[tuple]: (response, provider nickname) of each email, in
+            order, (None, None) for the emails no provider could send.
+            Emails of a batch share its response. Each email has its
+            own time budget, from its first attempt: it is (None, None)
+            if it runs out. Emails too big for a provider are sent in
+            chunks, like `send`
+
+        """
+        emails = [e.freeze() for e in emails]
+        if self.sessions is None:
+            with requests.session() as sess:
+                return self._send_many(emails, lambda _: sess)
+        return self._send_many(emails, self.sessions.get)
+
+    def _send_many(self, emails, get_session):
+        results = [(None, None)] * len(emails)
+        pending = []
+        for i, email in enumerate(emails):
+            if not self._needs_split(email):
+                pending.append(i)
+                continue
+            # Too big for some providers, sent in chunks
+            try:
+                results[i] = self._send_split(email, get_session)
+            except DeadlineExceededError as e:
+                _LOG.warning("%s, email %s not sent", e, i)
+
+        deadlines = {}
+        for klass in self._ordered():
+            if not pending:
+                break
+            try:
+                provider = self._provider(klass)
+                sess = get_session(provider.nickname)
+            except FAILOVER_ERRORS as e:
+                self._on_error(klass, e, 0)
+                continue
+
+            failed = []
+            for indexes in self._batches(provider, emails, pending):
+                try:
+                    response = self._attempt_many(
+                        klass, provider, [emails[i] for i in indexes],
+                        sess.request, self._deadline(deadlines, indexes)
+                    )
+                except DeadlineExceededError as e:
+                    _LOG.warning("%s, giving up on %s emails", e,
+                                 len(indexes))
+                    continue
+                if response is None:
+                    failed.extend(indexes)
+                    continue
+                for i in indexes:
+                    results[i] = (response, provider.nickname)
+            pending = sorted(failed)
+
+        return results
+
+    def _deadline(self, deadlines, indexes):
+        """Returns the deadline of a batch: the earliest of its emails,
+        whose clocks start at their first attempt.
+
+        Args:
+          deadlines (dict): Deadline of the emails by index, completed
+          indexes (list[int]): The emails of the batch
+        """
+        if self.timeouts is None:
+            return None
+        for i in indexes:
+            if i not in deadlines:
+                deadlines[i] = self.timeouts.deadline()
+        return min((deadlines[i] for i in indexes),
+                   key=lambda deadline: deadline.remaining())
+
+    def _attempt_many(self, klass, provider, emails, request_func,
+                      deadline):
+        """Sends emails with a provider, in a single call.
+
+        Returns:
+          The response, None if the provider failed
+        """
+        if not self._can_send(provider, *emails) or \
+           not self._enter(provider):
+            return None
+        start = time.monotonic()
+        try:
+            if not self._acquire(provider, deadline):
+                return None
+            if len(emails) == 1:
+                req = self._prep_request(emails[0], provider, request_func)
+            else:
+                req = self._prep_batch_request(emails, provider,
+                                               request_func)
+            kwargs = self._request_kwargs(provider, deadline)
+            if not self._allow(provider):
+                return None
+            response = req(**kwargs)
+        except FAILOVER_ERRORS as e:
+            self._on_error(klass, e, time.monotonic() - start)
+            return None
+        finally:
+            self._leave(provider)
+
+        if self._on_response(provider, response, time.monotonic() - start):
+            return response
+        return None
+
+    @staticmethod
+    def _batches(provider, emails, indexes):
+        """Groups the emails at `indexes` in batches for a provider.
+
+        Yields:
+          list[int]: The indexes of the emails of a batch
+        """
+        size = provider.max_batch_size or 1
+        groups = {}
+        for i in indexes:
+            key = provider.batch_key(emails[i]) if size > 1 else None
+            if key is None:
+                yield [i]
+            else:
+                groups.setdefault(key, []).append(i)
+
+        for group in groups.values():
+            for start in range(0, len(group), size):
+                yield group[start:start + size]
+
+    def _can_send(self, provider, *emails):
+        """Returns False if the provider lacks a feature the emails need,
+        e.g. attachments, or if its circuit breaker skips it.
+        """
+        if any(email.files for email in emails) and \
+           not getattr(provider, 'attachment_field', None):
+            _LOG.info("%s can't send attachments, skipped",
+                      provider.nickname)
+            return False
+        if self.breakers is not None and \
+           self.breakers.skips(provider.nickname):
+            return False
+        return True
+
+    def _allow(self, provider):
+        """Called right before a request, nothing may skip it once this
+        returned True: it takes the probe slot of a half-open breaker.
+
+        Returns:
+          bool: False if the circuit breaker skips the provider
+        """
+        return self.breakers is None or \
+            self.breakers.allow(provider.nickname)
+
+    def _enter(self, provider):
+        """Takes an in flight slot of a provider, see
+        `email_api.concurrency`.
+
+        Returns:
+          bool: False if the provider is full or backing off, to move on
+        """
+        if self.concurrency is None or \
+           self.concurrency.get(provider.nickname).acquire():
+            return True
+        _LOG.info("%s is at its concurrency limit, moving on",
+                  provider.nickname)
+        return False
+
+    def _leave(self, provider):
+        """Frees the slot taken by `_enter`, if any.
+        """
+        if provider is not None and self.concurrency is not None:
+            self.concurrency.get(provider.nickname).release()
+
+    def _max_wait(self, deadline):
+        return deadline.remaining() if deadline is not None else None
+
+    def _acquire(self, provider, deadline):
+        """Takes a token from the rate limits of a provider, waiting a bit
+        if it is over them.
+
+        Returns:
+          bool: False if the provider is over its rate limits, to move on
+        """
+        if self.rate_limits is None:
+            return True
+        if self.rate_limits.acquire(provider.nickname,
+                                    self._max_wait(deadline)):
+            return True
+        self._on_throttled(provider)
+        return False
+
+    @staticmethod
+    def _on_throttled(provider):
+        _LOG.warning("%s is over its rate limit, moving on",
+                     provider.nickname)
+        metrics.THROTTLED.inc(provider=provider.nickname)
+
+    def _request_kwargs(self, provider, deadline):
+        """Returns the extra arguments of the request call: its timeout.
+
+        Raises:
+          DeadlineExceededError: If there is no time left
+        """
+        if deadline is None:
+            return {}
+        timeout = deadline.timeout(
+            *self.timeouts.for_provider(provider.nickname)
+        )
+        return {'timeout': timeout}
+
+    def _ordered(self):
+        """Returns the provider classes in the order they should be tried.
+        """
+        providers = self.provider_classes
+        if self.breakers is not None:
+            providers = self.breakers.order(providers, _nickname)
+        if self.concurrency is not None:
+            providers = self.concurrency.order(providers, _nickname)
+        return providers
+
+    def _record(self, nickname, success, elapsed, answer=None):
+        if self.breakers is not None:
+            breaker = self.breakers.get(nickname)
+            if success or not _provider_failed(answer):
+                # A rejected email (4XX) says nothing of the provider
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+        if self.stats is not None:
+            self.stats.record(nickname, success, elapsed)
+        metrics.ATTEMPTS.inc(provider=nickname)
+        metrics.LATENCY.observe(elapsed, provider=nickname)
+
+    def _on_response(self, provider, response, elapsed):
+        """Called with each provider response.
+
+        Args:
+          provider (AProvider): The provider that answered
+          response: Its response
+          elapsed (float): Seconds the attempt took
+
+        Returns:
+          bool: True if the email was sent, False to move on
+        """
+        success = bool(provider.is_success(response))
+        self._record(provider.nickname, success, elapsed, response)
+        if self.concurrency is not None:
+            self.concurrency.record_response(provider.nickname, response,
+                                             success)
+        if success:
+            metrics.SUCCESSES.inc(provider=provider.nickname)
+        else:
+            metrics.FAILURES.inc(provider=provider.nickname, error='Rejected')
+            _LOG.error(
+                "Failed to send with %s moving on",
+                provider.nickname
+            )
+        return success
+
+    def _on_error(self, klass, error, elapsed):
+        """Called for each provider that raised one of `FAILOVER_ERRORS`
+        """
+        self._record(_nickname(klass), False, elapsed,
+                     getattr(error, 'response', None))
+        if self.concurrency is not None:
+            self.concurrency.record_error(_nickname(klass), error)
+        metrics.FAILURES.inc(provider=_nickname(klass),
+                             error=type(error).__name__)
+        if isinstance(error, (InvalidProviderError,
+                              requests.exceptions.MissingSchema)):
+            # Failing here means bad coding/config
+            _LOG.exception(
+                "%s is an invalid provider class", klass
+            )
+        else:
+            # HTTPError if 4XX most likely because of unsanitized or bad
+            # data format
+            _LOG.warning(error)
+
     def handle_callback(self, name, data):
-        # Implement webhook callbacks here.
-        # Dispatch to providers here and return structured data
-        pass
+        """Dispatches a webhook call to its provider.
+
+        Args:
+          name (str): Nickname of the provider
+          data (dict): The JSON body, or the parameters of the call
+
+        Raises:
+          InvalidProviderError: If no provider has this nickname, or it
+            has no webhooks
+          email_api.abstract_provider.InvalidCallbackError: If the call
+            is malformed, or not from the provider
+
+        Returns:
+          list[email_api.webhooks.DeliveryEvent]
+        """
+        for klass in self.provider_classes:
+            if _nickname(klass) != name:
+                continue
+            try:
+                events = self._provider(klass).parse_callback(data)
+            except NotImplementedError as e:
+                raise InvalidProviderError(str(e))
+            for event in events:
+                metrics.WEBHOOK_EVENTS.inc(provider=name, event=event.event)
+            return events
+        raise InvalidProviderError("Unknown provider: {}".format(name))
+
+    def message_id(self, response, name):
+        """Returns the ID a provider gave to an email it sent, None if
+        unknown (e.g. email sent in chunks).
+        """
+        if isinstance(response, ChunkedResponse):
+            return None
+        for klass in self.provider_classes:
+            if _nickname(klass) == name:
+                return self._provider(klass).message_id(response)
+        return None
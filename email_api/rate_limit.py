@@ -0,0 +1,300 @@
+"""Token bucket rate limits of the providers, shared by the workers.
+
+Provider plans come with quotas (calls per second, per day...). Without
+coordination the gunicorn workers burst over them and get 429s. Each
+limit of a provider is a token bucket: a call takes a token, tokens come
+back at the rate of the limit, up to the bucket capacity. When a bucket
+is empty the `ProvidersManager` waits a bit for a token (`max_wait`),
+then moves on to the next provider rather than making a call bound to
+fail::
+
+    rate_limiting:
+      path: rate_limits.db  # SQLite file shared by the workers
+      max_wait: 0.5         # Seconds to wait for a token
+
+    providers:
+      mailgun:
+        rate_limit:
+          per_second: 10    # Also per_minute, per_hour, per_day
+          burst: 20         # Capacity of the per_second bucket
+
+One token is taken per API call, a batch call counts as one. The bucket
+of a `per_day` limit refills continuously (per_day / 86400 tokens per
+second), it does not reset at midnight.
+
+Without a `path` the buckets live in memory and each worker gets the
+whole quota: divide the limits by the number of workers.
+
+"""
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+
+RATE_LIMITING_KEY = 'rate_limiting'
+RATE_LIMIT_KEY = 'rate_limit'  # Under providers.<nickname>
+DEFAULTS = {
+    'path': None,
+    'max_wait': 0.5,
+}
+
+PERIODS = {
+    'per_second': 1,
+    'per_minute': 60,
+    'per_hour': 3600,
+    'per_day': 86400,
+}
+
+Bucket = namedtuple('Bucket', ['key', 'capacity', 'rate'])
+"""A limit: its store `key`, `capacity` in tokens and refill `rate` in
+tokens per second.
+"""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS token_buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+
+def buckets_from_config(nickname, config):
+    """Returns the buckets of a provider.
+
+    Args:
+      nickname (str):
+      config (Optional[dict]): The `rate_limit` section of the provider
+
+    Raises:
+      ValueError: If a limit is unknown or not positive
+
+    Returns:
+      list[Bucket]
+    """
+    config = dict(config or {})
+    burst = config.pop('burst', None)
+    buckets = []
+    for name, amount in sorted(config.items()):
+        if name not in PERIODS:
+            raise ValueError("Unknown rate limit: {}".format(name))
+        if not amount or amount <= 0:
+            raise ValueError("Rate limit {} must be positive".format(name))
+        capacity = burst if name == 'per_second' and burst else amount
+        buckets.append(Bucket('{}:{}'.format(nickname, name), capacity,
+                              amount / PERIODS[name]))
+    return buckets
+
+
+def _take(states, buckets, now):
+    """Refills the buckets, and takes a token from each if they all have
+    one.
+
+    Args:
+      states (dict): (tokens, updated) by bucket key, missing for full
+        buckets. Updated in place if the tokens are taken
+      buckets (list[Bucket]):
+      now (float):
+
+    Returns:
+      float: 0 if the tokens were taken, the seconds until they can be
+        taken otherwise
+    """
+    levels = {}
+    wait = 0
+    for bucket in buckets:
+        tokens, updated = states.get(bucket.key, (bucket.capacity, now))
+        tokens = min(bucket.capacity,
+                     tokens + max(now - updated, 0) * bucket.rate)
+        levels[bucket.key] = tokens
+        if tokens < 1:
+            wait = max(wait, (1 - tokens) / bucket.rate)
+    if wait:
+        return wait
+    for key, tokens in levels.items():
+        states[key] = (tokens - 1, now)
+    return 0
+
+
+class MemoryBucketStore:
+    """Buckets of a single process.
+    """
+    blocking = False
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def take(self, buckets):
+        """Takes a token from each bucket, all or none.
+
+        Returns:
+          float: 0 if the tokens were taken, the seconds to wait otherwise
+        """
+        with self._lock:
+            return _take(self._states, buckets, self._clock())
+
+
+class SqliteBucketStore:
+    """Buckets in a SQLite file, shared by all the processes using it.
+
+    Thread-safe: every thread gets its own connection.
+    """
+    blocking = True  # Waits for the file lock, and for the disk
+
+    def __init__(self, path, clock=time.time):
+        """
+        Args:
+          path (str): The SQLite file, created if need be
+          clock (callable): Wall clock, the same for all the processes
+        """
+        self.path = path
+        self._clock = clock
+        self._local = threading.local()
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self):
+        # Connections can't be shared across threads, nor processes
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None
+            )
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')  # Losing it is harmless
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def take(self, buckets):
+        """Same as `MemoryBucketStore.take`, in a transaction.
+        """
+        conn = self._conn()
+        keys = [bucket.key for bucket in buckets]
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            states = {
+                key: (tokens, updated)
+                for key, tokens, updated in conn.execute(
+                    'SELECT key, tokens, updated FROM token_buckets '
+                    'WHERE key IN ({})'.format(','.join('?' * len(keys))),
+                    keys
+                )
+            }
+            wait = _take(states, buckets, self._clock())
+            if not wait:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO token_buckets '
+                    '(key, tokens, updated) VALUES (?, ?, ?)',
+                    [(key,) + states[key] for key in keys]
+                )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return wait
+
+
+class RateLimiter:
+    """The buckets of every provider with a `rate_limit`.
+    """
+
+    def __init__(self, limits, store=None, max_wait=0.5,
+                 clock=time.monotonic):
+        """
+        Args:
+          limits (dict): list of `Bucket` by provider nickname
+          store: `MemoryBucketStore` (default) or `SqliteBucketStore`
+          max_wait (float): Max seconds `acquire` waits for a token
+          clock (callable): Returns the current time in seconds, to
+            measure waits
+        """
+        self.limits = {nick: buckets for nick, buckets in limits.items()
+                       if buckets}
+        self.store = store if store is not None else MemoryBucketStore()
+        self.max_wait = max_wait
+        self._clock = clock
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Args:
+          config (dict): The full application config
+
+        Raises:
+          ValueError: If a rate limit is invalid
+
+        Returns:
+          RateLimiter: None if no provider has a rate limit
+        """
+        limits = {
+            nick: buckets_from_config(nick,
+                                      (conf or {}).get(RATE_LIMIT_KEY))
+            for nick, conf in (config.get('providers') or {}).items()
+        }
+        if not any(limits.values()):
+            return None
+        conf = dict(DEFAULTS, **(config.get(RATE_LIMITING_KEY) or {}))
+        store = SqliteBucketStore(conf['path']) if conf['path'] else None
+        return cls(limits, store, conf['max_wait'])
+
+    def try_acquire(self, nickname):
+        """Takes a token for a call to a provider, if there is one.
+
+        Returns:
+          float: 0 if the call can be made, the seconds until a token is
+            available otherwise
+        """
+        buckets = self.limits.get(nickname)
+        if not buckets:
+            return 0
+        return self.store.take(buckets)
+
+    def _max_wait(self, max_wait):
+        return self.max_wait if max_wait is None \
+            else min(max_wait, self.max_wait)
+
+    def acquire(self, nickname, max_wait=None):
+        """Takes a token for a call to a provider, waiting for one if it
+        comes soon enough.
+
+        Args:
+          nickname (str):
+          max_wait (Optional[float]): Seconds, capped by `max_wait`
+
+        Returns:
+          bool: False if there was no token in time
+        """
+        end = self._clock() + self._max_wait(max_wait)
+        while True:
+            wait = self.try_acquire(nickname)
+            if not wait:
+                return True
+            if self._clock() + wait > end:
+                return False
+            time.sleep(wait)
+
+    async def acquire_async(self, nickname, max_wait=None):
+        """Same as `acquire`, without blocking the event loop: a store
+        doing I/O is queried in the default executor, and waits are
+        `asyncio.sleep`.
+        """
+        if nickname not in self.limits:
+            return True
+        loop = asyncio.get_running_loop()
+        end = self._clock() + self._max_wait(max_wait)
+        while True:
+            if self.store.blocking:
+                wait = await loop.run_in_executor(None, self.try_acquire,
+                                                  nickname)
+            else:
+                wait = self.try_acquire(nickname)
+            if not wait:
+                return True
+            if self._clock() + wait > end:
+                return False
+            await asyncio.sleep(wait)
@@ -0,0 +1,260 @@
+"""Picks the providers order of an email from its recipients.
+
+The `routes` section of the config is compiled once at startup into a
+`Router`. Each routing type (e.g. `recipients`) holds an ordered list of
+rules, the first rule matching one of the 'to' recipients wins::
+
+    routes:
+      default:
+        - elasticemail
+        - mailgun
+      recipients:
+        - domains:           # Exact domain, or suffix with a leading dot
+            - hotmail.com
+            - .outlook.com   # outlook.com and any sub domain
+          providers:
+            - mailgun
+        - regex: '.*@((hotmail)|(outlook)|(live))\\..*'
+          providers:
+            - mailgun
+            - elasticemail
+
+`domains` rules go into hash indexes (exact and suffix) so matching
+costs O(recipients), whatever the number of rules. `regex` rules are the
+fallback: they are matched against each address and only tried when no
+domain rule with a higher priority matched.
+
+Results are kept in a bounded LRU, by domain (or by address if the
+routing type has regex rules).
+
+`Router.split` routes each 'to' recipient on its own instead: an email
+to hotmail and gmail addresses is split in one email per matching rule,
+each sent through its own providers.
+
+"""
+import logging
+import re
+
+from email_api.cache import LRUCache
+
+
+_LOG = logging.getLogger()
+
+
+DEFAULT_ROUTE = 'default'
+
+
+class UnconfiguredRouteError(Exception):
+    """Raise if a route or a provider used in a route is not configured.
+    """
+    pass
+
+
+def _domain(address):
+    return address.rpartition('@')[2].lower()
+
+
+class RouteTable:
+    """The compiled rules of one routing type.
+    """
+
+    def __init__(self, rules, cache_size=4096):
+        """
+        Args:
+          rules (list[dict]): Rules as found in the config, each has a
+            `providers` list and `domains` and/or `regex`
+          cache_size (int): Max entries of the match cache
+
+        Raises:
+          UnconfiguredRouteError: If a rule is malformed
+        """
+        self.providers = []
+        self._exact = {}
+        self._suffix = {}
+        self._regexes = []
+
+        for index, rule in enumerate(rules):
+            if not isinstance(rule, dict) or not rule.get('providers'):
+                raise UnconfiguredRouteError(
+                    "Rule #{} must have a list of providers".format(index)
+                )
+            if not rule.get('domains') and not rule.get('regex'):
+                raise UnconfiguredRouteError(
+                    "Rule #{} must have 'domains' or 'regex'".format(index)
+                )
+            self.providers.append(list(rule['providers']))
+
+            for domain in rule.get('domains') or []:
+                domain = domain.lower().lstrip('*')
+                index_ = self._suffix if domain.startswith('.') else \
+                    self._exact
+                # First rule wins
+                index_.setdefault(domain.lstrip('.'), index)
+
+            if rule.get('regex'):
+                try:
+                    self._regexes.append((index, re.compile(rule['regex'])))
+                except re.error as e:
+                    raise UnconfiguredRouteError(
+                        "Rule #{} has an invalid regex: {}".format(index, e)
+                    ) from e
+
+        self._cache = LRUCache(cache_size)
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def _match_domain(self, domain):
+        """Returns the index of the first domain rule matching, or None.
+        """
+        found = self._exact.get(domain)
+        # Walk up the labels: a.b.c -> a.b.c, b.c, c
+        suffix = domain
+        while suffix:
+            index = self._suffix.get(suffix)
+            if index is not None and (found is None or index < found):
+                found = index
+            suffix = suffix.partition('.')[2]
+        return found
+
+    def _match(self, address):
+        found = self._match_domain(_domain(address))
+        for index, regex in self._regexes:
+            if found is not None and index >= found:
+                break
+            res = regex.match(address)
+            if res and res.group(0):
+                return index
+        return found
+
+    def match(self, address):
+        """Returns the index of the first rule matching an address, or None.
+
+        Args:
+          address (str): An email address
+        """
+        key = address if self._regexes else _domain(address)
+        return self._cache.get_or_set(key, lambda _: self._match(address))
+
+    def match_all(self, addresses):
+        """Returns the index of the first rule matching any of the
+        addresses, or None.
+        """
+        best = None
+        for address in addresses:
+            index = self.match(address)
+            if index is not None and (best is None or index < best):
+                best = index
+                if best == 0:
+                    break
+        return best
+
+
+class Router:
+    """The compiled `routes` config.
+    """
+
+    def __init__(self, routes, provider_by_nick, cache_size=4096):
+        """
+        Args:
+          routes (dict): The `routes` section of the config
+          provider_by_nick (dict): Provider classes by nickname
+          cache_size (int): Max entries of the match cache of each
+            routing type
+
+        Raises:
+          UnconfiguredRouteError: If the config has malformed rules
+        """
+        routes = routes or {}
+        self._provider_by_nick = provider_by_nick
+        self.default = self._order(
+            routes.get(DEFAULT_ROUTE) or list(provider_by_nick)
+        )
+        self.tables = {
+            name: RouteTable(rules or [], cache_size)
+            for name, rules in routes.items() if name != DEFAULT_ROUTE
+        }
+        # Resolve the nicknames once, and catch typos at startup
+        self._orders = {
+            name: [self._order(nicks) for nicks in table.providers]
+            for name, table in self.tables.items()
+        }
+
+    def _order(self, nicks):
+        order = []
+        for nick in nicks:
+            if nick not in self._provider_by_nick:
+                # Not registered, e.g. commented out of the code
+                _LOG.warning("Unknown provider in routes: %s, ignored", nick)
+                continue
+            order.append(self._provider_by_nick[nick])
+        return order
+
+    def route(self, email, routing_type):
+        """Returns the providers order to use for an email.
+
+        Args:
+          email (class:Email): The email to route
+          routing_type (str): One of the configured routing types
+
+        Raises:
+          UnconfiguredRouteError: If the routing type does not exist
+
+        Returns:
+          list[AProvider]: Provider classes, by priority
+        """
+        self._check(routing_type)
+        index = self.tables[routing_type].match_all(
+            email.recipient_addresses('to')
+        )
+        if index is None:
+            return list(self.default)
+        return list(self._orders[routing_type][index])
+
+    def split(self, email, routing_type):
+        """Groups the 'to' recipients of an email by matching rule.
+
+        cc and bcc recipients are not routed, they go with the group of
+        the rule `route` would have picked, so they get a single copy.
+
+        Args:
+          email (class:Email): The email to route
+          routing_type (str): One of the configured routing types
+
+        Raises:
+          UnconfiguredRouteError: If the routing type does not exist
+
+        Returns:
+          list[tuple]: (email, providers) of each group, the emails are
+            frozen copies with the recipients of the group. The email
+            itself (frozen) if it has a single group
+        """
+        self._check(routing_type)
+        table = self.tables[routing_type]
+        orders = self._orders[routing_type]
+
+        groups = {}
+        for recp in email.get_recipients('to'):
+            groups.setdefault(table.match(recp.email), []).append(recp)
+        if len(groups) <= 1:
+            return [(email.freeze(), self.route(email, routing_type))]
+
+        # Same pick as `route`: the rule with the highest priority
+        first = min((i for i in groups if i is not None), default=None)
+        groups[first].extend(
+            r for r in email.get_recipients() if r.type_ != 'to'
+        )
+        return [
+            (
+                email.with_recipients(recps),
+                list(self.default if index is None else orders[index])
+            )
+            for index, recps in groups.items()
+        ]
+
+    def _check(self, routing_type):
+        if routing_type not in self.tables:
+            raise UnconfiguredRouteError(
+                "Unknown route type: {}".format(routing_type)
+            )
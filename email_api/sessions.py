@@ -0,0 +1,126 @@
+"""Long-lived HTTP sessions, one per provider.
+
+Opening a fresh `requests.session()` for every email means a new TCP
+and TLS handshake with the provider API on every call. Instead the
+`SessionPool` keeps one `requests.Session` per provider nickname, each
+mounted with its own urllib3 connection pool, and hands it out to every
+request of the worker.
+
+The urllib3 pool is thread-safe, we never mutate the sessions after
+they are built (no cookies, no per-request headers), so they can be
+shared by all the threads of a worker.
+
+Note:
+    The pool is created in `email_api.api.start_app` before gunicorn
+    forks its workers. That's fine because sessions are built lazily and
+    no socket is opened before the first request, so each worker ends
+    up with its own connections.
+
+"""
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+_LOG = logging.getLogger()
+HTTP_KEY = 'http'
+
+DEFAULTS = {
+    'pool_size': 10,
+    'pool_block': False,
+    'keep_alive': True,
+    'max_retries': 0,
+}
+
+
+class SessionPool:
+    """Hands out one shared `requests.Session` per provider nickname.
+
+    Settings are read from the `http` section of the config and can be
+    overridden per provider under `providers.<nickname>.http`::
+
+        http:
+          pool_size: 10      # Max connections kept alive per host
+          pool_block: false  # Block instead of opening extra connections
+          keep_alive: true
+          max_retries: 0     # Retries are handled by the failover loop
+
+    """
+
+    def __init__(self, config=None):
+        """
+        Args:
+          config (Optional[dict]): The full application config
+        """
+        config = config or {}
+        self._defaults = dict(DEFAULTS, **(config.get(HTTP_KEY) or {}))
+        self._providers_conf = config.get('providers') or {}
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def settings(self, nickname):
+        """Returns the effective HTTP settings for a provider.
+
+        Args:
+          nickname (str): The provider nickname
+
+        Returns:
+          dict
+        """
+        provider_conf = self._providers_conf.get(nickname) or {}
+        return dict(self._defaults, **(provider_conf.get(HTTP_KEY) or {}))
+
+    def _build(self, nickname):
+        settings = self.settings(nickname)
+        adapter = HTTPAdapter(
+            pool_connections=1,  # A provider talks to a single host
+            pool_maxsize=settings['pool_size'],
+            pool_block=settings['pool_block'],
+            max_retries=settings['max_retries']
+        )
+        sess = requests.Session()
+        sess.mount('https://', adapter)
+        sess.mount('http://', adapter)
+        if not settings['keep_alive']:
+            sess.headers['Connection'] = 'close'
+        return sess
+
+    def get(self, nickname):
+        """Returns the session of a provider, building it on first use.
+
+        Args:
+          nickname (str): The provider nickname
+
+        Raises:
+          RuntimeError: If the pool was closed
+
+        Returns:
+          requests.Session
+        """
+        sess = self._sessions.get(nickname)
+        if sess is not None:
+            return sess
+
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Session pool is closed")
+            if nickname not in self._sessions:
+                self._sessions[nickname] = self._build(nickname)
+            return self._sessions[nickname]
+
+    def close(self):
+        """Closes all sessions and their connections.
+        Safe to call more than once.
+        """
+        with self._lock:
+            self._closed = True
+            sessions, self._sessions = self._sessions, {}
+
+        for nickname, sess in sessions.items():
+            try:
+                sess.close()
+            except Exception:  # pylint: disable=W0703
+                _LOG.exception("Failed to close %s session", nickname)
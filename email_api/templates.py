@@ -0,0 +1,88 @@
+"""Mail merge templates: the same email to many recipients, with small
+per recipient substitutions.
+
+Placeholders look like `{{ name }}`, there is no logic and no escaping::
+
+    Hello {{ first_name }}, your code is {{code}}
+
+Templates are compiled once and cached by the hash of their content, so
+rendering thousands of recipients (or resending the same campaign) does
+not parse them again. Providers with server side substitution (see
+`email_api.abstract_provider.AProvider.supports_templates`) get the
+template translated to their own syntax instead, with `Template.to`.
+
+"""
+import hashlib
+import re
+
+from email_api.cache import LRUCache
+
+
+_PLACEHOLDER = re.compile(r'\{\{\s*([A-Za-z_][\w.-]*)\s*\}\}')
+
+cache = LRUCache(maxsize=1024)
+"""Compiled templates by sha256 of their source.
+"""
+
+
+class Template:
+    """A compiled template.
+    """
+    __slots__ = ('source', 'variables', '_parts')
+
+    def __init__(self, source):
+        """
+        Args:
+          source (str): The template
+        """
+        self.source = source
+        # Literals at even indexes, variable names at odd ones
+        self._parts = tuple(_PLACEHOLDER.split(source))
+        self.variables = frozenset(self._parts[1::2])
+
+    def render(self, variables):
+        """Substitutes the placeholders, missing variables are rendered
+        as empty strings.
+
+        Args:
+          variables (dict): Values by variable name
+
+        Returns:
+          str
+        """
+        return self.to(lambda name: str(variables.get(name, '')))
+
+    def to(self, placeholder):
+        """Translates the template, e.g. to a provider syntax::
+
+            template.to('%recipient.{}%'.format)
+
+        Args:
+          placeholder (callable): Returns the replacement of a variable
+            from its name
+
+        Returns:
+          str
+        """
+        parts = list(self._parts)
+        for i in range(1, len(parts), 2):
+            parts[i] = placeholder(parts[i])
+        return ''.join(parts)
+
+
+def compile_template(source):
+    """Returns the compiled template of a source, from the cache if it
+    was already compiled.
+
+    Args:
+      source (Optional[str]):
+
+    Returns:
+      Template: None if source is None
+    """
+    if source is None:
+        return None
+    key = hashlib.sha256(
+        source.encode('utf-8', 'surrogatepass')
+    ).hexdigest()
+    return cache.get_or_set(key, lambda _: Template(source))
@@ -0,0 +1,196 @@
+"""Async HTTP transports for `email_api.async_manager.AsyncProvidersManager`.
+
+A transport is the only piece of the async manager doing I/O, so it can
+be swapped: `AiohttpTransport` for production, `InMemoryTransport` for
+tests.
+
+Transports must raise `requests` exceptions (`requests.ConnectionError`,
+`requests.Timeout`...) so that the failover loop handles them exactly
+like the blocking `ProvidersManager` does, and return objects quacking
+like a `requests.Response` (`status_code`, `headers`, `text`, `json()`)
+so providers' `is_success` work unchanged.
+
+"""
+import asyncio
+import json as json_lib
+from abc import ABC, abstractmethod
+
+import requests
+
+# Optional dependency, only needed by `AiohttpTransport`
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+
+class TransportResponse:
+    """Minimal `requests.Response` look-alike.
+    """
+
+    def __init__(self, status_code, text='', headers=None):
+        self.status_code = status_code
+        self.text = text
+        # Case insensitive, like `requests.Response.headers`
+        self.headers = requests.structures.CaseInsensitiveDict(headers or {})
+
+    def json(self):
+        return json_lib.loads(self.text)
+
+    def __bool__(self):
+        return self.status_code < 400
+
+    def __repr__(self):
+        return '<TransportResponse [{}]>'.format(self.status_code)
+
+
+class AsyncTransport(ABC):
+    """Async counterpart of `requests.Session.request`.
+    """
+
+    @abstractmethod
+    async def request(self, method, url, auth=None, data=None, json=None,
+                      params=None, timeout=None, headers=None):
+        """Sends an HTTP request.
+
+        Args:
+          method (str): HTTP method
+          url (str):
+          auth (Optional[tuple]): (user, password) for basic auth
+          data (Optional[dict|file]): Form parameters, or a file-like
+            body streamed as it is read (e.g. a
+            `email_api.attachments.MultipartBody`)
+          json (Optional[dict]): JSON body
+          params (Optional[dict]): Query parameters
+          timeout (Optional[float|tuple]): Total timeout in seconds, or
+            (connect, read) timeouts like `requests`
+          headers (Optional[dict]): Extra request headers
+
+        Raises:
+          requests.RequestException
+
+        Returns:
+          TransportResponse
+        """
+        pass
+
+    async def close(self):
+        """Releases the connections, if any.
+        """
+        pass
+
+
+def _fields(values):
+    """Flattens a dict like `requests` does for form and query
+    parameters: list values are repeated, None values are dropped.
+    """
+    fields = []
+    for key, value in (values or {}).items():
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        fields.extend((key, str(v)) for v in value if v is not None)
+    return fields
+
+
+class AiohttpTransport(AsyncTransport):
+    """Transport based on aiohttp, keeps a pool of connections alive.
+    """
+
+    def __init__(self, pool_size=100, timeout=30):
+        """
+        Args:
+          pool_size (int): Max simultaneous connections
+          timeout (float): Default total timeout in seconds
+        """
+        if aiohttp is None:
+            raise RuntimeError("AiohttpTransport requires aiohttp")
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._session = None
+
+    def _get_session(self):
+        # Must be created from within the running loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._pool_size)
+            )
+        return self._session
+
+    async def request(self, method, url, auth=None, data=None, json=None,
+                      params=None, timeout=None, headers=None):
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            timeout = aiohttp.ClientTimeout(sock_connect=connect,
+                                            sock_read=read)
+        else:
+            timeout = aiohttp.ClientTimeout(total=timeout or self._timeout)
+        kwargs = {'params': _fields(params), 'timeout': timeout,
+                  'headers': headers}
+        if auth:
+            kwargs['auth'] = aiohttp.BasicAuth(*auth)
+        if json is not None:
+            kwargs['json'] = json
+        elif isinstance(data, dict):
+            kwargs['data'] = aiohttp.FormData(_fields(data))
+        elif data is not None:  # Streamed body
+            kwargs['data'] = data
+
+        try:
+            async with self._get_session().request(method, url,
+                                                   **kwargs) as resp:
+                text = await resp.text()
+                return TransportResponse(resp.status, text, resp.headers)
+        except asyncio.TimeoutError as e:
+            raise requests.Timeout(e) from e
+        except aiohttp.TooManyRedirects as e:
+            raise requests.TooManyRedirects(e) from e
+        except aiohttp.InvalidURL as e:
+            raise requests.exceptions.MissingSchema(e) from e
+        except aiohttp.ClientError as e:
+            raise requests.ConnectionError(e) from e
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class InMemoryTransport(AsyncTransport):
+    """Transport that never leaves the process, for tests.
+
+    Responses are looked up by url. A value can be a `TransportResponse`,
+    an exception (instance or class) to raise, or a callable taking the
+    request kwargs and returning one of the above.
+
+    Every request is recorded in `calls`.
+    """
+
+    def __init__(self, responses=None, default=None, delay=0):
+        """
+        Args:
+          responses (Optional[dict]): Responses by url
+          default (Optional[TransportResponse]): Returned for unknown urls,
+            defaults to an empty 200
+          delay (float): Simulated latency in seconds
+        """
+        self.responses = responses or {}
+        self.default = default if default is not None else \
+            TransportResponse(200, '{}')
+        self.delay = delay
+        self.calls = []
+
+    async def request(self, method, url, auth=None, data=None, json=None,
+                      params=None, timeout=None, headers=None):
+        call = dict(method=method, url=url, auth=auth, data=data, json=json,
+                    params=params, timeout=timeout, headers=headers)
+        self.calls.append(call)
+        if self.delay:
+            await asyncio.sleep(self.delay)
+
+        result = self.responses.get(url, self.default)
+        if callable(result) and not isinstance(result, type):
+            result = result(call)
+        if isinstance(result, BaseException) or \
+           (isinstance(result, type) and issubclass(result, BaseException)):
+            raise result
+        return result
@@ -0,0 +1,182 @@
+"""Delivery events posted by the providers to POST /webhook/<provider>.
+
+Providers call us for every delivery, bounce, open... at several times
+our send rate, and retry when we are slow to answer. The endpoint only
+parses the events (`AProvider.parse_callback`) and puts them in a
+bounded in-memory queue. A writer thread per worker saves them to the
+outbox database: all the events queued while it was saving the previous
+ones go in one transaction (up to `batch_size`), rather than one
+transaction per call::
+
+    webhooks:
+      queue_size: 10000   # Events waiting to be saved, 503 beyond
+      batch_size: 500     # Max events per transaction
+
+Events are matched to the emails of the outbox by the message ID the
+provider gave when it accepted them, see `GET /email/<id>`.
+
+Events that could not be saved (e.g. the database is locked) go back
+to the front of the queue, the writer retries them with an exponential
+backoff.
+
+Note:
+    Queued events are lost if the worker is killed before it saves them.
+    They are saved on a graceful stop.
+
+"""
+import logging
+import threading
+from collections import deque, namedtuple
+
+
+_LOG = logging.getLogger()
+WEBHOOKS_KEY = 'webhooks'
+
+DEFAULTS = {
+    'queue_size': 10000,
+    'batch_size': 500,
+    'poll_interval': 1,
+}
+MAX_BACKOFF = 60  # Seconds between retries of a failed save
+
+# Event types, providers map theirs to these
+ACCEPTED = 'accepted'
+DELIVERED = 'delivered'
+DEFERRED = 'deferred'
+BOUNCED = 'bounced'
+DROPPED = 'dropped'
+COMPLAINED = 'complained'
+UNSUBSCRIBED = 'unsubscribed'
+OPENED = 'opened'
+CLICKED = 'clicked'
+
+DeliveryEvent = namedtuple('DeliveryEvent', [
+    'provider', 'message_id', 'recipient', 'event', 'timestamp', 'reason'
+])
+"""A provider callback, standardized: the `provider` nickname, the
+`message_id` it gave when accepting the email, the `recipient` address,
+the `event` type, its UNIX `timestamp` and an optional `reason` (e.g.
+the bounce message).
+"""
+
+
+class QueueFullError(Exception):
+    """Raise if events come faster than they are saved.
+    """
+    pass
+
+
+class EventQueue:
+    """Events waiting to be saved, and the thread saving them.
+
+    Must be started in each process, after the fork for gunicorn.
+    """
+
+    def __init__(self, save, queue_size=10000, batch_size=500,
+                 poll_interval=1):
+        """
+        Args:
+          save (callable): Saves a list of `DeliveryEvent` in one
+            transaction, e.g. `email_api.outbox.Outbox.add_events`
+          queue_size (int): Max events waiting
+          batch_size (int): Max events per `save`
+          poll_interval (float): Seconds between checks for `stop` when
+            idle
+        """
+        self._save = save
+        self._events = deque()
+        self._queue_size = queue_size
+        self._not_empty = threading.Condition()
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._failures = 0
+
+    @classmethod
+    def from_config(cls, save, config):
+        """
+        Args:
+          save (callable): See `__init__`
+          config (Optional[dict]): The `webhooks` section of the config
+        """
+        conf = dict(DEFAULTS, **(config or {}))
+        return cls(save, conf['queue_size'], conf['batch_size'],
+                   conf['poll_interval'])
+
+    def put(self, events):
+        """Queues the events of a call, all or none of them, without
+        blocking.
+
+        Raises:
+          QueueFullError: If they don't all fit, none is queued: the
+            provider should be told to retry the whole call
+        """
+        events = list(events)
+        with self._not_empty:
+            if len(self._events) + len(events) > self._queue_size:
+                raise QueueFullError(
+                    "{} events waiting to be saved".format(len(self._events))
+                )
+            self._events.extend(events)
+            self._not_empty.notify()
+
+    def __len__(self):
+        return len(self._events)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='webhook-events')
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        """Stops the writer once the queued events are saved.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self.flush_once(self._poll_interval) and self._failures:
+                # Don't hammer a database that is down
+                self._stop.wait(min(
+                    self._poll_interval * 2 ** (self._failures - 1),
+                    MAX_BACKOFF
+                ))
+        while self.flush_once(0):
+            pass
+        if self._events:
+            _LOG.error("Lost %s webhook events", len(self._events))
+
+    def flush_once(self, timeout):
+        """Waits up to `timeout` seconds for an event, then saves it with
+        the others already queued, up to `batch_size`. Never waits for
+        more events to come. If they can't be saved they are queued
+        again, first.
+
+        Returns:
+          int: The number of events saved
+        """
+        with self._not_empty:
+            if not self._events and timeout:
+                self._not_empty.wait(timeout)
+            batch = [self._events.popleft() for _ in range(
+                min(len(self._events), self._batch_size)
+            )]
+        if not batch:
+            return 0
+        try:
+            self._save(batch)
+        except Exception:  # pylint: disable=W0703
+            self._failures += 1
+            _LOG.exception("Could not save %s webhook events, will retry",
+                           len(batch))
+            with self._not_empty:
+                # May go over queue_size: `put` rejects calls until then
+                self._events.extendleft(reversed(batch))
+            return 0
+        self._failures = 0
+        return len(batch)
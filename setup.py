@@ -3,7 +3,7 @@ from setuptools import setup, find_packages
 setup(
     name='email_api',
     version='0.1',
-    packages=find_packages(exclude=['tests']),
+    packages=find_packages(exclude=['tests', 'benchmarks', 'benchmarks.*']),
 
     install_requires=[
         'bottle>=0.12.9',
@@ -12,6 +12,14 @@ setup(
         'PyYAML>=3.11'
     ],
 
+    extras_require={
+        # For email_api.transports.AiohttpTransport
+        'async': ['aiohttp>=3.0'],
+        # The production server, see `server` in conf.yaml.example, also
+        # used by the benchmarks
+        'gunicorn': ['gunicorn>=19.7'],
+    },
+
     package_data={
         # If any package contains *.txt or *.rst files, include them:
         '': ['*.txt', '*.rst']
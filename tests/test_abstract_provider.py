@@ -0,0 +1,20 @@
+import unittest
+
+from email_api.api import REGISTERED_PROVIDERS
+
+
+class TestBaseUrl(unittest.TestCase):
+
+    def test_base_url(self):
+        """ The API root can be moved, e.g. to a stub server
+        """
+        conf = {'user': 'me', 'key': 'blah', 'domain': 'x.com'}
+        stub = dict(conf, base_url='http://localhost:8000/')
+        for prov in REGISTERED_PROVIDERS:
+            _, url = prov({prov.nickname: conf}).send_url
+            _, stub_url = prov({prov.nickname: stub}).send_url
+            self.assertEqual(
+                stub_url,
+                url.replace(prov.api_url, 'http://localhost:8000')
+            )
+            self.assertNotEqual(stub_url, url)
@@ -0,0 +1,40 @@
+import unittest
+
+from email_api import api
+
+try:
+    from gunicorn.config import Config
+except ImportError:
+    Config = None
+
+
+class TestServerOptions(unittest.TestCase):
+
+    def test_wsgiref_starts_now(self):
+        started = []
+        extra = api.server_options({'server_extra': {'quiet': True}},
+                                   [lambda: started.append(1)])
+        self.assertEqual(extra, {'quiet': True})
+        self.assertEqual(started, [1])
+
+    def test_gunicorn_starts_after_fork(self):
+        started = []
+        extra = api.server_options(
+            {'server': 'gunicorn', 'server_extra': {'workers': 2}},
+            [lambda: started.append(1)]
+        )
+        self.assertEqual(started, [])
+        extra['post_fork'](None, None)
+        self.assertEqual(started, [1])
+
+    @unittest.skipIf(Config is None, "gunicorn is not installed")
+    def test_gunicorn_accepts_options(self):
+        # Bottle's GunicornServer sets each of them on a gunicorn Config,
+        # which validates the hooks
+        config = Config()
+        extra = api.server_options(
+            {'server': 'gunicorn', 'server_extra': {'workers': 2}}, []
+        )
+        for name, value in extra.items():
+            config.set(name, value)
+        self.assertEqual(config.workers, 2)
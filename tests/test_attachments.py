@@ -0,0 +1,111 @@
+import io
+import os
+import unittest
+from email.parser import BytesParser
+from unittest import mock
+
+import requests
+
+from email_api.attachments import Attachment, MultipartBody
+from email_api.message import Email, Recipient
+from email_api.providers_manager import ProvidersManager
+from email_api.mailgun_provider import MailgunProvider
+
+
+def parse(body):
+    raw = b'Content-Type: ' + body.content_type.encode() + b'\r\n\r\n'
+    return BytesParser().parsebytes(raw + body.read()).get_payload()
+
+
+class TestAttachment(unittest.TestCase):
+
+    def test_spool(self):
+        small = Attachment.from_stream('a.txt', io.BytesIO(b'abc'),
+                                       spool_size=3)
+        self.assertTrue(small.in_memory)
+        self.assertEqual(small.content_type, 'text/plain')
+
+        with Attachment.from_stream('b', io.BytesIO(b'abcd'),
+                                    spool_size=3) as big:
+            self.assertFalse(big.in_memory)
+            path = big._path
+            # Each reader is independent
+            with big.open() as first, big.open() as second:
+                self.assertEqual([first.read(2), second.read()],
+                                 [b'ab', b'abcd'])
+        self.assertFalse(os.path.exists(path))
+
+    def test_from_file(self):
+        upload = io.BytesIO(b'abcd')
+        upload.read(1)  # Already read by the web framework
+        with Attachment.from_file('c.txt', upload) as wrapped:
+            self.assertEqual(wrapped.size, 4)
+            with wrapped.open() as first, wrapped.open() as second:
+                self.assertEqual([first.read(2), second.read(),
+                                  first.read()], [b'ab', b'abcd', b'cd'])
+            self.assertEqual(wrapped.digest(), Attachment(
+                'c.txt', data=b'abcd').digest())
+        # Left to its owner
+        self.assertFalse(upload.closed)
+        self.assertRaises(ValueError, Attachment, 'd', data=b'x',
+                          file=upload)
+
+    def test_multipart(self):
+        files = [('attachment', Attachment('a.txt', data=b'hello')),
+                 ('attachment', Attachment.from_stream(
+                     'b"\n.bin', io.BytesIO(b'\0' * 70000), spool_size=10)),
+                 ('attachment', Attachment.from_file(
+                     'c.txt', io.BytesIO(b'x' * 70000)))]
+        body = MultipartBody({'to': ['a@b.com', 'c@d.com'], 'cc': None,
+                              'subject': 'é'}, files)
+        length = len(body)
+        parts = parse(body)
+        self.assertEqual(body.tell(), length)
+        self.assertEqual(
+            [(p.get_param('name', header='content-disposition'),
+              p.get_filename(), p.get_payload(decode=True)) for p in parts],
+            [('to', None, b'a@b.com'), ('to', None, b'c@d.com'),
+             ('subject', None, 'é'.encode()),
+             ('attachment', 'a.txt', b'hello'),
+             ('attachment', 'b" .bin', b'\0' * 70000),
+             ('attachment', 'c.txt', b'x' * 70000)]
+        )
+        files[1][1].close()
+
+    def test_requests_content_length(self):
+        body = MultipartBody({'a': 'b'}, [('f', Attachment('f', data=b'x'))])
+        req = requests.Request('POST', 'http://localhost', data=body).prepare()
+        self.assertEqual(req.headers['Content-Length'], str(len(body)))
+
+
+class TestSendAttachments(unittest.TestCase):
+
+    def test_failover_resends_files(self):
+        email = Email(files=[Attachment('a.txt', data=b'hello')])
+        email.add_recipient(Recipient('a@b.com', None, 'to'))
+        email.from_ = Recipient('me@b.com', None, 'from')
+        bodies = []
+
+        def request(**kwargs):
+            bodies.append(parse(kwargs['data']))
+            if len(bodies) == 1:
+                raise requests.ConnectionError
+            return mock.Mock(status_code=200)
+
+        sessions = mock.Mock()
+        sessions.get.return_value.request = request
+        no_files = mock.Mock(return_value=mock.Mock(
+            nickname='nofiles', attachment_field=None,
+            recipient_limit=None))
+        config = {'mailgun': {'user': 'api', 'key': 'k', 'domain': 'd'}}
+        mng = ProvidersManager([no_files, MailgunProvider, MailgunProvider],
+                               config, sessions=sessions)
+        with mock.patch.object(mng, '_create_provider',
+                               lambda k, c: k(c)):
+            res, nick = mng.send(email)
+
+        self.assertEqual(nick, 'mailgun')
+        self.assertEqual(len(bodies), 2)
+        self.assertEqual(bodies[0][-1].get_payload(decode=True), b'hello')
+        self.assertEqual(bodies[0][-1].get_payload(decode=True),
+                         bodies[1][-1].get_payload(decode=True))
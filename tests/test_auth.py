@@ -0,0 +1,146 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import bottle
+
+from email_api import api
+from email_api.auth import (
+    ApiKeys,
+    InvalidApiKeyConfigError,
+    SlidingWindow,
+    hash_key,
+    retry_after_header
+)
+
+
+class TestSlidingWindow(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [0]
+        self.window = SlidingWindow(4, 10, clock=lambda: self.now[0])
+
+    def test_limit(self):
+        self.assertEqual([self.window.hit() for _ in range(4)], [0] * 4)
+        self.assertEqual(self.window.hit(), 10)
+        self.now[0] = 9
+        self.assertEqual(self.window.hit(), 1)
+
+    def test_slides(self):
+        for _ in range(4):
+            self.window.hit()
+        # The previous window still weighs 9/10 of its count
+        self.now[0] = 11
+        self.assertEqual(self.window.hit(), 0)
+        self.assertAlmostEqual(self.window.hit(), 1.5)
+        self.now[0] = 15
+        self.assertEqual(self.window.hit(), 0)
+        # Long idle, nothing left
+        self.now[0] = 100
+        self.assertEqual([self.window.hit() for _ in range(4)], [0] * 4)
+
+    def test_retry_after_header(self):
+        self.assertEqual([retry_after_header(w) for w in [0.001, 1, 2.1]],
+                         ['1', '1', '3'])
+
+
+class TestApiKeys(unittest.TestCase):
+
+    def test_config(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'keys.yaml')
+            with open(path, 'w') as keys_file:
+                keys_file.write('- {name: c, key: k3}\n')
+            keys = ApiKeys.from_config({
+                'limit': 5,
+                'keys_file': path,
+                'keys': [
+                    {'name': 'a', 'key': 'k1', 'limit': None},
+                    {'name': 'b', 'sha256': hash_key('k2').upper()},
+                ]
+            })
+        self.assertEqual(len(keys), 3)
+        self.assertEqual(
+            [keys.authenticate(k).name for k in ['k1', 'k2', 'k3']],
+            ['a', 'b', 'c']
+        )
+        self.assertIsNone(keys.authenticate('k1').rate_limit)
+        self.assertEqual(keys.authenticate('k2').rate_limit.limit, 5)
+        self.assertIsNone(keys.authenticate('nope'))
+        self.assertIsNone(keys.authenticate(None))
+        self.assertIsNone(ApiKeys.from_config(None))
+
+    def test_invalid_config(self):
+        for conf in [{'keys': [{'key': 'a'}]},
+                     {'keys': [{'name': 'a'}]},
+                     {'keys': [{'name': 'a', 'key': 'k'},
+                               {'name': 'b', 'key': 'k'}]},
+                     {'keys_file': '/does/not/exist'}]:
+            self.assertRaises(InvalidApiKeyConfigError,
+                              ApiKeys.from_config, conf)
+
+    def test_key_from(self):
+        keys = ApiKeys({})
+        self.assertEqual(keys.key_from({'X-API-Key': 'a'}), 'a')
+        self.assertEqual(keys.key_from({'Authorization': 'Bearer b '}), 'b')
+        self.assertIsNone(keys.key_from({'Authorization': 'Basic c'}))
+
+
+class TestAuthenticated(unittest.TestCase):
+
+    def setUp(self):
+        self.keys = ApiKeys.from_config({
+            'limit': 1, 'keys': [{'name': 'a', 'key': 'k'}]
+        })
+        self.handler = api.authenticated(lambda: 'ok')
+
+    def call(self, headers, keys=True):
+        config = {api.API_KEYS_KEY: self.keys if keys else None}
+        with mock.patch.object(api, 'app') as app, \
+                mock.patch.object(api, 'request') as request:
+            app.return_value.config = config
+            request.headers = headers
+            return self.handler()
+
+    def status(self, headers):
+        with self.assertRaises(bottle.HTTPError) as ctx:
+            self.call(headers)
+        return ctx.exception
+
+    def test_auth(self):
+        self.assertEqual(self.call({}, keys=False), 'ok')
+        self.assertEqual(self.status({}).status_code, 401)
+        self.assertEqual(self.status({'X-API-Key': 'bad'}).status_code, 401)
+        self.assertEqual(self.call({'X-API-Key': 'k'}), 'ok')
+
+        err = self.status({'X-API-Key': 'k'})
+        self.assertEqual(err.status_code, 429)
+        self.assertEqual(err.headers['Retry-After'], '60')
+
+    def test_batch_charged_per_email(self):
+        self.keys = ApiKeys.from_config({
+            'limit': 3, 'keys': [{'name': 'a', 'key': 'k'}]
+        })
+        body = b'\n'.join(b'{"to": "a@b.com"}' for _ in range(5))
+        config = {api.API_KEYS_KEY: self.keys}
+        with mock.patch.object(api, 'app') as app, \
+                mock.patch.object(api, 'request') as request, \
+                mock.patch.object(api, 'response'), \
+                mock.patch.object(api, '_send_batch_item',
+                                  return_value={'sent': True}):
+            app.return_value.config = config
+            request.headers = {'X-API-Key': 'k'}
+            request.environ = {'wsgi.input': io.BytesIO(body)}
+            request.content_length = len(body)
+            lines = [json.loads(line) for line in api.send_emails_batch()]
+
+        self.assertEqual(len([r for r in lines if r.get('sent')]), 3)
+        self.assertIn(
+            {'error': 'Rate limit exceeded, retry from index 3 in 60s'},
+            lines
+        )
+        # The window is used up
+        self.assertEqual(self.status({'X-API-Key': 'k'}).status_code, 429)
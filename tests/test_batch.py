@@ -0,0 +1,119 @@
+import io
+import threading
+import unittest
+
+from email_api.batch import (
+    InvalidBatchError,
+    LimitedReader,
+    iter_json_items,
+    send_batch
+)
+
+
+def items(body, chunk_size=3):
+    return list(iter_json_items(io.BytesIO(body), chunk_size=chunk_size))
+
+
+class TestIterJsonItems(unittest.TestCase):
+
+    def test_array(self):
+        for chunk_size in [1, 2, 7, 1024]:
+            self.assertEqual(
+                items(b' [{"a": 1}, {"b": [1, 2]} ,12 ] ', chunk_size),
+                [{'a': 1}, {'b': [1, 2]}, 12]
+            )
+
+    def test_ndjson(self):
+        for chunk_size in [1, 2, 7, 1024]:
+            self.assertEqual(
+                items(b'{"a": 1}\n{"b": "\xc3\xa9"}\n\n12\n', chunk_size),
+                [{'a': 1}, {'b': '\xe9'}, 12]
+            )
+
+    def test_empty(self):
+        self.assertEqual(items(b''), [])
+        self.assertEqual(items(b'[ ]'), [])
+
+    def test_invalid(self):
+        for body in [b'[{"a": 1} {"b": 2}]', b'[{"a": 1}', b'[1] 2',
+                     b'{"a": ', b'{"a": 1}\nnope']:
+            self.assertRaises(InvalidBatchError, items, body)
+
+    def test_invalid_utf8(self):
+        for body in [b'{"a": "\xff"}\n', b'[{"a": "\xc3"}]', b'{"a": "\xc3']:
+            for chunk_size in [1, 1024]:
+                self.assertRaises(InvalidBatchError, items, body, chunk_size)
+
+    def test_item_too_large(self):
+        body = b'[{"a": "' + b'x' * 100 + b'"}]'
+        self.assertRaises(
+            InvalidBatchError,
+            list,
+            iter_json_items(io.BytesIO(body), chunk_size=8, max_item_size=50)
+        )
+
+    def test_lazy(self):
+        stream = io.BytesIO(b'{"a": 1}\n' * 1000)
+        next(iter_json_items(stream, chunk_size=64))
+        self.assertEqual(stream.tell(), 64)
+
+    def test_limited_reader(self):
+        reader = LimitedReader(io.BytesIO(b'[1, 2] garbage'), 6)
+        self.assertEqual(list(iter_json_items(reader)), [1, 2])
+
+
+class TestSendBatch(unittest.TestCase):
+
+    def test_results(self):
+        res = list(send_batch(
+            iter([1, 2, 'x', 4]),
+            lambda i: {'double': i * 2} if i != 4 else 1 / 0,
+            max_in_flight=2
+        ))
+        self.assertEqual(
+            sorted(res, key=lambda r: r['index']),
+            [{'index': 0, 'double': 2},
+             {'index': 1, 'double': 4},
+             {'index': 2, 'double': 'xx'},
+             {'index': 3, 'error': 'Internal error: ZeroDivisionError'}]
+        )
+
+    def test_bounded(self):
+        lock = threading.Lock()
+        running = [0, 0]  # current, max
+
+        def process(item):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            threading.Event().wait(0.01)
+            with lock:
+                running[0] -= 1
+            return {}
+
+        res = list(send_batch(range(20), process, max_in_flight=3))
+        self.assertEqual(len(res), 20)
+        self.assertLessEqual(running[1], 3)
+
+    def test_max_items(self):
+        res = list(send_batch(range(5), lambda i: {}, max_items=2))
+        self.assertEqual(len(res), 3)
+        self.assertIn('error', [r for r in res if 'index' not in r][0])
+
+    def test_admit(self):
+        res = list(send_batch(
+            range(5), lambda i: {}, max_in_flight=1,
+            admit=lambda index: 'Over quota' if index == 3 else None
+        ))
+        self.assertEqual(sorted(r['index'] for r in res if 'index' in r),
+                         [0, 1, 2])
+        self.assertIn({'error': 'Over quota'}, res)
+
+    def test_invalid_batch(self):
+        def gen():
+            yield 1
+            raise InvalidBatchError('boom')
+
+        res = list(send_batch(gen(), lambda i: {}))
+        self.assertEqual(len(res), 2)
+        self.assertIn({'error': 'Invalid batch: boom'}, res)
@@ -0,0 +1,172 @@
+import unittest
+from unittest import mock
+
+import requests
+
+from email_api.circuit_breaker import (
+    CircuitBreaker,
+    CircuitBreakers,
+    CLOSED,
+    OPEN,
+    HALF_OPEN
+)
+from email_api.message import Email
+from email_api.providers_manager import ProvidersManager
+from email_api.transports import TransportResponse
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(2, 10, self.clock)
+
+    def test_opens(self):
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_half_open(self):
+        for _ in range(2):
+            self.breaker.record_failure()
+        self.clock.now = 10
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        # Single probe
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.clock.now = 20
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_order_keeps_probe(self):
+        breakers = CircuitBreakers(clock=self.clock)
+        breakers._breakers['a'] = self.breaker
+        a, b = Provider('a'), Provider('b')
+        for _ in range(2):
+            self.breaker.record_failure()
+        self.assertEqual(breakers.order([a, b]), [b, a])
+        self.clock.now = 10
+        for _ in range(2):
+            self.assertEqual(breakers.order([a, b]), [a, b])
+        # Sorting is not trying: the probe slot is still free
+        self.assertTrue(self.breaker.available)
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.available)
+
+
+class Provider:
+
+    def __init__(self, nickname, raises=None):
+        self.nickname = nickname
+        self.raises = raises
+
+    def __call__(self, config):
+        return self
+
+    def is_success(self, response):
+        return getattr(response, 'status_code', 200) == 200
+
+
+class TestBreakersInManager(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breakers = CircuitBreakers({
+            'circuit_breaker': {'failure_threshold': 1, 'reset_timeout': 10},
+            'providers': {'b': {'circuit_breaker': {'failure_threshold': 3}}}
+        }, clock=self.clock)
+        self.down = Provider('a', requests.ConnectionError)
+        self.up = Provider('b')
+
+    def _send(self, providers, response=None, **kwargs):
+        sessions = mock.Mock()
+        sessions.get.return_value.request.return_value = response
+        mng = ProvidersManager(providers, None, sessions=sessions,
+                               breakers=self.breakers, **kwargs)
+        tried = []
+
+        def prep(email, provider, request_func):
+            tried.append(provider.nickname)
+            if provider.raises:
+                raise provider.raises
+            return request_func
+
+        with mock.patch.object(mng, '_create_provider', lambda k, c: k), \
+                mock.patch.object(mng, '_prep_request', prep):
+            return mng.send(Email()), tried
+
+    def test_config(self):
+        self.assertEqual(self.breakers.get('a').failure_threshold, 1)
+        self.assertEqual(self.breakers.get('b').failure_threshold, 3)
+
+    def test_demote(self):
+        (_, nick), tried = self._send([self.down, self.up])
+        self.assertEqual([nick, tried], ['b', ['a', 'b']])
+        self.assertEqual(self.breakers.snapshot()['a']['state'], OPEN)
+
+        # a is open: tried last
+        (_, nick), tried = self._send([self.down, self.up])
+        self.assertEqual([nick, tried], ['b', ['b']])
+
+        # Probe once the timeout is over
+        self.clock.now = 10
+        self.down.raises = None
+        (_, nick), tried = self._send([self.down, self.up])
+        self.assertEqual([nick, tried], ['a', ['a']])
+        self.assertEqual(self.breakers.snapshot()['a']['state'], CLOSED)
+
+    def test_untried_provider_is_probed_later(self):
+        self._send([self.down])
+        self.clock.now = 10
+        # b takes the email, half-open a is sorted but never tried
+        (_, nick), tried = self._send([self.up, self.down])
+        self.assertEqual([nick, tried], ['b', ['b']])
+
+        self.down.raises = None
+        (_, nick), tried = self._send([self.down, self.up])
+        self.assertEqual([nick, tried], ['a', ['a']])
+
+    def test_skip(self):
+        self.breakers.skip_open = True
+        self._send([self.down, self.up])
+        res, tried = self._send([self.down])
+        self.assertEqual([res, tried], [(None, None), []])
+
+    def test_probe_kept_if_not_tried(self):
+        self.breakers.skip_open = True
+        self._send([self.down])
+        self.clock.now = 10
+        # Over its rate limit: skipped before its request
+        throttled = mock.Mock()
+        throttled.acquire.return_value = False
+        res, _ = self._send([self.down], rate_limits=throttled)
+        self.assertEqual(res, (None, None))
+        self.assertTrue(self.breakers.get('a').available)
+
+    def test_rejected_emails(self):
+        # Bad recipients are not the provider's fault
+        for _ in range(3):
+            self._send([self.up], TransportResponse(400))
+        self.assertEqual(self.breakers.snapshot()['b']['state'], CLOSED)
+        for status in (503, 429, 500):
+            self._send([self.up], TransportResponse(status))
+        self.assertEqual(self.breakers.snapshot()['b']['state'], OPEN)
@@ -0,0 +1,152 @@
+import unittest
+from email.utils import formatdate
+from unittest import mock
+
+import requests
+
+from email_api.concurrency import (
+    AdaptiveLimit,
+    AdaptiveLimits,
+    parse_retry_after
+)
+from email_api.message import Email
+from email_api.providers_manager import ProvidersManager
+from email_api.transports import TransportResponse
+
+
+class Provider:
+
+    def __init__(self, nickname):
+        self.nickname = nickname
+
+    @staticmethod
+    def is_success(response):
+        return response.status_code == 200
+
+
+class TestAdaptiveLimit(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [0]
+        self.limit = AdaptiveLimit(initial=2, min_limit=1, max_limit=3,
+                                   clock=lambda: self.now[0])
+
+    def test_slots(self):
+        self.assertTrue(self.limit.acquire())
+        self.assertTrue(self.limit.acquire())
+        self.assertFalse(self.limit.acquire())
+        self.limit.release()
+        self.assertTrue(self.limit.acquire())
+
+    def test_aimd(self):
+        self.limit.record_success()
+        self.assertEqual(self.limit.limit, 2.5)
+        for _ in range(10):
+            self.limit.record_success()
+        self.assertEqual(self.limit.limit, 3)
+        self.limit.record_congestion()
+        self.assertEqual(self.limit.limit, 1.5)
+        self.now[0] = 1
+        self.limit.record_congestion()
+        self.assertEqual(self.limit.limit, 1)
+
+    def test_simultaneous_timeouts(self):
+        limit = AdaptiveLimit(initial=64, min_limit=1, cooldown=1,
+                              clock=lambda: self.now[0])
+        # A burst of requests times out together: one signal
+        for _ in range(20):
+            limit.record_congestion()
+        self.assertEqual(limit.limit, 32)
+        self.now[0] = 0.5
+        limit.record_congestion(retry_after=5)
+        self.assertEqual(limit.limit, 32)
+        self.assertEqual(limit.blocked_for, 5)  # Still honoured
+        self.now[0] = 1
+        limit.record_congestion()
+        self.assertEqual(limit.limit, 16)
+
+    def test_retry_after(self):
+        self.limit.record_congestion(retry_after=10)
+        self.assertFalse(self.limit.acquire())
+        self.assertEqual(self.limit.snapshot()['blocked_for'], 10)
+        self.now[0] = 10
+        self.assertTrue(self.limit.acquire())
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('120'), 120)
+        self.assertEqual(parse_retry_after(formatdate(1030), now=1000), 30)
+        self.assertEqual(parse_retry_after(formatdate(900), now=1000), 0)
+        for value in [None, '', 'soon']:
+            self.assertIsNone(parse_retry_after(value))
+
+
+class TestAdaptiveLimits(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [0]
+        self.limits = AdaptiveLimits({
+            'adaptive_concurrency': {'enabled': True, 'initial': 1},
+            'providers': {'b': {'adaptive_concurrency': {'initial': 5}}},
+        }, clock=lambda: self.now[0])
+
+    def test_config(self):
+        self.assertEqual([self.limits.get('a').limit,
+                          self.limits.get('b').limit], [1, 5])
+        self.assertIsNone(AdaptiveLimits.from_config({}))
+
+    def test_order(self):
+        a, b = Provider('a'), Provider('b')
+        self.limits.get('a').acquire()
+        self.assertEqual(self.limits.order([a, b]), [b, a])
+
+    def test_feedback(self):
+        self.limits.record_response(
+            'b', TransportResponse(429, headers={'Retry-After': '5'}), False
+        )
+        self.assertEqual(self.limits.get('b').limit, 2.5)
+        self.assertFalse(self.limits.get('b').available)
+        # Rejected emails are not a capacity problem
+        self.limits.record_response('a', TransportResponse(400), False)
+        self.limits.record_error('a', requests.HTTPError())
+        self.assertEqual(self.limits.get('a').limit, 1)
+        self.now[0] = 10
+        self.limits.record_error('b', requests.Timeout())
+        self.assertEqual(self.limits.get('b').limit, 1.25)
+
+    def test_retry_after_any_case(self):
+        # aiohttp keeps the case the provider sent
+        self.limits.record_response(
+            'a', TransportResponse(429, headers={'retry-after': '5'}), False
+        )
+        self.assertFalse(self.limits.get('a').available)
+        self.now[0] = 5
+        self.assertTrue(self.limits.get('a').available)
+
+
+class TestManagerConcurrency(unittest.TestCase):
+
+    def test_throttled_provider_tried_last(self):
+        limits = AdaptiveLimits({'adaptive_concurrency': {'enabled': True}})
+        manager = ProvidersManager(
+            [Provider('a'), Provider('b')], {}, sessions=mock.Mock(),
+            concurrency=limits
+        )
+        manager._provider = lambda klass: klass
+        answers = {
+            'a': TransportResponse(429, headers={'Retry-After': '60'}),
+            'b': TransportResponse(200),
+        }
+        tried = []
+
+        def prep(email, provider, request_func):
+            tried.append(provider.nickname)
+            return lambda **kwargs: answers[provider.nickname]
+
+        with mock.patch.object(manager, '_prep_request', prep):
+            self.assertEqual(manager.send(Email())[1], 'b')
+            self.assertEqual(manager.send(Email())[1], 'b')
+
+        # a answered 429 and asked to wait, it is not tried again
+        self.assertEqual(tried, ['a', 'b', 'b'])
+        self.assertEqual(limits.get('a').in_flight, 0)
+        self.assertEqual(limits.get('b').in_flight, 0)
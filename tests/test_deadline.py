@@ -0,0 +1,114 @@
+import unittest
+from unittest import mock
+
+import requests
+
+from email_api.deadline import Deadline, DeadlineExceededError, Timeouts
+from email_api.message import Email, Recipient
+from email_api.providers_manager import ProvidersManager
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestDeadline(unittest.TestCase):
+
+    def test_timeout(self):
+        clock = FakeClock()
+        deadline = Deadline(10, clock)
+        self.assertEqual(deadline.timeout(3, 5), (3, 5))
+        clock.now = 7
+        self.assertEqual(deadline.timeout(3, 5), (3, 3))
+        self.assertFalse(deadline.expired)
+        clock.now = 10
+        self.assertTrue(deadline.expired)
+        self.assertRaises(DeadlineExceededError, deadline.timeout, 3, 5)
+
+    def test_config(self):
+        timeouts = Timeouts({
+            'deadline': {'budget': 5, 'read_timeout': 4},
+            'providers': {'a': {'timeout': {'connect': 1}}, 'b': None}
+        })
+        self.assertEqual(timeouts.budget, 5)
+        self.assertEqual(timeouts.for_provider('a'), (1, 4))
+        self.assertEqual(timeouts.for_provider('b'), (3.05, 4))
+
+
+class Provider:
+    max_batch_size = None
+
+    def __init__(self, nickname):
+        self.nickname = nickname
+
+    def __call__(self, config):
+        return self
+
+    def is_success(self, response):
+        return response == 'ok'
+
+
+class TestDeadlineInManager(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.timeouts = Timeouts({
+            'deadline': {'budget': 10},
+            'providers': {'a': {'timeout': {'connect': 1, 'read': 8}}}
+        })
+        self.calls = []
+
+    def _send(self, responses, budget=10, emails=None):
+        def request(**kwargs):
+            self.calls.append(kwargs['timeout'])
+            self.clock.now += 6
+            res = responses.pop(0)
+            if isinstance(res, type):
+                raise res
+            return res
+
+        sessions = mock.Mock()
+        sessions.get.return_value.request = request
+        mng = ProvidersManager([Provider('a'), Provider('b')], None,
+                               sessions=sessions, timeouts=self.timeouts)
+        with mock.patch.object(mng, '_create_provider', lambda k, c: k), \
+                mock.patch.object(mng, '_prep_request',
+                                  lambda email, provider, func: func), \
+                mock.patch.object(self.timeouts, 'deadline',
+                                  lambda: Deadline(budget, self.clock)):
+            if emails is not None:
+                return mng.send_many(emails)
+            return mng.send(Email())
+
+    def test_per_attempt_timeouts(self):
+        self.assertEqual(self._send(['ko', 'ok'])[0], 'ok')
+        # The second attempt only gets what's left of the budget
+        self.assertEqual(self.calls, [(1, 8), (3.05, 4)])
+
+    def test_budget_exhausted(self):
+        self.assertRaises(
+            DeadlineExceededError,
+            self._send, [requests.Timeout, 'ok'], 5
+        )
+        self.assertEqual(len(self.calls), 1)
+
+    def test_budget_per_email(self):
+        results = self._send(['ok'] * 3, emails=[Email() for _ in range(3)])
+        self.assertEqual([nick for _, nick in results], ['a'] * 3)
+        # Sent one after the other, each with its own budget
+        self.assertEqual(self.calls, [(1, 8)] * 3)
+
+    def test_budget_exhausted_many(self):
+        # Rendered here, then sent alone
+        templated = Email(variables={})
+        templated.add_recipient(Recipient('a@b.com', None, 'to'))
+        results = self._send(
+            [requests.Timeout, requests.Timeout, 'ok'], 5,
+            [templated, Email(), Email()]
+        )
+        self.assertEqual(results, [(None, None), (None, None), ('ok', 'a')])
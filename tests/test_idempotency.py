@@ -0,0 +1,209 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from email_api import api
+from email_api.attachments import Attachment
+from email_api.providers_manager import ChunkedResponse
+from email_api.idempotency import (
+    Idempotency,
+    InFlightError,
+    KeyReusedError,
+    SqliteIdempotencyStore,
+    fingerprint
+)
+
+
+class TestIdempotency(unittest.TestCase):
+
+    def setUp(self):
+        self.idempotency = Idempotency(wait_timeout=5)
+        self.calls = []
+
+    def func(self, result='ok'):
+        def call():
+            self.calls.append(result)
+            return result
+        return call
+
+    def test_replay(self):
+        self.assertEqual(self.idempotency.run('k', 'f', self.func()),
+                         ('ok', False))
+        self.assertEqual(self.idempotency.run('k', 'f', self.func()),
+                         ('ok', True))
+        self.assertEqual(self.idempotency.run('l', 'f', self.func()),
+                         ('ok', False))
+        self.assertEqual(len(self.calls), 2)
+        self.assertRaises(KeyReusedError, self.idempotency.run,
+                          'k', 'other', self.func())
+
+    def test_not_kept(self):
+        for _ in range(2):
+            self.idempotency.run('k', 'f', self.func('failed'),
+                                 keep=lambda result: result != 'failed')
+        self.assertRaises(ValueError, self.idempotency.run, 'l', 'f',
+                          mock.Mock(side_effect=ValueError))
+        self.idempotency.run('l', 'f', self.func())
+        self.assertEqual(self.calls, ['failed', 'failed', 'ok'])
+
+    def test_concurrent_duplicates_wait(self):
+        started, finish = threading.Event(), threading.Event()
+
+        def slow():
+            started.set()
+            finish.wait(5)
+            self.calls.append('slow')
+            return 'first'
+
+        results = []
+        first = threading.Thread(
+            target=lambda: results.append(self.idempotency.run('k', 'f',
+                                                               slow))
+        )
+        first.start()
+        started.wait(5)
+        second = threading.Thread(
+            target=lambda: results.append(self.idempotency.run(
+                'k', 'f', self.func()
+            ))
+        )
+        second.start()
+        finish.set()
+        first.join(5)
+        second.join(5)
+
+        self.assertEqual(self.calls, ['slow'])
+        self.assertEqual(sorted(results), [('first', False),
+                                           ('first', True)])
+
+    def test_sqlite_shared(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'idempotency.db')
+            first = Idempotency(store=SqliteIdempotencyStore(path))
+            second = Idempotency(store=SqliteIdempotencyStore(path),
+                                 wait_timeout=0.1, poll_interval=0.01)
+
+            def in_flight():
+                # The first worker is still sending
+                self.assertRaises(InFlightError, second.run, 'k', 'f',
+                                  self.func())
+                return ['ok']
+
+            self.assertEqual(first.run('k', 'f', in_flight),
+                             (['ok'], False))
+            self.assertEqual(second.run('k', 'f', self.func()),
+                             (['ok'], True))
+            self.assertRaises(KeyReusedError, second.run, 'k', 'other',
+                              self.func())
+            self.assertEqual(self.calls, [])
+
+    def test_sqlite_lease(self):
+        now = [0]
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SqliteIdempotencyStore(os.path.join(tmp, 'i.db'),
+                                           clock=lambda: now[0])
+            self.assertIsNone(store.claim('k', 'f', lease=10))
+            self.assertEqual(store.claim('k', 'f', lease=10), ('f', None))
+            # The worker having it died, it is taken over
+            now[0] = 10
+            self.assertIsNone(store.claim('k', 'f', lease=10))
+            store.release('k')
+            self.assertIsNone(store.claim('k', 'f', lease=10))
+
+    def test_sqlite_lease_renewed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'idempotency.db')
+            first = Idempotency(store=SqliteIdempotencyStore(path),
+                                lease=0.15)
+            second = Idempotency(store=SqliteIdempotencyStore(path),
+                                 wait_timeout=0, lease=0.15)
+
+            def slow_send():
+                # Longer than the lease, still not taken over
+                time.sleep(0.4)
+                self.assertRaises(InFlightError, second.run, 'k', 'f',
+                                  self.func())
+                return ['ok']
+
+            self.assertEqual(first.run('k', 'f', slow_send),
+                             (['ok'], False))
+            self.assertEqual(self.calls, [])
+
+    def test_from_config(self):
+        self.assertIsNone(Idempotency.from_config({'enabled': False}))
+        self.assertEqual(Idempotency.from_config(None).header,
+                         'Idempotency-Key')
+
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint({'a': 1, 'b': 2}),
+                         fingerprint({'b': 2, 'a': 1}))
+        self.assertNotEqual(fingerprint({'a': 1}), fingerprint({'a': 2}))
+
+
+class TestSendEmail(unittest.TestCase):
+
+    def call(self, config, headers, params):
+        with mock.patch.object(api, 'app') as app, \
+                mock.patch.object(api, 'request') as request, \
+                mock.patch.object(api, 'response') as response:
+            app.return_value.config = config
+            request.headers = headers
+            request.json = params
+            request.content_type = 'application/json'
+            request.environ = {}
+            res = api.send_email()
+            return response.status, res
+
+    def test_retry_not_sent_twice(self):
+        config = {api.IDEMPOTENCY_OBJ_KEY: Idempotency()}
+        headers = {'Idempotency-Key': 'abc'}
+        sent = {'sent': True, 'provider': 'mailgun'}
+
+        with mock.patch.object(api, 'email_from_params',
+                               return_value=(None, None)), \
+                mock.patch.object(api, 'submit',
+                                  return_value=sent) as submit:
+            self.assertEqual(self.call(config, headers, {'to': 'a'}),
+                             (200, sent))
+            self.assertEqual(self.call(config, headers, {'to': 'a'}),
+                             (200, sent))
+            self.assertEqual(submit.call_count, 1)
+
+            self.call(config, {}, {'to': 'a'})
+            self.assertEqual(submit.call_count, 2)
+
+            submit.return_value = {'sent': False, 'provider': None}
+            for _ in range(2):
+                self.call(config, {'Idempotency-Key': 'def'}, {'to': 'a'})
+            self.assertEqual(submit.call_count, 4)
+
+    def test_partly_sent_chunks_not_sent_again(self):
+        config = {api.IDEMPOTENCY_OBJ_KEY: Idempotency()}
+        headers = {'Idempotency-Key': 'abc'}
+        # The first chunk went out, no provider took the second one
+        partial = ChunkedResponse([(True, 'mailgun'), (None, None)])
+
+        with mock.patch.object(api, 'email_from_params',
+                               return_value=(mock.Mock(files=[]), None)), \
+                mock.patch.object(api, 'send',
+                                  return_value=(partial, 'mailgun')) as send:
+            first = self.call(config, headers, {'to': 'a'})
+            self.assertEqual(self.call(config, headers, {'to': 'a'}), first)
+        self.assertEqual(send.call_count, 1)
+        self.assertEqual(first[1]['chunks'], {'sent': 1, 'total': 2})
+
+    def test_fingerprint_attachments(self):
+        params = {'to': 'a'}
+        first = api._request_fingerprint(
+            params, [Attachment('a.pdf', data=b'v1')]
+        )
+        self.assertEqual(first, api._request_fingerprint(
+            params, [Attachment('a.pdf', data=b'v1')]
+        ))
+        # Same name and size, other content
+        self.assertNotEqual(first, api._request_fingerprint(
+            params, [Attachment('a.pdf', data=b'v2')]
+        ))
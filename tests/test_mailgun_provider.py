@@ -0,0 +1,44 @@
+import json
+import unittest
+
+from email_api.mailgun_provider import MailgunProvider
+from email_api.message import Email, Recipient, build_recipients
+
+
+def new_email(to, **kwargs):
+    email = Email(**kwargs)
+    email.add_recipients(build_recipients(to))
+    email.from_ = Recipient.from_string("unittest <noreply@unitest", 'from')
+    return email
+
+
+class TestMailgunProvider(unittest.TestCase):
+
+    def test_mailgun_batch(self):
+        """ One message for many recipients, with recipient-variables so
+        they don't see each other
+        """
+        prov = MailgunProvider()
+        emails = [new_email({'to': to}, subject='a', text='hey').freeze()
+                  for to in ['a <a@b.com>', 'c@d.com']]
+
+        self.assertEqual(prov.batch_key(emails[0]), prov.batch_key(emails[1]))
+        with_cc = new_email({'to': 'a@b.com', 'cc': 'c@d.com'}, subject='a')
+        self.assertIsNone(prov.batch_key(with_cc.freeze()))
+        _, data = prov.emails_to_batch_data(emails)
+        self.assertEqual(data['to'], ['a <a@b.com>', 'c@d.com'])
+        self.assertEqual(json.loads(data['recipient-variables']),
+                         {'a@b.com': {}, 'c@d.com': {}})
+
+    def test_mailgun_templates(self):
+        """ Mailgun renders mail merge emails server side
+        """
+        email = new_email({'to': ['a@b.com', 'c@d.com']},
+                          subject='Hi {{name}}', text='Hey {{ name }}',
+                          variables={'a@b.com': {'name': 'A'}})
+
+        _, data = MailgunProvider().email_to_data(email.freeze())
+        self.assertEqual([data['subject'], data['text']],
+                         ['Hi %recipient.name%', 'Hey %recipient.name%'])
+        self.assertEqual(json.loads(data['recipient-variables']),
+                         {'a@b.com': {'name': 'A'}, 'c@d.com': {}})
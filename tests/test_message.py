@@ -1,11 +1,14 @@
 import unittest
+from unittest import mock
 
+from email_api import message
 from email_api.message import (
     Email,
     Recipient,
     InvalidEmailError,
     InvalidRecipientError,
-    build_email
+    build_email,
+    build_recipients
 )
 
 
@@ -64,6 +67,36 @@ class TestRecipient(unittest.TestCase):
                 self.assertEqual([r.email, r.display_name], [e, n])
 
 
+class TestValidationCache(unittest.TestCase):
+
+    def setUp(self):
+        message.configure_validation_cache({'maxsize': 10})
+
+    def tearDown(self):
+        message.configure_validation_cache()
+
+    def test_cached(self):
+        with mock.patch.object(
+            message, 'validate_email', wraps=message.validate_email
+        ) as validate:
+            for _ in range(3):
+                Recipient.check_email('a@b.com')
+                self.assertRaises(
+                    InvalidRecipientError, Recipient.check_email, 'a@b'
+                )
+            build_recipients({'to': ['a@b.com', 'c <a@b.com>']})
+
+        # Valid and invalid results are both cached
+        self.assertEqual(validate.call_count, 2)
+        stats = message.validation_cache.stats()
+        self.assertEqual([stats['hits'], stats['misses']], [6, 2])
+
+    def test_bounded(self):
+        for i in range(20):
+            Recipient.check_email('a{}@b.com'.format(i))
+        self.assertEqual(len(message.validation_cache), 10)
+
+
 class TestEmail(unittest.TestCase):
 
     def setUp(self):
@@ -128,6 +161,92 @@ class TestEmail(unittest.TestCase):
                 self.assertEqual([email.subject, email.body], [s, b])
                 self.assertEqual(email.validate(), True)
 
+    def test_recipients_by_type(self):
+        email = self.get_new_mail()
+        email.add_recipients([
+            Recipient('a@b.com', 'A', 'to'),
+            Recipient('c@d.com', None, 'cc'),
+            Recipient('e@f.com', None, 'to'),
+        ])
+        self.assertEqual(
+            [r.email for r in email.get_recipients('to')],
+            ['a@b.com', 'e@f.com']
+        )
+        self.assertEqual(len(email.get_recipients()), 3)
+        self.assertEqual(email.get_recipients('bcc'), [])
+        self.assertEqual(email.recipient_strings('to'),
+                         ('A <a@b.com>', 'e@f.com'))
+        self.assertIs(email.recipient_strings('to'),
+                      email.recipient_strings('to'))
+
+        # Cache is invalidated
+        email.add_recipient(Recipient('g@h.com', None, 'to'))
+        self.assertEqual(email.recipient_addresses('to'),
+                         ('a@b.com', 'e@f.com', 'g@h.com'))
+        self.assertEqual(email.recipient_addresses('cc'), ('c@d.com',))
+
+    def test_freeze(self):
+        email = self.get_new_mail(subject='a')
+        email.add_recipients(self.recipients)
+        frozen = email.freeze()
+        self.assertIs(frozen.freeze(), frozen)
+        self.assertFalse(email.frozen)
+        self.assertRaises(AttributeError, setattr, frozen, 'subject', 'b')
+        self.assertRaises(AttributeError, frozen.add_recipient,
+                          self.recipients[0])
+        self.assertEqual(frozen.payloads, {})
+        self.assertIsNone(email.payloads)
+
+        sender = Recipient('me@blah.com', None, 'from')
+        copy = frozen.replace(from_=sender)
+        self.assertEqual([copy.from_, frozen.from_], [sender, None])
+        self.assertEqual(copy.to_record(),
+                         dict(frozen.to_record(), **{'from': str(sender)}))
+
+    def test_split(self):
+        email = self.get_new_mail(subject='a')
+        email.add_recipients(
+            Recipient('a{}@b.com'.format(i), None, type_)
+            for i, type_ in enumerate(['to'] * 3 + ['cc', 'bcc'])
+        )
+        self.assertEqual(len(email.split(5)), 1)
+        chunks = email.split(2)
+        self.assertEqual([c.recipient_count for c in chunks], [2, 2, 1])
+        self.assertEqual(chunks[1].recipient_addresses('to'), ('a2@b.com',))
+        self.assertEqual(chunks[1].recipient_addresses('cc'), ('a3@b.com',))
+        self.assertTrue(all(c.frozen and c.subject == 'a' for c in chunks))
+
+    def test_render_all(self):
+        variables = {'a@b.com': {'name': 'A'}}
+        email = build_email(
+            build_recipients({'to': ['a@b.com', 'Z <z@b.com>']}),
+            'Hi {{name}}', 'Hello {{ name }}', None, variables=variables
+        )
+        self.assertTrue(email.templated)
+        rendered = email.render_all()
+        self.assertEqual(
+            [(e.recipient_strings('to'), e.subject, e.text, e.templated)
+             for e in rendered],
+            [(('a@b.com',), 'Hi A', 'Hello A', False),
+             (('Z <z@b.com>',), 'Hi ', 'Hello ', False)]
+        )
+        self.assertEqual(Email.from_record(email.to_record()).variables,
+                         variables)
+
+        self.assertRaises(  # No cc
+            InvalidEmailError, build_email,
+            build_recipients({'to': 'a@b.com', 'cc': 'c@b.com'}),
+            None, 'Hello', None, variables=variables
+        )
+        self.assertRaises(
+            InvalidEmailError, build_email, self.recipients, None, 'Hello',
+            None, variables={'me@blah.com': 'A'}
+        )
+
+    def test_slots(self):
+        self.assertRaises(AttributeError, setattr, Email(), 'foo', 1)
+        self.assertFalse(hasattr(self.recipients[0], '__dict__'))
+
 
 class TestUtilsFuncs(unittest.TestCase):
 
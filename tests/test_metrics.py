@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from email_api import metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.counter = metrics.Counter('c', 'A counter', ('provider',))
+        self.histogram = metrics.Histogram('h', 'A histogram',
+                                           buckets=(1, 2))
+        self.all = (self.counter, self.histogram)
+
+    def render(self, snapshots):
+        return metrics.render(snapshots, self.all).splitlines()
+
+    def test_render(self):
+        self.counter.inc(provider='a')
+        self.counter.inc(2, provider='b"')
+        for value in [0.5, 1.5, 3]:
+            self.histogram.observe(value)
+        self.assertEqual(self.counter.get(provider='b"'), 2)
+        self.assertEqual(self.histogram.get(), (3, 5))
+        self.assertEqual(self.render([metrics.snapshot(self.all)]), [
+            '# HELP c A counter',
+            '# TYPE c counter',
+            'c_total{provider="a"} 1',
+            'c_total{provider="b\\""} 2',
+            '# HELP h A histogram',
+            '# TYPE h histogram',
+            'h_bucket{le="1"} 1',
+            'h_bucket{le="2"} 2',
+            'h_bucket{le="+Inf"} 3',
+            'h_sum 5.0',
+            'h_count 3',
+        ])
+
+    def test_aggregation(self):
+        self.counter.inc(provider='a')
+        self.histogram.observe(1)
+        with tempfile.TemporaryDirectory() as tmp:
+            exporter = metrics.MetricsExporter(
+                os.path.join(tmp, 'metrics'), metrics=self.all
+            )
+            exporter.reset()
+            exporter.flush()
+            # Another worker
+            with mock.patch('os.getpid', return_value=-1):
+                exporter.flush()
+            self.counter.inc(provider='a')
+
+            snapshots = exporter.collect()
+            self.assertEqual(len(snapshots), 2)
+            lines = self.render(snapshots)
+            # Live values of this worker plus the dump of the other one
+            self.assertIn('c_total{provider="a"} 3', lines)
+            self.assertIn('h_count 2', lines)
+
+            other = os.path.join(tmp, 'metrics', 'outbox.json')
+            with open(other, 'w') as out:
+                out.write('{}')
+            exporter.reset()
+            self.assertEqual(exporter.collect(),
+                             [metrics.snapshot(self.all)])
+            # Files that are not dumps are neither read nor removed
+            self.assertTrue(os.path.exists(other))
+
+    def test_from_config(self):
+        self.assertIsNone(metrics.MetricsExporter.from_config(None))
+        exporter = metrics.MetricsExporter.from_config({'dir': '/tmp/x'})
+        self.assertEqual(exporter.flush_interval, 5)
+
@@ -0,0 +1,217 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from email_api.message import Email, build_recipients
+from email_api.outbox import Outbox, OutboxWorkers
+from email_api.providers_manager import ChunkedResponse
+from email_api.webhooks import DeliveryEvent
+
+
+def new_email(to='a@b.com'):
+    email = Email(subject='hi', text='hello')
+    email.add_recipients(build_recipients({'to': to, 'cc': 'c <c@d.fr>'}))
+    return email
+
+
+class TestOutbox(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.outbox = Outbox(os.path.join(self.dir, 'outbox.db'),
+                             lease=60, max_attempts=2, retry_delay=0)
+
+    def tearDown(self):
+        self.outbox.close()
+        shutil.rmtree(self.dir)
+
+    def test_put_claim(self):
+        id_ = self.outbox.put(new_email(), 'recipients')
+        self.assertEqual(self.outbox.get(id_)['status'], 'queued')
+
+        [item] = self.outbox.claim(10)
+        self.assertEqual([item.id, item.route, item.attempts],
+                         [id_, 'recipients', 1])
+        self.assertEqual(item.email.to_record(), new_email().to_record())
+        self.assertEqual(self.outbox.get(id_)['status'], 'sending')
+        # Leased
+        self.assertEqual(self.outbox.claim(10), [])
+
+        self.outbox.mark_sent(item, 'mailgun')
+        status = self.outbox.get(id_)
+        self.assertEqual([status['status'], status['provider']],
+                         ['sent', 'mailgun'])
+        self.assertEqual(self.outbox.claim(10), [])
+
+    def test_batches(self):
+        ids = [self.outbox.put(new_email()) for _ in range(5)]
+        claimed = self.outbox.claim(3) + self.outbox.claim(3)
+        self.assertEqual([i.id for i in claimed], ids)
+
+    def test_expired_lease(self):
+        self.outbox.lease = 0
+        id_ = self.outbox.put(new_email())
+        self.outbox.claim(1)
+        [item] = self.outbox.claim(1)
+        self.assertEqual([item.id, item.attempts], [id_, 2])
+
+    def test_claimed_again(self):
+        self.outbox.lease = 0
+        id_ = self.outbox.put(new_email())
+        [first] = self.outbox.claim(1)
+        # The first worker took too long, another one has the row now
+        self.outbox.lease = 60
+        [second] = self.outbox.claim(1)
+        self.assertEqual(self.outbox.renew([first, second]), 1)
+
+        self.assertTrue(self.outbox.mark_sent(second, 'mailgun'))
+        self.assertFalse(self.outbox.mark_failed(first, 'timeout'))
+        status = self.outbox.get(id_)
+        self.assertEqual([status['status'], status['provider']],
+                         ['sent', 'mailgun'])
+
+    def test_lease_renewed_while_sending(self):
+        self.outbox.lease = 0.15
+        id_ = self.outbox.put(new_email())
+        claimed = []
+
+        def send(email, route):
+            time.sleep(0.4)
+            claimed.extend(self.outbox.claim(1))
+            return True, 'mailgun'
+
+        workers = OutboxWorkers(self.outbox, send)
+        self.assertEqual(workers.drain_once(), 1)
+        self.assertEqual(claimed, [])
+        self.assertEqual(self.outbox.get(id_)['status'], 'sent')
+
+    def test_retries(self):
+        id_ = self.outbox.put(new_email())
+        [item] = self.outbox.claim(1)
+        self.outbox.mark_failed(item, 'oops')
+        self.assertEqual(self.outbox.get(id_)['status'], 'queued')
+
+        [item] = self.outbox.claim(1)
+        self.outbox.mark_failed(item, 'oops')
+        status = self.outbox.get(id_)
+        self.assertEqual([status['status'], status['error']],
+                         ['failed', 'oops'])
+        self.assertEqual(self.outbox.claim(1), [])
+
+    def test_partly_sent_chunks(self):
+        email = new_email(['a@b.com', 'x@y.com'])
+        id_ = self.outbox.put(email)
+        chunks = email.split(2)  # a + x, then c
+        sent = []
+
+        def send(email, route):
+            sent.append(email.recipient_addresses('to') +
+                        email.recipient_addresses('cc'))
+            if len(sent) == 1:
+                return ChunkedResponse.merge(
+                    [(True, 'mailgun'), (None, None)], chunks
+                )
+            return True, 'mailgun'
+
+        workers = OutboxWorkers(self.outbox, send)
+        workers.drain_once()
+        status = self.outbox.get(id_)
+        self.assertEqual([status['status'], status['error']],
+                         ['queued', 'Partly sent: 1 of 2 chunks'])
+
+        workers.drain_once()
+        # Only the recipients of the chunk that was not sent
+        self.assertEqual(sent[1], ('c@d.fr',))
+        self.assertEqual(self.outbox.get(id_)['status'], 'sent')
+
+    def test_not_found(self):
+        self.assertIsNone(self.outbox.get('nope'))
+
+    def test_events(self):
+        ids = [self.outbox.put(new_email(to)) for to in ['a@b.com',
+                                                          'x@y.com']]
+        workers = OutboxWorkers(
+            self.outbox, lambda email, route: (True, 'mailgun'),
+            message_id=lambda res, provider: 'm1'  # Sent in one batch
+        )
+        workers.drain_once()
+        self.outbox.add_events([
+            DeliveryEvent('mailgun', 'm1', 'A@b.com', 'delivered', 2, None),
+            DeliveryEvent('mailgun', 'm1', 'x@y.com', 'bounced', 3, 'full'),
+            DeliveryEvent('mailgun', 'm1', 'a@b.com', 'accepted', 1, None),
+            DeliveryEvent('mailgun', 'm2', 'a@b.com', 'opened', 4, None),
+        ])
+        self.assertEqual(
+            [(e['event'], e['timestamp'])
+             for e in self.outbox.get(ids[0])['events']],
+            [('accepted', 1), ('delivered', 2)]
+        )
+        [event] = self.outbox.get(ids[1])['events']
+        self.assertEqual([event['event'], event['reason']],
+                         ['bounced', 'full'])
+
+    def test_migration(self):
+        path = os.path.join(self.dir, 'old.db')
+        conn = sqlite3.connect(path)
+        conn.execute(
+            'CREATE TABLE outbox (id TEXT PRIMARY KEY, payload TEXT NOT NULL,'
+            ' route TEXT, status TEXT NOT NULL, attempts INTEGER NOT NULL '
+            'DEFAULT 0, provider TEXT, error TEXT, created REAL NOT NULL, '
+            'updated REAL NOT NULL, available_at REAL NOT NULL)'
+        )
+        conn.close()
+        outbox = Outbox(path)
+        id_ = outbox.put(new_email())
+        [item] = outbox.claim(1)
+        outbox.mark_sent(item, 'mailgun', 'm1')
+        self.assertEqual(outbox.get(id_)['status'], 'sent')
+        outbox.close()
+
+    def test_workers(self):
+        sent = []
+        done = threading.Event()
+
+        def send(email, route):
+            sent.append(next(iter(email.get_recipients('to'))).email)
+            if len(sent) == 3:
+                done.set()
+            return (None, None) if 'fail' in sent[-1] else (True, 'mailgun')
+
+        self.outbox.retry_delay = 60
+        workers = OutboxWorkers(self.outbox, send, workers=2, batch_size=2,
+                                poll_interval=0.01)
+        ids = [self.outbox.put(new_email(to))
+               for to in ['a@b.com', 'fail@b.com', 'c@b.com']]
+        workers.start()
+        self.assertTrue(done.wait(5))
+        workers.stop()
+
+        self.assertEqual(sorted(sent), ['a@b.com', 'c@b.com', 'fail@b.com'])
+        self.assertEqual(
+            [self.outbox.get(i)['status'] for i in ids],
+            ['sent', 'queued', 'sent']
+        )
+
+    def test_send_many(self):
+        calls = []
+
+        def send_many(emails, route):
+            calls.append((len(emails), route))
+            return [(True, 'mailgun')] * (len(emails) - 1) + [(None, None)]
+
+        workers = OutboxWorkers(self.outbox, None, batch_size=10,
+                                send_many=send_many)
+        ids = [self.outbox.put(new_email(to), route)
+               for to, route in [('a@b.com', None), ('b@b.com', 'x'),
+                                 ('c@b.com', None)]]
+        self.assertEqual(workers.drain_once(), 3)
+
+        self.assertEqual(sorted(calls, key=str), [(1, 'x'), (2, None)])
+        self.assertEqual(
+            [self.outbox.get(i)['status'] for i in ids],
+            ['sent', 'queued', 'queued']
+        )
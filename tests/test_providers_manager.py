@@ -1,16 +1,24 @@
+import asyncio
 import unittest
 from unittest import mock
 
 import requests
 
-from email_api.providers_manager import ProvidersManager
+from email_api import metrics
+from email_api.providers_manager import ChunkedResponse, ProvidersManager
 from email_api.abstract_provider import (
     AProvider,
     HttpMethod,
     DataFormat,
     InvalidProviderError
 )
-from email_api.message import Email
+from email_api.message import Email, Recipient
+from email_api.sessions import SessionPool
+from email_api.provider_registry import ProviderRegistry, RequestTarget
+from email_api.async_manager import AsyncProvidersManager
+from email_api.elasticemail_provider import ElasticEmailProvider
+from email_api.mailgun_provider import MailgunProvider
+from email_api.transports import InMemoryTransport, TransportResponse
 
 
 class fake_request_func:
@@ -38,6 +46,8 @@ def klass(instance):
 
 
 class FakeProvider(AProvider):
+    nickname = 'fake'
+
     def __init__(self,
                  auth=('user', 'pw'),
                  send_url=(HttpMethod.post, 'http://google.fr'),
@@ -47,6 +57,11 @@ class FakeProvider(AProvider):
         self._send_url = send_url
         self._email_data = email_data
         self._raises = raises
+        self._config = {
+            'human_name': 'Fake',
+            'from_name': 'noreply',
+            'domain': 'fake.fr'
+        }
 
     @property
     def auth(self):
@@ -61,6 +76,9 @@ class FakeProvider(AProvider):
             raise self._raises
         return self._email_data
 
+    def is_success(self, response):
+        return True
+
     def __str__(self):
         return '{},{},{}'.format(
             self.auth, self._send_url, self._email_data
@@ -91,18 +109,18 @@ class TestProvidersManager(unittest.TestCase):
             InvalidProvider,
             {}
         )
+        mng = self._get_manager()
+
+        def prep(provider_class):
+            provider = mng._create_provider(provider_class, {})
+            return mng._prep_request(Email(), provider, fake_request_func)
+
         for p in self.bad_providers:
-            self.assertRaises(
-                InvalidProviderError,
-                self._get_manager()._prep_request,
-                Email(),
-                klass(p),
-                fake_request_func
-            )
+            self.assertRaises(InvalidProviderError, prep, klass(p))
 
     def test_smoke(self):
         req = self._get_manager()._prep_request(
-            Email(), klass(FakeProvider()), fake_request_func
+            Email(), FakeProvider(), fake_request_func
         )
         req = req()
         prov = FakeProvider()
@@ -125,11 +143,403 @@ class TestProvidersManager(unittest.TestCase):
 
         with mock.patch(  # Stops I/O
             'email_api.providers_manager.requests.session',
-            auto_spec=True
+            autospec=True
         ):
             for excp in exceptions:
                 providers = [klass(FakeProvider(raises=excp))] * 2
                 mng = self._get_manager(providers)
-                assert not mng.send(Email())
+                self.assertEqual(mng.send(Email()), (None, None))
                 mng = self._get_manager(providers + [klass(self.good)])
-                assert mng.send(Email())
+                res, nick = mng.send(Email())
+                assert res
+                self.assertEqual(nick, self.good.nickname)
+
+    def test_records_stats(self):
+        stats = mock.Mock()
+        providers = [klass(FakeProvider(raises=requests.Timeout)),
+                     klass(self.good)]
+        mng = ProvidersManager(providers, None, sessions=mock.Mock(),
+                               stats=stats)
+        mng.send(Email())
+        self.assertEqual(
+            [c[0][:2] for c in stats.record.call_args_list],
+            [(None, False), ('fake', True)]
+        )
+
+    def test_records_metrics(self):
+        for metric in metrics.ALL:
+            metric.clear()
+        providers = [klass(FakeProvider(raises=requests.Timeout)),
+                     klass(self.good)]
+        mng = ProvidersManager(providers, None, sessions=mock.Mock())
+        mng.send(Email())
+
+        self.assertEqual(metrics.SUCCESSES.get(provider='fake'), 1)
+        self.assertEqual(metrics.ATTEMPTS.get(provider='fake'), 1)
+        self.assertEqual(metrics.LATENCY.get(provider='fake')[0], 1)
+        self.assertEqual(
+            metrics.FAILURES.get(provider=None, error='Timeout'), 1
+        )
+        self.assertEqual(metrics.FAILOVER_DEPTH.get(), (1, 2))
+
+
+class BatchProvider(FakeProvider):
+    nickname = 'batch'
+    max_batch_size = 2
+
+    def batch_key(self, email):
+        return email.subject if email.subject != 'solo' else None
+
+    def emails_to_batch_data(self, emails):
+        return DataFormat.form, {'subjects': [e.subject for e in emails]}
+
+
+class TestSendMany(unittest.TestCase):
+
+    def setUp(self):
+        self.sess = mock.Mock()
+        self.sessions = mock.Mock()
+        self.sessions.get.return_value = self.sess
+
+    def _send_many(self, providers, subjects):
+        mng = ProvidersManager([klass(p) for p in providers], None,
+                               sessions=self.sessions)
+        return mng.send_many([Email(subject=s) for s in subjects])
+
+    def _data(self):
+        return [c[1]['data'] for c in self.sess.request.call_args_list]
+
+    def test_batches(self):
+        results = self._send_many([BatchProvider()],
+                                  ['a', 'b', 'a', 'solo', 'a'])
+        self.assertEqual([nick for _, nick in results], ['batch'] * 5)
+        data = self._data()
+        self.assertEqual(len(data), 4)
+        # The third 'a', 'b' and 'solo' are sent one by one
+        self.assertEqual([d for d in data if 'subjects' in d],
+                         [{'subjects': ['a', 'a']}])
+
+    def test_fallback_to_single_sends(self):
+        self.sess.request.side_effect = [requests.ConnectionError,
+                                         'ok', 'ok']
+        results = self._send_many([BatchProvider(), FakeProvider()],
+                                  ['a', 'a'])
+        self.assertEqual([nick for _, nick in results], ['fake', 'fake'])
+        self.assertEqual(self.sess.request.call_count, 3)
+
+    def test_no_provider(self):
+        self.sess.request.side_effect = requests.ConnectionError
+        self.assertEqual(self._send_many([BatchProvider()], ['a', 'b']),
+                         [(None, None)] * 2)
+
+
+class TestChunks(unittest.TestCase):
+
+    def setUp(self):
+        self.small = FakeProvider()
+        self.small.max_recipients = 2
+        self.email = Email()
+        self.email.add_recipients(
+            Recipient('a{}@b.com'.format(i), None, 'to') for i in range(5)
+        )
+
+    def test_send_in_chunks(self):
+        sessions = mock.Mock()
+        mng = ProvidersManager([klass(self.small), klass(FakeProvider())],
+                               None, sessions=sessions)
+        with mock.patch.object(FakeProvider, 'email_to_data',
+                               lambda s, e: (DataFormat.form,
+                                             {'to': e.recipient_count})):
+            res, nick = mng.send(self.email)
+        self.assertTrue(res)
+        self.assertEqual([len(res), res.sent, nick], [3, 3, 'fake'])
+        self.assertEqual(
+            sorted(c[1]['data']['to']
+                   for c in sessions.get().request.call_args_list),
+            [1, 2, 2]
+        )
+
+    def test_failover_per_chunk(self):
+        self.small._config['max_recipients'] = 3  # Config override
+        sess = mock.Mock()
+        sess.request.side_effect = [requests.ConnectionError, 'ok', 'ok']
+        mng = ProvidersManager([klass(self.small)] * 2, None,
+                               sessions=mock.Mock(), max_parallel_chunks=1)
+        mng.sessions.get.return_value = sess
+        res, _ = mng.send(self.email)
+        self.assertEqual([len(res), res.sent, bool(res)], [2, 2, True])
+
+        sess.request.side_effect = requests.ConnectionError
+        self.assertEqual(mng.send(self.email), (None, None))
+
+    def test_unsent_recipients(self):
+        sess = mock.Mock()
+        sess.request.side_effect = ['ok', requests.ConnectionError, 'ok']
+        mng = ProvidersManager([klass(self.small)], None,
+                               sessions=mock.Mock(), max_parallel_chunks=1)
+        mng.sessions.get.return_value = sess
+        res, _ = mng.send(self.email)
+        self.assertEqual([len(res), res.sent, bool(res)], [3, 2, False])
+        self.assertEqual([r.email for r in res.unsent_recipients()],
+                         ['a2@b.com', 'a3@b.com'])
+
+        # Nested, e.g. a split route sent in chunks
+        outer = ChunkedResponse([(res, 'fake'), ('ok', 'fake')],
+                                [self.email, self.email])
+        self.assertFalse(outer)
+        self.assertEqual(len(outer.unsent_recipients()), 2)
+
+    def test_render_templates(self):
+        email = Email(text='Hi {{ n }}', variables={'a0@b.com': {'n': 0}})
+        email.add_recipients(self.email.get_recipients())
+        sess = mock.Mock()
+        sessions = mock.Mock(get=mock.Mock(return_value=sess))
+        server_side = FakeProvider()
+        server_side.supports_templates = True
+        rendered = ['Hi ', 'Hi ', 'Hi ', 'Hi ', 'Hi 0']
+        with mock.patch.object(FakeProvider, 'email_to_data',
+                               lambda s, e: (DataFormat.form,
+                                             {'text': e.text})):
+            for providers, errors, texts in [
+                    ([server_side], [], ['Hi {{ n }}']),
+                    ([server_side, FakeProvider()], [], ['Hi {{ n }}']),
+                    # Rendered only when failing over
+                    ([server_side, FakeProvider()],
+                     [requests.ConnectionError], ['Hi {{ n }}'] + rendered),
+                    ([FakeProvider(), server_side], [], rendered)]:
+                sess.reset_mock()
+                sess.request.side_effect = errors + ['ok'] * 5
+                mng = ProvidersManager([klass(p) for p in providers], None,
+                                       sessions=sessions)
+                self.assertTrue(mng.send(email)[0])
+                self.assertEqual(
+                    sorted(c[1]['data']['text']
+                           for c in sess.request.call_args_list),
+                    sorted(texts)
+                )
+
+    def test_templates_default_route(self):
+        email = Email(subject='Hi {{ name }}', text='Hey',
+                      variables={'a0@b.com': {'name': 'A'}})
+        email.add_recipients(self.email.get_recipients()[:2])
+        email.from_ = Recipient('noreply@b.com', None, 'from')
+        sess = mock.Mock()
+        sess.request.return_value = TransportResponse(
+            200, '{"success": true, "id": "<m>"}'
+        )
+        mng = ProvidersManager(
+            [MailgunProvider, ElasticEmailProvider],
+            {'mailgun': {'domain': 'mg.fr'}, 'elasticemail': {}},
+            sessions=mock.Mock(get=mock.Mock(return_value=sess))
+        )
+        _, nick = mng.send(email)
+        [call] = sess.request.call_args_list
+        self.assertEqual(nick, 'mailgun')
+        self.assertEqual(call[1]['data']['subject'], 'Hi %recipient.name%')
+
+        # Mailgun is down, Elastic Email gets one email per recipient
+        sess.reset_mock()
+        sess.request.side_effect = [TransportResponse(500)] + \
+            [sess.request.return_value] * 2
+        res, nick = mng.send(email)
+        self.assertTrue(res)
+        self.assertEqual([res.sent, nick], [2, 'elasticemail'])
+        self.assertEqual(
+            sorted((c[1]['data']['msgTo'], c[1]['data']['subject'])
+                   for c in sess.request.call_args_list[1:]),
+            [('a0@b.com', 'Hi A'), ('a1@b.com', 'Hi ')]
+        )
+
+    def test_templates_partly_sent(self):
+        self.small._config['max_recipients'] = 3
+        self.small.supports_templates = True
+        email = Email(text='Hi {{ n }}', variables={})
+        email.add_recipients(self.email.get_recipients())
+        sess = mock.Mock()
+        # The chunk of 2 recipients fails, then one of them
+        sess.request.side_effect = ['ok', requests.ConnectionError,
+                                    requests.ConnectionError, 'ok']
+        mng = ProvidersManager([klass(self.small), klass(FakeProvider())],
+                               None, max_parallel_chunks=1,
+                               sessions=mock.Mock(get=mock.Mock(
+                                   return_value=sess)))
+        res, _ = mng.send(email)
+        self.assertFalse(res)
+        self.assertEqual(res.sent, 2)
+        self.assertEqual([r.email for r in res.unsent_recipients()],
+                         ['a3@b.com'])
+
+    def test_async_templates(self):
+        email = Email(text='Hi {{ n }}', variables={})
+        email.add_recipients(self.email.get_recipients())
+        server_side = FakeProvider(send_url=(HttpMethod.post,
+                                             'http://server.fr'))
+        server_side.supports_templates = True
+        transport = InMemoryTransport(
+            {'http://server.fr': requests.ConnectionError}
+        )
+        mng = AsyncProvidersManager(
+            [klass(server_side), klass(FakeProvider())], None, transport
+        )
+        res, _ = asyncio.run(mng.send(email))
+        self.assertTrue(res)
+        self.assertEqual([len(res), len(transport.calls)], [5, 6])
+
+    def test_async(self):
+        transport = InMemoryTransport()
+        mng = AsyncProvidersManager([klass(self.small)], None, transport)
+        res, _ = asyncio.run(mng.send(self.email))
+        self.assertEqual(res.sent, 3)
+        self.assertEqual(len(transport.calls), 3)
+
+
+class TestProviderRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.provider = FakeProvider()
+        self.factory = mock.Mock(return_value=self.provider)
+        self.registry = ProviderRegistry([self.factory], None)
+
+    def test_built_once(self):
+        self.assertIs(self.registry.get(self.factory), self.provider)
+        self.assertIn(self.factory, self.registry)
+        self.assertEqual(
+            self.registry.target(self.provider),
+            RequestTarget('POST', 'http://google.fr', ('user', 'pw'))
+        )
+        self.assertIsNone(self.registry.target(FakeProvider()))
+        self.assertRaises(
+            InvalidProviderError,
+            ProviderRegistry, [klass(FakeProvider(auth=''))], None
+        )
+
+    def test_manager_reuses_instances(self):
+        sess = mock.Mock()
+        mng = ProvidersManager([self.factory], None, sessions=mock.Mock(),
+                               registry=self.registry)
+        mng.sessions.get.return_value = sess
+        with mock.patch.object(FakeProvider, 'send_url',
+                               new_callable=mock.PropertyMock) as send_url:
+            for _ in range(3):
+                mng.send(Email())
+            send_url.assert_not_called()
+
+        self.factory.assert_called_once_with(None)
+        self.assertEqual(sess.request.call_args[1]['url'],
+                         'http://google.fr')
+
+    def test_payload_memoized(self):
+        provider = FakeProvider()
+        provider.build_from_address = mock.Mock(
+            return_value=Recipient('a@b.com', None, 'from')
+        )
+        registry = ProviderRegistry([klass(provider)], None)
+        sess = mock.Mock()
+        mng = ProvidersManager([klass(provider)] * 2, None,
+                               sessions=mock.Mock(), registry=registry)
+        mng.sessions.get.return_value = sess
+        sess.request.side_effect = [requests.Timeout, 'ok', 'ok']
+
+        email = Email()
+        with mock.patch.object(provider, 'email_to_data',
+                               wraps=provider.email_to_data) as to_data:
+            frozen = email.freeze()
+            mng.send(frozen)  # Failover on the same provider
+            mng.send(frozen)  # Resend
+            self.assertEqual(to_data.call_count, 1)
+            self.assertEqual(sess.request.call_count, 3)
+
+        provider.build_from_address.assert_called_once_with()
+        self.assertIsNone(email.from_)
+        self.assertIsNone(frozen.from_)
+
+
+class TestSessionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = SessionPool({
+            'http': {'pool_size': 3},
+            'providers': {'fake': {'http': {'keep_alive': False}}}
+        })
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_settings(self):
+        settings = self.pool.settings('fake')
+        self.assertEqual(settings['pool_size'], 3)
+        self.assertFalse(settings['keep_alive'])
+        self.assertTrue(self.pool.settings('other')['keep_alive'])
+
+    def test_reuse(self):
+        sess = self.pool.get('fake')
+        self.assertIs(sess, self.pool.get('fake'))
+        self.assertIsNot(sess, self.pool.get('other'))
+        self.assertEqual(sess.headers['Connection'], 'close')
+
+    def test_closed(self):
+        self.pool.get('fake')
+        self.pool.close()
+        self.pool.close()
+        self.assertRaises(RuntimeError, self.pool.get, 'fake')
+
+    def test_send_uses_pool(self):
+        sess = mock.Mock()
+        pool = mock.Mock()
+        pool.get.return_value = sess
+        mng = ProvidersManager([klass(FakeProvider())], None, sessions=pool)
+        res, nick = mng.send(Email())
+
+        pool.get.assert_called_once_with(FakeProvider.nickname)
+        self.assertIs(res, sess.request.return_value)
+        self.assertEqual(nick, FakeProvider.nickname)
+
+
+class TestAsyncProvidersManager(unittest.TestCase):
+
+    def setUp(self):
+        self.down = FakeProvider(send_url=(HttpMethod.post, 'http://down'))
+        self.up = FakeProvider(send_url=(HttpMethod.post, 'http://up'))
+
+    def _send(self, providers, transport, *emails):
+        mng = AsyncProvidersManager(
+            [klass(p) for p in providers], None, transport
+        )
+        return asyncio.run(mng.send_all(emails or [Email()], 2))
+
+    def test_request(self):
+        transport = InMemoryTransport()
+        [(res, nick)] = self._send([self.up], transport)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(nick, self.up.nickname)
+        [call] = transport.calls
+        self.assertEqual(
+            [call['method'], call['url'], call['auth']],
+            ['POST', 'http://up', self.up.auth]
+        )
+        format_, data = self.up._email_data
+        self.assertEqual(call[format_.value], data)
+
+    def test_fallback(self):
+        for excp in [requests.ConnectionError, requests.Timeout('slow')]:
+            transport = InMemoryTransport({'http://down': excp})
+            results = self._send([self.down, self.up], transport,
+                                 Email(), Email(), Email())
+            self.assertEqual(
+                [nick for _, nick in results], [self.up.nickname] * 3
+            )
+            self.assertEqual(len(transport.calls), 6)
+
+            results = self._send([self.down], transport)
+            self.assertEqual(results, [(None, None)])
+
+    def test_unsuccessful_response(self):
+        transport = InMemoryTransport(
+            default=TransportResponse(500, 'oops')
+        )
+        with mock.patch.object(FakeProvider, 'is_success',
+                               lambda self, r: r.status_code == 200):
+            self.assertEqual(
+                self._send([self.up], transport), [(None, None)]
+            )
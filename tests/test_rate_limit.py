@@ -0,0 +1,135 @@
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from email_api.message import Email
+from email_api.providers_manager import ProvidersManager
+from email_api.rate_limit import (
+    Bucket,
+    MemoryBucketStore,
+    RateLimiter,
+    SqliteBucketStore,
+    buckets_from_config
+)
+
+
+class Provider:
+
+    def __init__(self, nickname):
+        self.nickname = nickname
+
+
+class TestBuckets(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [0]
+        self.clock = lambda: self.now[0]
+
+    def test_from_config(self):
+        self.assertEqual(
+            buckets_from_config('a', {'per_second': 2, 'burst': 5,
+                                      'per_day': 8640}),
+            [Bucket('a:per_day', 8640, 0.1), Bucket('a:per_second', 5, 2)]
+        )
+        self.assertEqual(buckets_from_config('a', None), [])
+        for conf in [{'per_week': 1}, {'per_second': 0}]:
+            self.assertRaises(ValueError, buckets_from_config, 'a', conf)
+
+    def check_store(self, store):
+        buckets = [Bucket('a:per_second', 2, 1), Bucket('a:per_minute', 3,
+                                                        0.05)]
+        self.assertEqual([store.take(buckets), store.take(buckets)], [0, 0])
+        self.assertEqual(store.take(buckets), 1)  # per_second is empty
+        self.now[0] = 1
+        self.assertEqual(store.take(buckets), 0)
+        self.now[0] = 2
+        # per_minute is empty too, and refills slower
+        self.assertAlmostEqual(store.take(buckets), 0.9 / 0.05)
+
+    def test_memory(self):
+        self.check_store(MemoryBucketStore(self.clock))
+
+    def test_sqlite_shared(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'buckets.db')
+            first = SqliteBucketStore(path, self.clock)
+            second = SqliteBucketStore(path, self.clock)
+            bucket = [Bucket('b:per_second', 2, 1)]
+            self.assertEqual([first.take(bucket), second.take(bucket)],
+                             [0, 0])
+            self.assertEqual(first.take(bucket), 1)
+            self.check_store(second)
+
+    def test_acquire_waits(self):
+        limiter = RateLimiter({'a': [Bucket('a:per_second', 1, 10)]},
+                              MemoryBucketStore(self.clock), max_wait=0.5,
+                              clock=self.clock)
+        self.assertTrue(limiter.acquire('a'))
+        self.assertTrue(limiter.acquire('b'))  # No limit
+
+        def sleep(seconds):
+            self.now[0] += seconds
+
+        with mock.patch('time.sleep', sleep):
+            self.assertTrue(limiter.acquire('a'))
+            self.assertAlmostEqual(self.now[0], 0.1)
+            # The wait is capped by the caller
+            self.assertFalse(limiter.acquire('a', max_wait=0.01))
+
+        limiter.max_wait = 0
+        self.assertFalse(limiter.acquire('a'))
+        self.assertFalse(asyncio.run(limiter.acquire_async('a')))
+
+    def test_acquire_async_off_the_loop(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SqliteBucketStore(os.path.join(tmp, 'b.db'), self.clock)
+            limiter = RateLimiter({'a': [Bucket('a:per_second', 1, 1)]},
+                                  store, max_wait=0)
+            threads = []
+            take = store.take
+
+            def spy(buckets):
+                threads.append(threading.current_thread())
+                return take(buckets)
+
+            with mock.patch.object(store, 'take', spy):
+                self.assertTrue(asyncio.run(limiter.acquire_async('a')))
+                self.assertFalse(asyncio.run(limiter.acquire_async('a')))
+            # SQLite waits for its lock in the executor
+            self.assertEqual(len(threads), 2)
+            self.assertNotIn(threading.current_thread(), threads)
+
+    def test_from_config_none(self):
+        self.assertIsNone(RateLimiter.from_config({'providers': {'a': {}}}))
+        limiter = RateLimiter.from_config({
+            'providers': {'a': {'rate_limit': {'per_minute': 1}}, 'b': {}}
+        })
+        self.assertEqual(list(limiter.limits), ['a'])
+        self.assertIsInstance(limiter.store, MemoryBucketStore)
+
+
+class TestManagerRateLimit(unittest.TestCase):
+
+    def test_spills_to_next_provider(self):
+        limiter = RateLimiter({'a': [Bucket('a:per_day', 1, 0.0001)]},
+                              max_wait=0)
+        manager = ProvidersManager(
+            [Provider('a'), Provider('b')], {}, sessions=mock.Mock(),
+            rate_limits=limiter
+        )
+        manager._provider = lambda klass: klass
+        sent = []
+
+        def prep(email, provider, request_func):
+            sent.append(provider.nickname)
+            return lambda **kwargs: True
+
+        with mock.patch.object(manager, '_prep_request', prep), \
+                mock.patch.object(manager, '_on_response',
+                                  return_value=True):
+            self.assertEqual(manager.send(Email())[1], 'a')
+            self.assertEqual(manager.send(Email())[1], 'b')
+        self.assertEqual(sent, ['a', 'b'])
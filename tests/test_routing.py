@@ -0,0 +1,223 @@
+import unittest
+from unittest import mock
+
+from email_api import api
+from email_api.cache import LRUCache
+from email_api.message import Email, build_recipients
+from email_api.provider_stats import ProviderStats
+from email_api.routing import Router, UnconfiguredRouteError
+
+
+class A:
+    nickname = 'a'
+
+
+class B:
+    nickname = 'b'
+
+
+class C:
+    nickname = 'c'
+
+
+PROVIDER_BY_NICK = {p.nickname: p for p in [A, B, C]}
+
+
+def email_to(*addresses):
+    email = Email()
+    email.add_recipients(build_recipients({'to': list(addresses)}))
+    return email
+
+
+class TestRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.routes = {
+            'default': ['a', 'b', 'c'],
+            'recipients': [
+                {'domains': ['gmail.com', '.corp.fr'], 'providers': ['b']},
+                {'regex': '.*@((hotmail)|(outlook)|(live))\\..*',
+                 'providers': ['c', 'a']},
+                {'domains': ['*.fr'], 'providers': ['c']},
+            ],
+            'domains_only': [
+                {'domains': ['gmail.com'], 'providers': ['c']},
+            ]
+        }
+        self.router = Router(self.routes, PROVIDER_BY_NICK)
+
+    def route(self, *addresses, routing_type='recipients'):
+        return self.router.route(email_to(*addresses), routing_type)
+
+    def test_default(self):
+        self.assertEqual(self.route('a@b.com'), [A, B, C])
+
+    def test_exact_and_suffix(self):
+        self.assertEqual(self.route('a@GMail.com'), [B])
+        self.assertEqual(self.route('a@corp.fr'), [B])
+        self.assertEqual(self.route('a@mail.corp.fr'), [B])
+        self.assertEqual(self.route('a@blah.fr'), [C])
+        self.assertEqual(self.route('a@gmail.com.evil'), [A, B, C])
+
+    def test_regex_fallback(self):
+        self.assertEqual(self.route('a@hotmail.com'), [C, A])
+
+    def test_first_rule_wins(self):
+        # Rule order matters, not recipient order
+        self.assertEqual(self.route('a@hotmail.com', 'b@gmail.com'), [B])
+        self.assertEqual(self.route('a@x.fr', 'b@live.fr'), [C, A])
+
+    def test_unknown(self):
+        self.assertRaises(UnconfiguredRouteError, self.route, 'a@b.com',
+                          routing_type='nope')
+        self.assertRaises(UnconfiguredRouteError, self.route, 'a@b.com',
+                          routing_type='default')
+
+    def test_bad_rules(self):
+        for rule in [{'providers': ['a']},
+                     {'regex': '(', 'providers': ['a']},
+                     {'domains': ['a.com']}]:
+            self.assertRaises(
+                UnconfiguredRouteError,
+                Router, {'recipients': [rule]}, PROVIDER_BY_NICK
+            )
+
+    def test_unknown_provider_ignored(self):
+        router = Router({'default': ['a', 'nope']}, PROVIDER_BY_NICK)
+        self.assertEqual(router.default, [A])
+
+    def test_cache(self):
+        table = self.router.tables['domains_only']
+        for _ in range(3):
+            self.route('z@b.com', 'x@gmail.com', 'y@gmail.com',
+                       routing_type='domains_only')
+        # Cached by domain when there are no regex rules
+        self.assertEqual(len(table.cache), 2)
+        self.assertEqual(table.cache.misses, 2)
+
+    def test_result_not_shared(self):
+        self.route('a@b.com').append(None)
+        self.assertEqual(self.route('a@b.com'), [A, B, C])
+
+    def test_split(self):
+        email = email_to('a@hotmail.com', 'b@gmail.com', 'c@x.com',
+                         'd@gmail.com')
+        email.add_recipients(build_recipients({'cc': 'e@y.com'}))
+        parts = {
+            part.recipient_addresses('to'): (
+                part.recipient_addresses('cc'), providers
+            )
+            for part, providers in self.router.split(email, 'recipients')
+        }
+        self.assertEqual(parts, {
+            ('a@hotmail.com',): ((), [C, A]),
+            ('b@gmail.com', 'd@gmail.com'): (('e@y.com',), [B]),
+            ('c@x.com',): ((), [A, B, C]),
+        })
+
+        [(part, providers)] = self.router.split(
+            email_to('a@gmail.com', 'b@gmail.com'), 'recipients'
+        )
+        self.assertEqual([part.recipient_count, providers], [2, [B]])
+        self.assertRaises(UnconfiguredRouteError, self.router.split,
+                          email, 'nope')
+
+    def test_split_send(self):
+        email = email_to('a@hotmail.com', 'b@gmail.com')
+        managers = {}
+
+        def new_manager(providers):
+            manager = managers[tuple(providers)] = mock.Mock()
+            manager.send.return_value = (
+                (True, providers[0].nickname) if providers != [B]
+                else (None, None)
+            )
+            return manager
+
+        config = {api.ROUTER_KEY: self.router,
+                  api.SPLIT_ROUTING_KEY: {'enabled': True}}
+        with mock.patch.object(api, 'app') as app, \
+                mock.patch.object(api, 'new_manager', new_manager):
+            app.return_value.config = config
+            res, nick = api.send(email, 'recipients')
+
+        self.assertEqual([res.sent, len(res), bool(res), nick],
+                         [1, 2, False, 'c'])
+        self.assertEqual(set(managers), {(B,), (C, A)})
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual([cache.get('a'), cache.get('c')], [1, 3])
+        self.assertEqual(cache.stats()['hits'], 3)
+
+    def test_ttl(self):
+        now = [0]
+        cache = LRUCache(10, ttl=5, clock=lambda: now[0])
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        now[0] = 5
+        self.assertEqual(cache.get('a', 'gone'), 'gone')
+        self.assertEqual(len(cache), 0)
+
+
+class TestProviderStats(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = ProviderStats(alpha=0.5, min_samples=2)
+
+    def record(self, nick, success, latency, times=2):
+        for _ in range(times):
+            self.stats.record(nick, success, latency)
+
+    def test_ewma(self):
+        self.stats.record('a', True, 1)
+        self.stats.record('a', False, 3)
+        stat = self.stats.snapshot()['a']
+        self.assertEqual([stat['latency'], stat['success_rate']], [2, 0.5])
+
+    def test_rank(self):
+        self.record('a', True, 0.5)
+        self.record('b', True, 0.1)
+        self.assertEqual(self.stats.rank([A, B]), [B, A])
+
+    def test_fast_failures_rank_last(self):
+        self.record('a', True, 0.5)
+        self.record('b', False, 0.001)
+        self.assertEqual(self.stats.rank([B, A]), [A, B])
+
+    def test_unknown_first(self):
+        self.record('a', True, 0.5)
+        self.record('b', True, 0.1)
+        self.stats.record('c', True, 10)  # Not enough samples
+        self.assertEqual(self.stats.rank([A, B, C]), [C, B, A])
+
+    def test_get_route(self):
+        config = {
+            'routes': {'default': ['a', 'b'],
+                       'recipients': [{'domains': ['b.com'],
+                                       'providers': ['c', 'b']}]},
+            api.STATS_OBJ_KEY: self.stats,
+        }
+        self.record('b', True, 0.1)
+        self.record('c', True, 0.5)
+
+        with mock.patch.dict(api.PROVIDER_BY_NICK, PROVIDER_BY_NICK,
+                             clear=True):
+            # Config still restricts the providers
+            self.assertEqual(
+                api.get_route(config, email_to('a@b.com'), 'recipients'),
+                [B, C]
+            )
+            self.stats.enabled = False
+            self.assertEqual(
+                api.get_route(config, email_to('a@b.com'), 'recipients'),
+                [C, B]
+            )
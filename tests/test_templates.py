@@ -0,0 +1,25 @@
+import unittest
+
+from email_api import templates
+from email_api.templates import Template, compile_template
+
+
+class TestTemplate(unittest.TestCase):
+
+    def test_render(self):
+        tpl = Template('Hi {{ name }}, {{code}}{{ name}}!')
+        self.assertEqual(tpl.variables, {'name', 'code'})
+        self.assertEqual(tpl.render({'name': 'Bob', 'code': 42}),
+                         'Hi Bob, 42Bob!')
+        self.assertEqual(tpl.render({}), 'Hi , !')
+        self.assertEqual(tpl.to('%{}%'.format), 'Hi %name%, %code%%name%!')
+        self.assertEqual(Template('{ {x}} {{ 1x }}').render({'x': 1}),
+                         '{ {x}} {{ 1x }}')
+
+    def test_compiled_once(self):
+        templates.cache.clear()
+        tpl = compile_template('Hi {{ name }}')
+        self.assertIs(compile_template('Hi ' + '{{ name }}'), tpl)
+        self.assertIsNot(compile_template('Hi {{ other }}'), tpl)
+        self.assertIsNone(compile_template(None))
+        self.assertEqual(templates.cache.hits, 1)
@@ -0,0 +1,162 @@
+import hashlib
+import hmac
+import time
+import unittest
+
+from email_api.abstract_provider import (
+    InvalidCallbackError,
+    InvalidProviderError
+)
+from email_api.elasticemail_provider import ElasticEmailProvider
+from email_api.mailgun_provider import MailgunProvider
+from email_api.providers_manager import ProvidersManager
+from email_api.transports import TransportResponse
+from email_api.webhooks import DeliveryEvent, EventQueue, QueueFullError
+
+
+def mailgun_event(event='delivered', key='', signed_at=None, **extra):
+    timestamp = str(int(signed_at or time.time()))
+    signature = {'timestamp': timestamp, 'token': 'abc'}
+    signature['signature'] = hmac.new(
+        key.encode(), (timestamp + 'abc').encode(), hashlib.sha256
+    ).hexdigest()
+    data = dict({
+        'event': event,
+        'timestamp': 1529006854.3,
+        'recipient': 'a@b.com',
+        'message': {'headers': {'message-id': 'm1@mg.fr'}},
+    }, **extra)
+    return {'signature': signature, 'event-data': data}
+
+
+class TestEventQueue(unittest.TestCase):
+
+    def test_batches(self):
+        saved = []
+        events = EventQueue(saved.append, queue_size=5, batch_size=2)
+        events.put(range(4))
+        # All or nothing: a retried call must not save events twice
+        self.assertRaises(QueueFullError, events.put, [4, 5])
+        self.assertEqual(len(events), 4)
+        events.put([4])
+        self.assertRaises(QueueFullError, events.put, [5])
+        self.assertEqual(
+            [events.flush_once(0) for _ in range(4)], [2, 2, 1, 0]
+        )
+        self.assertEqual(saved, [[0, 1], [2, 3], [4]])
+
+    def test_failed_save_retried(self):
+        saved = []
+
+        def save(batch):
+            if not saved:
+                saved.append(None)
+                raise OSError('database is locked')
+            saved.extend(batch)
+
+        events = EventQueue(save, batch_size=2)
+        events.put(range(3))
+        self.assertEqual(events.flush_once(0), 0)
+        self.assertEqual(len(events), 3)
+        while events.flush_once(0):
+            pass
+        self.assertEqual(saved, [None, 0, 1, 2])
+
+    def test_stop_saves_queued(self):
+        saved = []
+        events = EventQueue(saved.extend, poll_interval=0.01)
+        events.start()
+        events.put(range(3))
+        events.stop()
+        self.assertEqual(saved, [0, 1, 2])
+        self.assertEqual(len(events), 0)
+
+
+class TestMailgun(unittest.TestCase):
+
+    def setUp(self):
+        self.provider = MailgunProvider({'mailgun': {
+            'domain': 'mg.fr', 'webhook_signing_key': 'secret'
+        }})
+
+    def test_parse(self):
+        self.assertEqual(
+            self.provider.parse_callback(mailgun_event(key='secret')),
+            [DeliveryEvent('mailgun', 'm1@mg.fr', 'a@b.com', 'delivered',
+                           1529006854.3, None)]
+        )
+        [event] = self.provider.parse_callback(mailgun_event(
+            'failed', 'secret', severity='permanent',
+            **{'delivery-status': {'description': 'No such user'}}
+        ))
+        self.assertEqual([event.event, event.reason],
+                         ['bounced', 'No such user'])
+        self.assertEqual(
+            self.provider.parse_callback(mailgun_event('stored', 'secret')),
+            []
+        )
+
+    def test_invalid(self):
+        for data in [mailgun_event(key='wrong'), {'event-data': {}}, [],
+                     mailgun_event(key='secret', signed_at=1529006854),
+                     dict(mailgun_event(key='secret'),
+                          signature={'timestamp': 'now', 'token': 'abc',
+                                     'signature': '\xe9'})]:
+            self.assertRaises(InvalidCallbackError,
+                              self.provider.parse_callback, data)
+
+    def test_message_id(self):
+        self.assertEqual(
+            self.provider.message_id(TransportResponse(
+                200, '{"id": "<m1@mg.fr>", "message": "Queued"}'
+            )),
+            'm1@mg.fr'
+        )
+        self.assertIsNone(self.provider.message_id(TransportResponse(500)))
+
+
+class TestElasticEmail(unittest.TestCase):
+
+    def setUp(self):
+        self.provider = ElasticEmailProvider({'elasticemail': {
+            'webhook_token': 't0k'
+        }})
+
+    def test_parse(self):
+        data = {'token': 't0k', 'messageid': 'm2', 'to': 'a@b.com',
+                'status': 'Error', 'category': 'NoMailbox',
+                'date': '6/14/2018 7:54:14 PM'}
+        self.assertEqual(
+            self.provider.parse_callback(data),
+            [DeliveryEvent('elasticemail', 'm2', 'a@b.com', 'bounced',
+                           1529006054.0, 'NoMailbox')]
+        )
+        for token in ['nope', '\xe9t\xe9', None]:
+            self.assertRaises(InvalidCallbackError,
+                              self.provider.parse_callback,
+                              dict(data, token=token))
+        self.assertRaises(InvalidCallbackError, self.provider.parse_callback,
+                          dict(data, date='yesterday'))
+
+    def test_message_id(self):
+        self.assertEqual(self.provider.message_id(TransportResponse(
+            200, '{"success": true, "data": {"messageid": "m2"}}'
+        )), 'm2')
+
+
+class TestHandleCallback(unittest.TestCase):
+
+    def test_dispatch(self):
+        manager = ProvidersManager(
+            [MailgunProvider, ElasticEmailProvider],
+            {'mailgun': {'domain': 'mg.fr'}, 'elasticemail': {}}
+        )
+        [event] = manager.handle_callback('mailgun', mailgun_event())
+        self.assertEqual(event.message_id, 'm1@mg.fr')
+        self.assertRaises(InvalidProviderError, manager.handle_callback,
+                          'nope', {})
+        self.assertEqual(
+            manager.message_id(TransportResponse(200, '{"id": "<m>"}'),
+                               'mailgun'),
+            'm'
+        )